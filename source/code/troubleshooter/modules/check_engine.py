@@ -0,0 +1,160 @@
+import sys
+import threading
+
+from error_codes import *
+from errors      import error_info, is_error, print_errors
+
+# Queue module renamed in Python 3
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+MAX_WORKERS = 8
+
+
+
+# one check of the troubleshooter, run once all the checks it requires passed
+class Check(object):
+    def __init__(self, name, section, message, run, requires=()):
+        self.name = name
+        self.section = section
+        self.message = message
+        self.run = run
+        self.requires = list(requires)
+        # filled in when the check has run
+        self.result = None
+        self.errors = []
+        self.output = []
+        self.skipped_by = None
+
+
+
+# sys.stdout replacement holding what each check thread prints until the check is reported
+class CheckOutput(object):
+    def __init__(self, stdout):
+        self.stdout = stdout
+        self.local = threading.local()
+        self.softspace = 0
+
+    def capture(self, output):
+        self.local.output = output
+
+    def write(self, text):
+        output = getattr(self.local, 'output', None)
+        if (output == None):
+            self.stdout.write(text)
+        else:
+            output.append(text)
+
+    def flush(self):
+        self.stdout.flush()
+
+
+
+# run a single check, keeping its error info and output for the report
+def run_check(check, check_output):
+    error_info.capture(check.errors)
+    check_output.capture(check.output)
+    try:
+        check.result = check.run()
+    except Exception as e:
+        check.output.append("ERROR (INTERNAL): check '{0}' failed: {1}\n".format(check.name, e))
+        check.result = ERR_FOUND
+    finally:
+        error_info.capture(None)
+        check_output.capture(None)
+
+def check_worker(todo, done, check_output):
+    while True:
+        check = todo.get()
+        if (check == None):
+            return
+        run_check(check, check_output)
+        done.put(check)
+
+
+
+# print a check which has run (or been skipped) as the sequential troubleshooter would
+def report_check(check, prev_section):
+    if (check.section != prev_section):
+        if (prev_section != None):
+            print("================================================================================")
+        print(check.section)
+    print(check.message)
+    if (check.skipped_by != None):
+        print("Skipping this check, '{0}' check failed...".format(check.skipped_by))
+        return NO_ERROR
+    sys.stdout.write(''.join(check.output))
+    if (check.result in [NO_ERROR, USER_EXIT]):
+        return check.result
+    error_info.extend(check.errors)
+    return print_errors(check.result)
+
+
+
+# run all checks, concurrently as soon as the checks they require passed, and report
+# them in the given order (where each check must come after the checks it requires)
+def run_checks(checks, max_workers=MAX_WORKERS):
+    by_name = dict()
+    for check in checks:
+        for req in check.requires:
+            if (req not in by_name):
+                raise ValueError("Check '{0}' requires '{1}', which isn't listed before it".format(check.name, req))
+        by_name[check.name] = check
+
+    waiting = list(checks)
+    finished = set()
+    nb_running = 0
+    nb_reported = 0
+    section = None
+    success = NO_ERROR
+
+    todo = Queue()
+    done = Queue()
+    check_output = CheckOutput(sys.stdout)
+    workers = []
+    for i in range(min(max_workers, len(checks))):
+        worker = threading.Thread(target=check_worker, args=(todo, done, check_output))
+        worker.daemon = True
+        worker.start()
+        workers.append(worker)
+
+    sys.stdout = check_output
+    try:
+        while (nb_reported < len(checks)):
+            # start (or skip) every check whose required checks have all finished
+            for check in list(waiting):
+                if (not set(check.requires).issubset(finished)):
+                    continue
+                waiting.remove(check)
+                for req in check.requires:
+                    if (by_name[req].skipped_by != None or is_error(by_name[req].result)):
+                        check.skipped_by = req
+                        break
+                if (check.skipped_by != None):
+                    finished.add(check.name)
+                else:
+                    todo.put(check)
+                    nb_running += 1
+
+            # report the checks finished so far, in order
+            while (nb_reported < len(checks) and checks[nb_reported].name in finished):
+                checked = report_check(checks[nb_reported], section)
+                if (checked == USER_EXIT):
+                    return USER_EXIT
+                if (checked != NO_ERROR):
+                    success = ERR_FOUND
+                section = checks[nb_reported].section
+                nb_reported += 1
+
+            if (nb_running > 0):
+                check = done.get()
+                finished.add(check.name)
+                nb_running -= 1
+    finally:
+        sys.stdout = check_output.stdout
+        for worker in workers:
+            todo.put(None)
+
+    return success
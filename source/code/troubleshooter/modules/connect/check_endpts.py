@@ -1,7 +1,11 @@
 # INSPIRED BY update_mgmt_health_check.py
 
 import os
+import socket
+import ssl
 import subprocess
+import threading
+import time
 
 from error_codes import *
 from errors      import error_info
@@ -11,6 +15,13 @@ OMSADMIN_PATH = "/etc/opt/microsoft/omsagent/conf/omsadmin.conf"
 CERT_PATH = "/etc/opt/microsoft/omsagent/certs/oms.crt"
 KEY_PATH = "/etc/opt/microsoft/omsagent/certs/oms.key"
 SSL_CMD = "echo | openssl s_client -connect {0}:443 -brief"
+SSL_CERT_CMD = "{0} -cert {1} -key {2}".format(SSL_CMD, CERT_PATH, KEY_PATH)
+# seconds shared by all the endpoints probed together
+PROBE_TIMEOUT = 10
+
+# addresses of the endpoints resolved during this run
+dns_cache = dict()
+dns_lock = threading.Lock()
 
 
 
@@ -36,16 +47,159 @@ def check_endpt_ssl(ssl_cmd, endpoint):
 
 
 
+def certs_exist():
+    return (os.path.isfile(CERT_PATH) and os.path.isfile(KEY_PATH))
+
+def resolve_endpt(endpoint, port):
+    with dns_lock:
+        if ((endpoint, port) in dns_cache):
+            return dns_cache[(endpoint, port)]
+    addrs = socket.getaddrinfo(endpoint, port, 0, socket.SOCK_STREAM)
+    with dns_lock:
+        dns_cache[(endpoint, port)] = addrs
+    return addrs
+
+def time_left(deadline):
+    left = deadline - time.time()
+    if (left <= 0):
+        raise socket.timeout("timed out")
+    return left
+
+# verifies the server against the system CAs (or the CAs in cafile), and presents the agent
+# certificate if the server asks for one
+def get_ssl_context(use_certs, cafile=None):
+    context = ssl.SSLContext(getattr(ssl, 'PROTOCOL_TLS_CLIENT', ssl.PROTOCOL_SSLv23))
+    context.verify_mode = ssl.CERT_REQUIRED
+    context.check_hostname = True
+    if (cafile == None):
+        context.load_default_certs()
+    else:
+        context.load_verify_locations(cafile)
+    if (use_certs):
+        try:
+            context.load_cert_chain(CERT_PATH, KEY_PATH)
+        except (IOError, OSError, ssl.SSLError):
+            pass  # probe without the agent certificate
+    return context
+
+# native TLS connection to an endpoint, filling in result with its timings (in seconds)
+def probe_endpt(result, port, context, deadline):
+    endpoint = result['endpoint']
+    try:
+        start = time.time()
+        addrs = resolve_endpt(endpoint, port)
+        result['dns'] = time.time() - start
+
+        start = time.time()
+        sock = None
+        for (family, socktype, proto, canonname, addr) in addrs:
+            sock = socket.socket(family, socktype, proto)
+            try:
+                sock.settimeout(time_left(deadline))
+                sock.connect(addr)
+                break
+            except socket.error:
+                sock.close()
+                sock = None
+                # try the next address, unless it was the last one
+                if ((family, socktype, proto, canonname, addr) == addrs[-1]):
+                    raise
+        result['connect'] = time.time() - start
+
+        # the certificate chain and host name are verified during the handshake
+        start = time.time()
+        try:
+            sock.settimeout(time_left(deadline))
+            ssl_sock = context.wrap_socket(sock, server_hostname=endpoint)
+            result['handshake'] = time.time() - start
+            result['connected'] = True
+            result['verified'] = True
+            ssl_sock.close()
+        finally:
+            sock.close()
+    except ssl.CertificateError as e:
+        result['handshake'] = time.time() - start
+        result['connected'] = True
+        result['error'] = "certificate verification failed ({0})".format(e)
+    except ssl.SSLError as e:
+        if ('CERTIFICATE_VERIFY_FAILED' in str(e) or getattr(e, 'reason', None) == 'CERTIFICATE_VERIFY_FAILED'):
+            result['handshake'] = time.time() - start
+            result['connected'] = True
+            result['error'] = "certificate verification failed"
+        else:
+            result['error'] = "TLS handshake failed ({0})".format(e)
+    except socket.timeout:
+        result['error'] = "timed out"
+    except socket.gaierror as e:
+        result['error'] = "couldn't resolve endpoint ({0})".format(e.args[-1])
+    except socket.error as e:
+        result['error'] = "couldn't connect ({0})".format(e.args[-1])
+
+# connect to all endpoints at once (verifying against the CAs in cafile if given), returns a result
+# dict per endpoint: endpoint, connected, verified, error, and the dns / connect / handshake timings reached
+def probe_endpts(endpoints, port=443, timeout=PROBE_TIMEOUT, cafile=None):
+    use_certs = certs_exist()
+    results = [dict(endpoint=endpt, connected=False, verified=False, error=None) for endpt in endpoints]
+
+    # ssl.SSLContext is only in Python 2.7.9+, use openssl one endpoint at a time
+    if (not hasattr(ssl, 'SSLContext')):
+        for result in results:
+            (connected, verified) = check_endpt_ssl(SSL_CMD, result['endpoint'])
+            if (not verified and use_certs):
+                (cert_connected, cert_verified) = check_endpt_ssl(SSL_CERT_CMD, result['endpoint'])
+                if (cert_connected):
+                    (connected, verified) = (cert_connected, cert_verified)
+            result['connected'] = connected
+            result['verified'] = verified
+            if (not verified):
+                result['error'] = "openssl command failed"
+        return results
+
+    context = get_ssl_context(use_certs, cafile)
+    deadline = time.time() + timeout
+    threads = []
+    for result in results:
+        thread = threading.Thread(target=probe_endpt, args=(result, port, context, deadline))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for i in range(len(threads)):
+        threads[i].join(max(deadline - time.time(), 0))
+        if (threads[i].is_alive()):
+            # DNS lookups can't be interrupted, leave the thread behind (keeping the timings it reached)
+            results[i] = dict(results[i], connected=False, verified=False,\
+                              error="timed out after {0}s".format(timeout))
+    return results
+
+def print_endpt_timings(results):
+    for result in results:
+        timings = []
+        for step in ['dns', 'connect', 'handshake']:
+            if (step in result):
+                timings.append("{0} {1:.0f}ms".format(step, result[step] * 1000))
+        if (result['error'] != None):
+            timings.append(result['error'])
+        print("  {0}: {1}".format(result['endpoint'], ', '.join(timings)))
+
+# openssl command to give the user to look into an endpoint
+def get_ssl_cmd(endpoint):
+    if (certs_exist()):
+        return SSL_CERT_CMD.format(endpoint)
+    return SSL_CMD.format(endpoint)
+
+
+
 # check general internet connectivity
 def check_internet_connect():
-    (connected_docs, verified_docs) = check_endpt_ssl(SSL_CMD, "docs.microsoft.com")
-    if (connected_docs and verified_docs):
+    result = probe_endpts(["docs.microsoft.com"])[0]
+    print_endpt_timings([result])
+    if (result['connected'] and result['verified']):
         return NO_ERROR
-    elif (connected_docs and not verified_docs):
+    elif (result['connected'] and not result['verified']):
         error_info.append((SSL_CMD.format("docs.microsoft.com"),))
         return WARN_INTERNET
     else:
-        error_info.append((SSL_CMD.format("docs.microsoft.com"),))
+        error_info.append((SSL_CMD.format("docs.microsoft.com"), result['error']))
         return WARN_INTERNET_CONN
 
 
@@ -59,35 +213,23 @@ def check_agent_service_endpt():
         return ERR_INFO_MISSING
     agent_endpt = dsc_endpt.split('/')[2]
 
-    # check without certs
-    (dsc_connected, dsc_verified) = check_endpt_ssl(SSL_CMD, agent_endpt)
-    if (dsc_connected and dsc_verified):
+    result = probe_endpts([agent_endpt])[0]
+    print_endpt_timings([result])
+    if (result['connected'] and result['verified']):
         return NO_ERROR
 
-    else:
-        # try with certs (if they exist)
-        if (os.path.isfile(CERT_PATH) and os.path.isfile(KEY_PATH)):
-            ssl_command = "{0} -cert {1} -key {2}".format(SSL_CMD, CERT_PATH, KEY_PATH)
-            (dsc_cert_connected, dsc_cert_verified) = check_endpt_ssl(ssl_command, agent_endpt)
-            # with certs connected and verified
-            if (dsc_cert_connected and dsc_cert_verified):
-                return NO_ERROR
-            # with certs connected, but didn't verify
-            elif (dsc_cert_connected and not dsc_cert_verified):
-                error_info.append((agent_endpt, ssl_command.format(agent_endpt)))
-                return WARN_ENDPT
-        else:
-            # lets user know cert and key aren't there
-            print("NOTE: Certificate and key files don't exist, OMS isn't onboarded.")
+    # lets user know cert and key aren't there
+    if (not certs_exist()):
+        print("NOTE: Certificate and key files don't exist, OMS isn't onboarded.")
 
-        # if certs didn't work at all, check to see if no certs was connected (but not verified)
-        if (dsc_connected and not dsc_verified):
-            error_info.append((agent_endpt, SSL_CMD.format(agent_endpt)))
-            return WARN_ENDPT
+    # connected, but didn't verify
+    if (result['connected']):
+        error_info.append((agent_endpt, get_ssl_cmd(agent_endpt)))
+        return WARN_ENDPT
 
-        # neither with nor without certs connected
-        error_info.append((agent_endpt, SSL_CMD.format(agent_endpt)))
-        return ERR_ENDPT
+    # couldn't connect
+    error_info.append((agent_endpt, get_ssl_cmd(agent_endpt), result['error']))
+    return ERR_ENDPT
 
 
 
@@ -95,7 +237,6 @@ def check_agent_service_endpt():
 # check log analytics endpoints
 def check_log_analytics_endpts():
     success = NO_ERROR
-    no_certs_printed = False
     connected_err = []
     verified_err = []
 
@@ -120,47 +261,26 @@ def check_log_analytics_endpts():
         log_analytics_endpts = ["*.ods.opinsights.azure.com", "*.oms.opinsights.azure.com", \
             "ods.systemcenteradvisor.com"]
 
-    for endpt in log_analytics_endpts:
-        # replace '*' with workspace ID
-        if ('*' in endpt):
-            endpt = endpt.replace('*', workspace_id)
-
-        # check endpoint without certs
-        (la_connected, la_verified) = check_endpt_ssl(SSL_CMD, endpt)
-        if (not (la_connected or la_verified)):
-            # try with certs (if they exist)
-            if (os.path.isfile(CERT_PATH) and os.path.isfile(KEY_PATH)):
-                ssl_command = "{0} -cert {1} -key {2}".format(SSL_CMD, CERT_PATH, KEY_PATH)
-                (la_cert_connected, la_cert_verified) = check_endpt_ssl(ssl_command, endpt)
-
-                # didn't connect or verify with certs
-                if (not (la_cert_connected or la_cert_verified)):
-                    connected_err.append((endpt, ssl_command.format(endpt)))
-                    success = ERR_ENDPT
-
-                # connected but didn't verify with certs
-                elif (la_cert_connected and not la_cert_verified):
-                    # haven't run into a connected error already
-                    if (success != ERR_ENDPT):
-                        verified_err.append((endpt, ssl_command.format(endpt)))
-                        success = WARN_ENDPT
-
-            else:
-                # lets user know cert and key aren't there
-                if (not no_certs_printed):
-                    print("NOTE: Certificate and key files don't exist, OMS isn't onboarded.")
-                    no_certs_printed = True
-
-                # if certs didn't work at all, check to see if no certs was connected (but not verified)
-                if (la_connected and not la_verified):
-                    # haven't run into a connected error already
-                    if (success != ERR_ENDPT):
-                        verified_err.append((endpt, SSL_CMD.format(endpt)))
-                        success = WARN_ENDPT
-
-                # neither with nor without certs connected
-                connected_err.append((endpt, SSL_CMD.format(endpt)))
-                success = ERR_ENDPT
+    # replace '*' with workspace ID, and check all endpoints at once
+    log_analytics_endpts = [endpt.replace('*', workspace_id) for endpt in log_analytics_endpts]
+    results = probe_endpts(log_analytics_endpts)
+    print_endpt_timings(results)
+
+    for result in results:
+        endpt = result['endpoint']
+        # didn't connect
+        if (not result['connected']):
+            connected_err.append((endpt, get_ssl_cmd(endpt), result['error']))
+            success = ERR_ENDPT
+        # connected but didn't verify
+        elif (not result['verified']):
+            verified_err.append((endpt, get_ssl_cmd(endpt)))
+            if (success != ERR_ENDPT):
+                success = WARN_ENDPT
+
+    # lets user know cert and key aren't there
+    if (success != NO_ERROR and not certs_exist()):
+        print("NOTE: Certificate and key files don't exist, OMS isn't onboarded.")
 
     # if any connection issues found
     if (success == ERR_ENDPT):
@@ -168,4 +288,4 @@ def check_log_analytics_endpts():
     # if no connection issues found but some verification issues found
     elif (success == WARN_ENDPT):
         error_info.extend(verified_err)
-    return success
\ No newline at end of file
+    return success
@@ -1,8 +1,8 @@
 import os
-import subprocess
 
 from error_codes import *
 from errors      import error_info, get_input
+from helpers     import get_cmd_output
 
 CLCONF_PATH = "/etc/opt/microsoft/omsagent/conf/omsagent.d/customlog.conf"
 OMSCONFLOG_PATH = "/var/opt/microsoft/omsconfig/omsconfig.log"
@@ -79,7 +79,7 @@ def check_customlog(log_dict):
 
         # check unique number with custom log
         un_pos = parsed_lines[2]
-        log_ls_info = subprocess.check_output(['ls','-li',log_path])
+        log_ls_info = get_cmd_output(['ls','-li',log_path])
         un_log = (log_ls_info.split())[0]
         un_log_hex = hex(int(un_log)).lstrip('0x').rstrip('L')
         if (un_pos != un_log_hex):
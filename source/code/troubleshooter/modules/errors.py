@@ -1,5 +1,6 @@
 import copy
 import subprocess
+import threading
 
 from error_codes import *
 
@@ -9,8 +10,31 @@ try:
 except NameError:
     pass
 
+# error info of the errors found, kept apart for each check the check engine runs on its own thread
+class ErrorInfo(object):
+    def __init__(self):
+        self.shared = []
+        self.local = threading.local()
+
+    # send the error info added by the calling thread to entries (None to go back to the shared list)
+    def capture(self, entries):
+        self.local.entries = entries
+
+    # list of the error info of the calling thread
+    def entries(self):
+        entries = getattr(self.local, 'entries', None)
+        if (entries == None):
+            return self.shared
+        return entries
+
+    def append(self, item):
+        self.entries().append(item)
+
+    def extend(self, items):
+        self.entries().extend(items)
+
 # error info edited when error occurs
-error_info = []
+error_info = ErrorInfo()
 
 # list of all errors called when script ran
 err_summary = []
@@ -55,7 +79,7 @@ error_messages = {
     ERR_RSA_KEY : "RSA key is invalid, please check {0} for the issue.",
     ERR_FILE_EMPTY : "File {0} is empty.",
     ERR_INFO_MISSING : "Couldn't get {0}. Please check {1} for the issue.",
-    ERR_ENDPT : "Machine couldn't connect to {0}: openssl command failed. "\
+    ERR_ENDPT : "Machine couldn't connect to {0}: {2}. "\
           "Please run the command below for more information on the failure:\n"\
           "\n  $ {1}\n",
     ERR_GUID : "The agent is configured to report to a different workspace - the GUID "\
@@ -73,7 +97,7 @@ error_messages = {
     ERR_HEARTBEAT : "Heartbeats are failing to send data to the workspace.",
     ERR_MULTIHOMING : "Machine registered with more than one log analytics workspace. List of "\
           "workspaces: {0}",
-    WARN_INTERNET_CONN : "Machine is not connected to the internet: openssl command failed. "\
+    WARN_INTERNET_CONN : "Machine is not connected to the internet: {1}. "\
           "Please run the command below for more information on the failure:\n"\
           "\n  $ {0}\n",
     ERR_QUERIES : "The following queries failed: {0}.",
@@ -228,15 +252,16 @@ def print_errors(err_code):
 
     err_string = error_messages[err_code]
 
+    entries = error_info.entries()
     # no formatting
-    if (error_info == []):
+    if (entries == []):
         err_string = "ERROR FOUND: {0}".format(err_string)
         err_summary.append(err_string)
         print(err_string)
     # needs input
     else:
-        while (len(error_info) > 0):
-            tup = error_info.pop(0)
+        while (len(entries) > 0):
+            tup = entries.pop(0)
             temp_err_string = err_string.format(*tup)
             if (warning):
                 final_err_string = "WARNING FOUND: {0}".format(temp_err_string)
@@ -1,9 +1,10 @@
 import re
 import subprocess
+import sys
 
 from error_codes        import *
 from errors             import error_info, is_error, print_errors
-from helpers            import geninfo_lookup
+from helpers            import geninfo_lookup, get_cmd_output
 from install.check_oms  import get_oms_version
 from install.install    import check_installation
 from connect.connect    import check_connection
@@ -16,9 +17,19 @@ SC_PATH = "/opt/microsoft/omsagent/bin/service_control"
 
 
 
+# run a service_control command, printing its output through sys.stdout so that it is
+# reported along with the check which ran it
+def run_sc(cmd):
+    sc_proc = subprocess.Popen([SC_PATH, cmd], stdout=subprocess.PIPE, stderr=subprocess.STDOUT,\
+                universal_newlines=True)
+    output = sc_proc.communicate()[0]
+    if (output != ''):
+        sys.stdout.write(output)
+    return sc_proc.returncode
+
 def check_omsagent_running_sc():
     # check if OMS is running through service control
-    is_running = subprocess.call([SC_PATH, 'is-running'])
+    is_running = run_sc('is-running')
     if (is_running == 1):
         return NO_ERROR
     elif (is_running == 0):
@@ -30,7 +41,7 @@ def check_omsagent_running_sc():
         return ERR_OMS_WONT_RUN
 
 def check_omsagent_running_omsadmin(workspace):
-    output = subprocess.check_output(['sh', OMSADMIN_SH_PATH, '-l'], universal_newlines=True)
+    output = get_cmd_output(['sh', OMSADMIN_SH_PATH, '-l'])
     output_regx = "Primary Workspace: (\S+)    Status: (\w+)\((\b+)\)\n"
     output_matches = re.match(output_regx, output)
 
@@ -76,7 +87,7 @@ def check_omsagent_running_omsadmin(workspace):
 
 def check_omsagent_running_ps(workspace):
     # check if OMS is running through 'ps'
-    processes = subprocess.check_output(['ps', '-ef'], universal_newlines=True).split('\n')
+    processes = get_cmd_output(['ps', '-ef']).split('\n')
     for process in processes:
         # check if process is OMS
         if (not process.startswith('omsagent')):
@@ -134,9 +145,9 @@ def start_omsagent(workspace, enabled=False):
     result = 0
     # enable the agent if necessary
     if (not enabled):
-        result = subprocess.call([SC_PATH, 'enable'])
+        result = run_sc('enable')
     # start the agent if enable was successful
-    result = (subprocess.call([SC_PATH, 'start'])) if (result == 0) else (result)
+    result = (run_sc('start')) if (result == 0) else (result)
 
     # check if successful
     if (result == 0):
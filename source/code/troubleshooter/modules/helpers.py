@@ -2,6 +2,8 @@ import errno
 import os
 import ssl
 import subprocess
+import sys
+import threading
 
 from error_codes import *
 from errors      import error_info, print_errors
@@ -23,8 +25,16 @@ except ImportError:
         pass  # will use /etc/os-release check
 
 CONF_PATH = "/etc/opt/microsoft/omsagent/conf/omsadmin.conf"
+CPUINFO_PATH = "/proc/cpuinfo"
+OS_RELEASE_PATH = "/etc/os-release"
+DPKG_STATUS_PATH = "/var/lib/dpkg/status"
+RPMDB_PATHS = ["/var/lib/rpm/Packages", "/var/lib/rpm/rpmdb.sqlite", "/usr/lib/sysimage/rpm/rpmdb.sqlite"]
+# packages looked up together, with any other package asked for
+AGENT_PKGS = ['omsconfig', 'omi', 'scx', 'omsagent']
 
 general_info = dict()
+# checks run concurrently by the check engine share one update of general_info
+geninfo_lock = threading.Lock()
 
 def add_geninfo(key, value):
     general_info[key] = value
@@ -32,26 +42,155 @@ def add_geninfo(key, value):
 
 def geninfo_lookup(key):
     try:
+        if (geninfo_changed()):
+            raise KeyError(key)
         val = general_info[key]
     except KeyError:
-        updated_geninfo = update_geninfo_all()
-        if (updated_geninfo != NO_ERROR):
-            print_errors(updated_geninfo)
-            return None
-        val = general_info[key]
+        with geninfo_lock:
+            if (key not in general_info or geninfo_changed()):
+                updated_geninfo = update_geninfo_all()
+                if (updated_geninfo != NO_ERROR):
+                    print_errors(updated_geninfo)
+                    return None
+            val = general_info[key]
     if (val == ''):
         return None
     return val
 
 
 
+# run a command and return what it writes to the kept stream ('stdout' or 'stderr'), printing what it
+# writes to the other stream through sys.stdout so that the check engine reports it along with the
+# check which ran it (raises CalledProcessError, with the kept output, if check and the command failed)
+def get_cmd_output(args, keep='stdout', check=True):
+    proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    (out, err) = proc.communicate()
+    if (keep == 'stdout'):
+        (kept, shown) = (out, err)
+    else:
+        (kept, shown) = (err, out)
+    if (shown != ''):
+        sys.stdout.write(shown)
+    if (check and proc.returncode != 0):
+        error = subprocess.CalledProcessError(proc.returncode, args)
+        error.output = kept
+        raise error
+    return kept
+
+
+
+# System facts, read from files where possible and cached until the file they come from changes
+
+# (path, parser) -> (mtime, facts)
+facts_cache = dict()
+facts_lock = threading.RLock()
+# mtimes of the files general_info was last updated from
+geninfo_mtimes = dict()
+
+def get_mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+def read_facts(path, parse):
+    mtime = get_mtime(path)
+    with facts_lock:
+        cached = facts_cache.get((path, parse.__name__))
+        if (cached != None and cached[0] == mtime and mtime != None):
+            return cached[1]
+        facts = parse(path)
+        facts_cache[(path, parse.__name__)] = (mtime, facts)
+        return facts
+
+def geninfo_changed():
+    for (path, mtime) in list(geninfo_mtimes.items()):
+        if (get_mtime(path) != mtime):
+            return True
+    return False
+
+def find_exec(name):
+    for dirname in os.environ.get('PATH', os.defpath).split(os.pathsep):
+        fp = os.path.join(dirname, name)
+        if (os.path.isfile(fp) and os.access(fp, os.X_OK)):
+            return fp
+    return None
+
+def parse_cpuinfo(path):
+    try:
+        with open(path, 'r') as cpuinfo_file:
+            for line in cpuinfo_file:
+                parsed_line = line.split(':')
+                if (parsed_line[0].strip() == 'flags'):
+                    # long mode
+                    if ('lm' in parsed_line[1].split()):
+                        return '64-bit'
+                    return '32-bit'
+    except IOError:
+        pass
+    return None
+
+def parse_dpkg_status(path):
+    packages = dict()
+    try:
+        with open(path, 'r') as status_file:
+            pkg = dict()
+            for line in status_file:
+                if (line.strip() == ''):
+                    if ('Package' in pkg):
+                        packages[pkg['Package']] = pkg
+                    pkg = dict()
+                elif (not line.startswith(' ')):
+                    parsed_line = line.rstrip('\n').split(': ', 1)
+                    if (parsed_line[0] in ['Package', 'Status', 'Version']):
+                        pkg[parsed_line[0]] = parsed_line[1] if (len(parsed_line) > 1) else ''
+            if ('Package' in pkg):
+                packages[pkg['Package']] = pkg
+    except IOError:
+        pass
+    return packages
+
+def get_rpmdb_mtime():
+    return max([get_mtime(path) or 0 for path in RPMDB_PATHS])
+
+# Version and Release of the rpm packages asked for and the agent packages, with one rpm call
+def query_rpm_packages(pkgs):
+    mtime = get_rpmdb_mtime()
+    with facts_lock:
+        (cached_mtime, packages) = facts_cache.get(('rpm', 'query_rpm_packages'), (None, dict()))
+        if (cached_mtime != mtime):
+            packages = dict()
+        missing = []
+        for pkg in AGENT_PKGS + list(pkgs):
+            if (pkg not in packages and pkg not in missing):
+                missing.append(pkg)
+        if (missing != []):
+            try:
+                rpm_info = subprocess.check_output(['rpm', '-q', '--qf', '%{NAME} %{VERSION} %{RELEASE}\n'] \
+                                                   + missing, universal_newlines=True, stderr=subprocess.STDOUT)
+            except subprocess.CalledProcessError as e:
+                # some packages aren't installed, the others are still listed
+                rpm_info = e.output
+            for pkg in missing:
+                packages[pkg] = None
+            for line in rpm_info.split('\n'):
+                parsed_line = line.split()
+                if (len(parsed_line) == 3 and parsed_line[0] in packages):
+                    packages[parsed_line[0]] = {'Version' : parsed_line[1], 'Release' : parsed_line[2]}
+            facts_cache[('rpm', 'query_rpm_packages')] = (mtime, packages)
+        return packages
+
+
+
 # All functions that update general_info
 
 # CPU Bits
 def get_os_bits():
-    cpu_info = subprocess.check_output(['lscpu'], universal_newlines=True)
-    cpu_opmodes = (cpu_info.split('\n'))[1]
-    cpu_bits = cpu_opmodes[-6:]
+    cpu_bits = read_facts(CPUINFO_PATH, parse_cpuinfo)
+    if (cpu_bits == None):
+        cpu_info = get_cmd_output(['lscpu'])
+        cpu_opmodes = (cpu_info.split('\n'))[1]
+        cpu_bits = cpu_opmodes[-6:]
     general_info['CPU_BITS'] = cpu_bits
     return cpu_bits
 
@@ -68,7 +207,8 @@ dist_to_id = {'redhat' : 'rhel',
 
 
 # OS Info
-def get_os_version():
+def read_os_version(os_release_path):
+    (vm_dist, vm_ver) = ('', '')
     # get vm info
     try:
         (vm_dist, vm_ver, vm_id) = linux_distribution()
@@ -81,7 +221,7 @@ def get_os_version():
     # if above didn't work, get vm info through os_release
     if (not vm_dist and not vm_ver):
         try:
-            with open('/etc/os-release', 'r') as os_file:
+            with open(os_release_path, 'r') as os_file:
                 for line in os_file:
                     parsed_line = line.split('=')
                     if (parsed_line[0] == 'ID'):
@@ -92,6 +232,13 @@ def get_os_version():
                         vm_ver = (vm_ver.replace('\"','')).replace('\n','')
         except:
             return None
+    return (vm_dist, vm_ver)
+
+def get_os_version():
+    vm_info = read_facts(OS_RELEASE_PATH, read_os_version)
+    if (vm_info == None):
+        return None
+    (vm_dist, vm_ver) = vm_info
 
     # update general_info
     general_info['OS_ID'] = vm_dist
@@ -106,23 +253,13 @@ def get_os_version():
 # Package Manager
 def update_pkg_manager():
     # try dpkg
-    try:
-        is_dpkg = subprocess.check_output(['which', 'dpkg'], \
-                    universal_newlines=True, stderr=subprocess.STDOUT)
-        if (is_dpkg != ''):
-            general_info['PKG_MANAGER'] = 'dpkg'
-            return NO_ERROR
-    except subprocess.CalledProcessError:
-        pass
+    if (find_exec('dpkg') != None):
+        general_info['PKG_MANAGER'] = 'dpkg'
+        return NO_ERROR
     # try rpm
-    try:
-        is_rpm = subprocess.check_output(['which', 'rpm'], \
-                    universal_newlines=True, stderr=subprocess.STDOUT)
-        if (is_rpm != ''):
-            general_info['PKG_MANAGER'] = 'rpm'
-            return NO_ERROR
-    except subprocess.CalledProcessError:
-        pass
+    if (find_exec('rpm') != None):
+        general_info['PKG_MANAGER'] = 'rpm'
+        return NO_ERROR
     # neither
     return ERR_PKG_MANAGER
 
@@ -130,51 +267,37 @@ def update_pkg_manager():
 
 # Package Info
 def get_dpkg_pkg_version(pkg):
-    try:
-        dpkg_info = subprocess.check_output(['dpkg', '-s', pkg], universal_newlines=True,\
-                                            stderr=subprocess.STDOUT)
-        dpkg_lines = dpkg_info.split('\n')
-        for line in dpkg_lines:
-            if (line.startswith('Package: ') and not line.endswith(pkg)):
-                # wrong package
-                return None
-            if (line.startswith('Status: ') and not line.endswith('installed')):
-                # not properly installed
-                return None
-            if (line.startswith('Version: ')):
-                version = (line.split())[-1]
-                general_info['{0}_VERSION'.format(pkg.upper())] = version
-                return version
-        return None
-    except subprocess.CalledProcessError:
+    pkg_info = read_facts(DPKG_STATUS_PATH, parse_dpkg_status).get(pkg)
+    if (pkg_info == None or not pkg_info.get('Status', '').endswith('installed')):
+        # not (properly) installed
         return None
+    version = pkg_info.get('Version')
+    if (version != None):
+        general_info['{0}_VERSION'.format(pkg.upper())] = version
+    return version
 
-def get_rpm_pkg_version(pkg):
+def get_rpm_pkg_version(pkg, release=False):
     try:
-        rpm_info = subprocess.check_output(['rpm', '-qi', pkg], universal_newlines=True,\
-                                            stderr=subprocess.STDOUT)
-        if ("package {0} is not installed".format(pkg) in rpm_info):
-            # didn't find package
-            return None
-        rpm_lines = rpm_info.split('\n')
-        for line in rpm_lines:
-            # parse line
-            # note: parsing is weird bc rpm puts various information into two columns
-            parsed_line = line.split()
-            if (parsed_line[0] == 'Name'):
-                # ['Name', ':', name, 'Relocations', ':', relocations]
-                name = parsed_line[2]
-                if (name != pkg):
-                    # wrong package
-                    return None
-            if (parsed_line[0] == 'Version'):
-                # ['Version', ':', version, 'Vendor', ':', 'MSFT']
-                version = parsed_line[2]
-                general_info['{0}_VERSION'.format(pkg.upper())] = version
-                return version
+        pkg_info = query_rpm_packages([pkg]).get(pkg)
+    except OSError:
         return None
-    except subprocess.CalledProcessError:
+    if (pkg_info == None):
+        # didn't find package
         return None
+    version = pkg_info['Version']
+    general_info['{0}_VERSION'.format(pkg.upper())] = version
+    if (release):
+        return '{0}-{1}'.format(version, pkg_info['Release'])
+    return version
+
+# version of a package with the machine's package manager (with the release for rpm if asked)
+def get_pkg_version(pkg, release=False):
+    pkg_manager = geninfo_lookup('PKG_MANAGER')
+    if (pkg_manager == 'dpkg'):
+        return get_dpkg_pkg_version(pkg)
+    elif (pkg_manager == 'rpm'):
+        return get_rpm_pkg_version(pkg, release)
+    return None
 
 
 # Recent OMS Version
@@ -217,12 +340,10 @@ def update_omsadmin():
 # service controller
 def check_service_controller():
     # check systemd
-    try:
-        is_systemctl = subprocess.check_output(['which', 'systemctl'], \
-                        universal_newlines=True, stderr=subprocess.STDOUT)
+    if (find_exec('systemctl') != None):
         general_info['SERVICE_CONTROLLER'] = 'systemctl'
         return NO_ERROR
-    except subprocess.CalledProcessError:
+    else:
         # systemd not on VM, try other service controllers
         INVOKE_RC_PATH = "/usr/sbin/invoke-rc.d"
         SERVICE_PATH = "/sbin/service"
@@ -249,6 +370,8 @@ def check_service_controller():
 
 # update all
 def update_geninfo_all():
+    for path in [OS_RELEASE_PATH, DPKG_STATUS_PATH, CONF_PATH] + RPMDB_PATHS:
+        geninfo_mtimes[path] = get_mtime(path)
     # cpu_bits
     bits = get_os_bits()
     if (bits not in ['32-bit', '64-bit']):
@@ -3,7 +3,7 @@ import subprocess
 
 from error_codes import *
 from errors      import error_info
-from helpers     import geninfo_lookup
+from helpers     import get_pkg_version
 
 SCRIPT_DIR = "/opt/microsoft/omsagent/tst/modules/high_cpu_mem"
 SCRIPT_FILE = os.path.join(SCRIPT_DIR, 'omiHighCPUDiagnosticsTST.sh')
@@ -12,56 +12,9 @@ OUTPUT_FILE = os.path.join(SCRIPT_DIR, 'omiagent_trace')
 
 
 
+# version of a package, with its release for rpm
 def get_pkg_ver(pkg):
-    version = None
-    try:
-        pkg_manager = geninfo_lookup('PKG_MANAGER')
-
-        # check using rpm
-        if (pkg_manager == 'rpm'):
-            pkg_info = subprocess.check_output(['rpm', '-qi', pkg], universal_newlines=True,\
-                            stderr=subprocess.STDOUT)
-            for line in pkg_info.split('\n'):
-                # parse line
-                parsed_line = line.split(': ')
-                if (len(parsed_line > 2)):
-                    parsed_line = [parsed_line[0]] + [parsed_line[1:].join(': ')]
-                # check info
-                if (parsed_line[0].startswith('Name') and parsed_line[1] != pkg):
-                    # wrong package
-                    return None
-                if (parsed_line[0].startswith('Version')):
-                    version = parsed_line[1]
-                    continue
-                if (parsed_line[0].startswith('Release')):
-                    version = version + '-' + parsed_line[1]
-                    break
-        
-        # check using dpkg
-        elif (pkg_manager == 'dpkg'):
-            pkg_info = subprocess.check_output(['dpkg', '-s', pkg], universal_newlines=True,\
-                            stderr=subprocess.STDOUT)
-            for line in pkg_info.split('\n'):
-                # parse line
-                parsed_line = line.split(': ')
-                if (len(parsed_line > 2)):
-                    parsed_line = [parsed_line[0]] + [parsed_line[1:].join(': ')]
-                # check info
-                if (parsed_line[0] == 'Package' and parsed_line[1] != pkg):
-                    # wrong package
-                    return None
-                if (parsed_line[0] == 'Version'):
-                    version = parsed_line[1]
-                    break
-
-        return version
-    
-    # no pkg
-    except subprocess.CalledProcessError:
-        return None
-    
-
-
+    return get_pkg_version(pkg, release=True)
 
 
 
@@ -3,15 +3,16 @@ import subprocess
 
 from error_codes       import *
 from errors            import error_info
+from helpers           import get_cmd_output
 from .check_cpu        import get_pkg_ver
 from install.check_oms import comp_versions_ge
 
 def check_strace():
     dne_errs = 0
-    strace_errors = subprocess.Popen(['strace','-f','-e','trace=access','curl',"'https://www.google.com'"],\
-                        stderr=subprocess.PIPE).communicate()[1]
+    strace_errors = get_cmd_output(['strace','-f','-e','trace=access','curl',"'https://www.google.com'"],\
+                        keep='stderr', check=False)
     # count of doesnotexist errors
-    for line in (strace_errors.decode('utf8').split('\n')):
+    for line in (strace_errors.split('\n')):
         if (line.endswith('= -1 ENOENT (No such file or directory)')):
             dne_errs += 1
     return (dne_errs <= 300)
@@ -19,7 +20,7 @@ def check_strace():
 
 def check_nss_var(slabtop_10_pretty):
     try:
-        nss_var = subprocess.check_output(['printenv','NSS_SDB_USE_CACHE'], universal_newlines=True)
+        nss_var = get_cmd_output(['printenv','NSS_SDB_USE_CACHE'])
         if (nss_var == 'yes\n'):
             error_info.append((slabtop_10_pretty,))
             return ERR_SLAB_BLOATED
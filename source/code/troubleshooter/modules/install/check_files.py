@@ -1,16 +1,57 @@
+import grp
+import json
 import os
+import pwd
 import re
-import subprocess
+import stat
+import threading
 
 from error_codes import *
-from errors      import error_info
+from errors      import error_info, get_input
 from helpers     import geninfo_lookup
 from .check_oms  import comp_versions_ge
 
+VAR_REGEX = re.compile(r'\$\{\{(\w+)\}\}')
+# diff_path printing the differences found instead of writing them to a file
+PRINT_FS_DIFF = '-'
+
+
+
+# Path trie: nested dicts keyed by path component, holding the [perms, ...] info of each path under ''
+
+def trie_add(trie, path, info):
+    node = trie
+    for part in path.split('/'):
+        if (part != ''):
+            node = node.setdefault(part, dict())
+    node.setdefault('', []).append(info)
+
+# info of all paths at or under path
+def trie_subtree(trie, path):
+    node = trie
+    for part in path.split('/'):
+        if (part != ''):
+            node = node.get(part)
+            if (node == None):
+                return
+    nodes = [node]
+    while (len(nodes) > 0):
+        node = nodes.pop()
+        for (part, child) in node.items():
+            if (part == ''):
+                for info in child:
+                    yield info
+            else:
+                nodes.append(child)
+
+
+
 # get files/directories/links from data files
 
 def get_data(f, variables, files, links, dirs):
     curr_section = None
+    # every path of files, links and dirs, for recursive chmod
+    trie = dict()
     with open(f, 'r') as data_file:
         for line in data_file:
             line = line.rstrip('\n')
@@ -29,15 +70,8 @@ def get_data(f, variables, files, links, dirs):
                 continue
 
             # line contains variable, needs to be replaced with content
-            while ('${{' in line):
-                vstart = line.index('${{')
-                vend = line.index('}}') + 2
-                l = line[vstart:vend]
-                v = line[vstart+3:vend-2]
-                if (v in list(variables.keys())):
-                    line = line.replace(l, variables[v])
-                else:
-                    break
+            if ('${{' in line):
+                line = VAR_REGEX.sub(lambda m : variables.get(m.group(1), m.group(0)), line)
 
             # variable line
             if (curr_section == "Variables"):
@@ -51,6 +85,7 @@ def get_data(f, variables, files, links, dirs):
                 # parsed_line: [filepath, install filepath, permissions, user, group]
                 parsed_line = (line.replace(' ','')).split(';')
                 files[parsed_line[0]] = parsed_line[2:5]
+                trie_add(trie, parsed_line[0], files[parsed_line[0]])
                 continue
 
             # link line
@@ -58,6 +93,7 @@ def get_data(f, variables, files, links, dirs):
                 # parsed_line: [filepath, install filepath, permissions, user, group]
                 parsed_line = (line.replace(' ','')).split(';')
                 links[parsed_line[0]] = parsed_line[2:5] + [parsed_line[1]]
+                trie_add(trie, parsed_line[0], links[parsed_line[0]])
                 continue
 
             # directory line
@@ -65,6 +101,7 @@ def get_data(f, variables, files, links, dirs):
                 # parsed_line: [filepath, permissions, user, group]
                 parsed_line = (line.replace(' ','')).split(';')
                 dirs[parsed_line[0]] = parsed_line[1:4]
+                trie_add(trie, parsed_line[0], dirs[parsed_line[0]])
                 continue
 
             # installation code
@@ -80,15 +117,8 @@ def get_data(f, variables, files, links, dirs):
                     new_perms = parsed_line[-2]
                     if (parsed_line[1] == '-R'):
                         # recursively apply new perms
-                        for f in (files.keys()):
-                            if (f.startswith(path)):
-                                files[f][0] = new_perms
-                        for l in (links.keys()):
-                            if (l.startswith(path)):
-                                links[l][0] = new_perms
-                        for d in (dirs.keys()):
-                            if (d.startswith(path)):
-                                dirs[d][0]  = new_perms
+                        for info in trie_subtree(trie, path):
+                            info[0] = new_perms
                     else: # not recursive
                         if path in files:
                             files[path][0] = new_perms
@@ -100,6 +130,15 @@ def get_data(f, variables, files, links, dirs):
 
 
 
+# compile a data file into its manifest of files/directories/links
+
+def compile_manifest(f, variables):
+    manifest = {'files' : dict(), 'links' : dict(), 'dirs' : dict()}
+    get_data(f, variables, manifest['files'], manifest['links'], manifest['dirs'])
+    return manifest
+
+
+
 # Convert between octal permission and symbolic permission
 def perm_oct_to_symb(p):
     binstr = ''
@@ -128,152 +167,229 @@ def perm_symb_to_oct(p):
 
 
 
+# Owner names, resolved once per uid / gid
+
+user_names = dict()
+group_names = dict()
+
+def get_user_name(uid):
+    if (uid not in user_names):
+        try:
+            user_names[uid] = pwd.getpwuid(uid).pw_name
+        except KeyError:
+            user_names[uid] = str(uid)
+    return user_names[uid]
+
+def get_group_name(gid):
+    if (gid not in group_names):
+        try:
+            group_names[gid] = grp.getgrgid(gid).gr_name
+        except KeyError:
+            group_names[gid] = str(gid)
+    return group_names[gid]
+
+
+
+# lstat all paths in one pass, split over threads if workers > 1 (path -> stat result, or None if missing)
+def lstat_paths(paths, workers=1):
+    stats = dict()
+    def lstat_all(some_paths):
+        for path in some_paths:
+            try:
+                stats[path] = os.lstat(path)
+            except OSError:
+                stats[path] = None
+    if (workers <= 1 or len(paths) < 2 * workers):
+        lstat_all(paths)
+        return stats
+    threads = []
+    for i in range(workers):
+        thread = threading.Thread(target=lstat_all, args=(paths[i::workers],))
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    return stats
+
+
+
 # Check permissions are correct for each file
-# info: [permissions, user, group]
-def check_permissions(f, perm_info, corr_info, typ, perms_err):
+# corr_info: [permissions, user, group]
+def check_permissions(f, st, corr_info, typ, perms_err, fs_diff):
     success = NO_ERROR
     # check user
-    perm_user = perm_info[1]
+    perm_user = get_user_name(st.st_uid)
     corr_user = corr_info[1]
     if ((perm_user != corr_user) and (perm_user != 'omsagent')):
         perms_err.append((typ, f, 'user', perm_user, corr_user))
+        fs_diff.append({'type' : typ, 'path' : f, 'field' : 'user', 'actual' : perm_user, 'expected' : corr_user})
         success = WARN_FILE_PERMS
     
     # check group
-    perm_group = perm_info[2]
+    perm_group = get_group_name(st.st_gid)
     corr_group = corr_info[2]
     if ((perm_group != corr_group) and (perm_group != 'omiusers')):
         perms_err.append((typ, f, 'group', perm_group, corr_group))
+        fs_diff.append({'type' : typ, 'path' : f, 'field' : 'group', 'actual' : perm_group, 'expected' : corr_group})
         success = WARN_FILE_PERMS
     
     # check permissions
-    perms = (perm_info[0])[1:].rstrip('.')
-    corr_perms = perm_oct_to_symb(corr_info[0])
+    perms = '{0:03o}'.format(stat.S_IMODE(st.st_mode))
+    try:
+        corr_perms = '{0:03o}'.format(int(corr_info[0], 8))
+    except ValueError:
+        # no permissions given in the data file
+        return success
     if (perms != corr_perms):
         perms_err.append((typ, f, 'permissions', perms, corr_perms))
+        fs_diff.append({'type' : typ, 'path' : f, 'field' : 'permissions', 'actual' : perms, \
+                        'expected' : corr_perms})
         success = WARN_FILE_PERMS
     return success
-    
+
+def add_missing(typ, f, exist_err, fs_diff):
+    exist_err.append((typ, f))
+    fs_diff.append({'type' : typ, 'path' : f, 'field' : 'missing'})
 
 
-# Check directories exist
 
-def get_ll_dir(ll_output, d):
-    ll_lines = ll_output.split('\n')
-    d_end = os.path.basename(d)
-    ll_line = list(filter(lambda x : x.endswith(' ' + d_end), ll_lines))[0]
-    return ll_line.split()
+# Check directories exist
 
-def check_dirs(dirs, exist_err, perms_err):
+def check_dirs(dirs, stats, exist_err, perms_err, fs_diff):
     success = NO_ERROR
     missing_dirs = []
-    for d in (dirs.keys()):
-        if (any(d.startswith(md) for md in missing_dirs)):
+    for d in sorted(dirs.keys()):
+        if (any(d.startswith(md + '/') for md in missing_dirs)):
             # parent folder doesn't exist, skip checking child folder
             continue
         # check if folder exists
-        elif (not os.path.isdir(d)):
-            missing_dirs += d
-            exist_err.append(('directory', d))
+        st = stats[d]
+        if (st == None or not stat.S_ISDIR(st.st_mode)):
+            missing_dirs.append(d)
+            add_missing('directory', d, exist_err, fs_diff)
             success = ERR_FILE_MISSING
             continue
         # check if permissions are correct
-        if (success != ERR_FILE_MISSING):
-            # get permissions
-            ll_output = subprocess.check_output(['ls', '-l', os.path.join(d, '..')],\
-                            universal_newlines=True)
-            # ll_info: [perms, items, user, group, size, month mod, day mod, time mod, name]
-            ll_info = get_ll_dir(ll_output, d)
-            perm_info = [ll_info[0]] + ll_info[2:4]
-            corr_info = dirs[d]
-            if (check_permissions(d, perm_info, corr_info, "directory", perms_err) != NO_ERROR):
-                success = WARN_FILE_PERMS
+        if (check_permissions(d, st, dirs[d], "directory", perms_err, fs_diff) != NO_ERROR \
+                and success != ERR_FILE_MISSING):
+            success = WARN_FILE_PERMS
     return success
 
 
 
 # Check files exist
 
-def check_files(files, exist_err, perms_err):
+def check_files(files, stats, exist_err, perms_err, fs_diff):
     success = NO_ERROR
-    for f in (files.keys()):
+    for f in sorted(files.keys()):
+        st = stats[f]
         # skip over omsadmin.conf, as it's created in onboarding
         if (f.endswith("omsadmin.conf")):
-            print("WARNING: omsadmin.conf file doesn't exist. File should exist after "\
-                    "onboarding successfully (ignore if not installed/onboarded yet).")
+            if (st == None):
+                print("WARNING: omsadmin.conf file doesn't exist. File should exist after "\
+                        "onboarding successfully (ignore if not installed/onboarded yet).")
             continue
         # check if file exists
-        if (not os.path.isfile(f)):
-            exist_err.append(('file', f))
+        if (st == None or not stat.S_ISREG(st.st_mode)):
+            add_missing('file', f, exist_err, fs_diff)
             success = ERR_FILE_MISSING
             continue
         # check if permissions are correct
-        if (success != ERR_FILE_MISSING):
-            # get permissions
-            ll_output = subprocess.check_output(['ls', '-l', f], universal_newlines=True)
-            # ll_info: [perms, items, user, group, size, month mod, day mod, time mod, name]
-            ll_info = ll_output.split()
-            perm_info = [ll_info[0]] + ll_info[2:4]
-            corr_info = files[f]
-            if (check_permissions(f, perm_info, corr_info, "file", perms_err) != NO_ERROR):
-                success = WARN_FILE_PERMS
+        if (check_permissions(f, st, files[f], "file", perms_err, fs_diff) != NO_ERROR \
+                and success != ERR_FILE_MISSING):
+            success = WARN_FILE_PERMS
     return success
 
-            
-
 
 
 # Check links exist
 
-def check_links(links, exist_err, perms_err):
-    success = True
-    for l in (links.keys()):
+def check_links(links, stats, exist_err, perms_err, fs_diff):
+    success = NO_ERROR
+    for l in sorted(links.keys()):
         # check if link exists
-        if (not os.path.islink(l)):
-            exist_err.append(('link', l))
+        st = stats[l]
+        if (st == None or not stat.S_ISLNK(st.st_mode)):
+            add_missing('link', l, exist_err, fs_diff)
             success = ERR_FILE_MISSING
             continue
-        # check if permissions are correct
-        if (success != ERR_FILE_MISSING):
-            linked_file = links[l][-1]
-            # in case a link points to a link
-            while (os.path.islink(linked_file)):
-                linked_file = links[linked_file][-1]
-            # get permissions
-            if (os.path.isdir(linked_file)):
-                ll_output = subprocess.check_output(['ls', '-l', os.path.join(linked_file, '..')],\
-                                universal_newlines=True)
-                ll_info = get_ll_dir(ll_output, linked_file)
-            elif (os.path.isfile(linked_file)):
-                ll_output = subprocess.check_output(['ls', '-l', linked_file],\
-                                universal_newlines=True)
-                ll_info = ll_output.split()
-            # ll_info: [perms, items, user, group, size, month mod, day mod, time mod, name]
-            perm_info = [ll_info[0]] + ll_info[2:4]
-            corr_info = links[l][:-1]
-            if (check_permissions(l, perm_info, corr_info, "link", perms_err) != NO_ERROR):
-                success = WARN_FILE_PERMS
+        # check the permissions of the file / directory linked to (following links to links)
+        try:
+            linked_st = os.stat(l)
+        except OSError:
+            add_missing('file', links[l][-1], exist_err, fs_diff)
+            success = ERR_FILE_MISSING
+            continue
+        if (check_permissions(l, linked_st, links[l][:-1], "link", perms_err, fs_diff) != NO_ERROR \
+                and success != ERR_FILE_MISSING):
+            success = WARN_FILE_PERMS
     return success
 
 
 
+# machine-readable list of the differences found, as dicts of type, path, field (missing, user,
+# group or permissions), and actual / expected values
+def write_fs_diff(fs_diff, diff_path):
+    fs_diff_json = json.dumps(fs_diff, indent=2, sort_keys=True)
+    if (diff_path == PRINT_FS_DIFF):
+        print("Differences in the installed files:")
+        print(fs_diff_json)
+        return
+    try:
+        with open(diff_path, 'w') as diff_file:
+            diff_file.write(fs_diff_json)
+        print("Differences in the installed files written to {0}".format(diff_path))
+    except IOError as e:
+        print("WARNING: couldn't write the differences in the installed files to {0}: {1}".format(\
+                diff_path, e))
+
+
+
+# Ask the user how to check the files (interactive mode). The troubleshooter doesn't write any
+# files without express permission, so the differences are only written to a file given here.
+
+def ask_check_files_options():
+    print("--------------------------------------------------------------------------------")
+    print(" Please input the number of threads to check the files with, and where to put\n"\
+          " the list of differences found (as JSON).")
+
+    def check_int(i):
+        try:
+            return (int(i) > 0)
+        except ValueError:
+            return (i == '')
+
+    workers_in = get_input("How many threads do you want to use? (Default is 1)",\
+                           check_int,\
+                           "Please either type a positive integer, or just hit enter to go\n"\
+                               "with the default value.")
+    workers = 1 if (workers_in == '') else int(workers_in)
+    diff_path = get_input("Where do you want the differences written? (Type an absolute filepath, 'p'\n"\
+                          " to print them, or just hit enter to skip)",\
+                          (lambda x : x in ['', 'p'] or x.startswith('/')),\
+                          "Please either type an absolute filepath for the JSON file, 'p' to\n"\
+                              "print the differences, or just hit enter to skip.")
+    if (diff_path == ''):
+        diff_path = None
+    elif (diff_path.lower() == 'p'):
+        diff_path = PRINT_FS_DIFF
+    return (workers, diff_path)
+
 
 
 # Check everything
 
-def check_filesystem(DFS_PATH):
+def check_filesystem(DFS_PATH, workers=1, diff_path=None):
     success = NO_ERROR
 
     # create lists to track errors
     exist_err = []
     perms_err = []
+    fs_diff = []
 
     datafiles = os.listdir(DFS_PATH)
     for df in datafiles:        
         variables = dict()  # {var name : content}
-        files = dict()      # {path : [perms, user, group]}
-        links = dict()      # {path : [perms, user, group, linked path]}
-        dirs = dict()       # {path : [perms, user, group]}
 
         # TEMP FIX: add in variables for RUBY_ARCH and RUBY_ARCM
         if (df.endswith("ruby.data")):
@@ -284,13 +400,17 @@ def check_filesystem(DFS_PATH):
         if ((df == "linux_rpm.data") and (not os.path.exists('/usr/sbin/semodule'))):
             continue
 
-        # populate dictionaries with info from data files
-        get_data((os.path.join(DFS_PATH, df)), variables, files, links, dirs)
+        # get info from data files
+        manifest = compile_manifest(os.path.join(DFS_PATH, df), variables)
+        files = manifest['files']   # {path : [perms, user, group]}
+        links = manifest['links']   # {path : [perms, user, group, linked path]}
+        dirs = manifest['dirs']     # {path : [perms, user, group]}
 
         # check everything
-        checked_dirs = check_dirs(dirs, exist_err, perms_err)
-        checked_files = check_files(files, exist_err, perms_err)
-        checked_links = check_links(links, exist_err, perms_err)
+        stats = lstat_paths(list(dirs.keys()) + list(files.keys()) + list(links.keys()), workers)
+        checked_dirs = check_dirs(dirs, stats, exist_err, perms_err, fs_diff)
+        checked_files = check_files(files, stats, exist_err, perms_err, fs_diff)
+        checked_links = check_links(links, stats, exist_err, perms_err, fs_diff)
 
         # some paths are missing
         if (ERR_FILE_MISSING in [checked_dirs, checked_files, checked_links]):
@@ -300,6 +420,9 @@ def check_filesystem(DFS_PATH):
         elif ((WARN_FILE_PERMS in [checked_dirs, checked_files, checked_links]) and (success != ERR_FILE_MISSING)):
             success = WARN_FILE_PERMS
 
+    if (diff_path != None):
+        write_fs_diff(fs_diff, diff_path)
+
     # update errors
     if (success == ERR_FILE_MISSING):
         error_info.extend(exist_err)
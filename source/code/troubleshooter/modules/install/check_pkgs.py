@@ -1,19 +1,8 @@
-import subprocess
-
 from error_codes import *
-from helpers     import geninfo_lookup, get_dpkg_pkg_version, get_rpm_pkg_version
+from helpers     import get_pkg_version
 
 def get_package_version(pkg):
-    pkg_mngr = geninfo_lookup('PKG_MANAGER')
-
-    # dpkg
-    if (pkg_mngr == 'dpkg'):
-        return get_dpkg_pkg_version(pkg)
-    # rpm
-    elif (pkg_mngr == 'rpm'):
-        return get_rpm_pkg_version(pkg)
-    else:
-        return None
+    return get_pkg_version(pkg)
 
 
 
@@ -7,7 +7,7 @@ from errors_tsg   import ask_install_error_codes
 from helpers      import update_pkg_manager
 from .check_os    import check_os
 from .check_oms   import check_oms
-from .check_files import check_filesystem
+from .check_files import check_filesystem, ask_check_files_options
 from .check_pkgs  import check_packages
 
 DFS_PATH = "/opt/microsoft/omsagent/tst/files/datafiles/"
@@ -148,8 +148,12 @@ def check_installation(interactive, err_codes=True, prev_success=NO_ERROR):
 
     # check all files
     if (os.path.isdir(DFS_PATH)):
+        if (interactive):
+            (workers, diff_path) = ask_check_files_options()
+        else:
+            (workers, diff_path) = (1, None)
         print("Checking if all files installed correctly (may take some time)...")
-        checked_files = check_filesystem(DFS_PATH)
+        checked_files = check_filesystem(DFS_PATH, workers, diff_path)
         if (is_error(checked_files)):
             return print_errors(checked_files)
         else:
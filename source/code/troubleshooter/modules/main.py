@@ -1,14 +1,31 @@
 import os
 import subprocess
 
-from error_codes               import *
-from errors                    import is_error, get_input, print_errors, err_summary
-from install.install           import check_installation
-from connect.connect           import check_connection
-from heartbeat.heartbeat       import check_heartbeat
-from high_cpu_mem.high_cpu_mem import check_high_cpu_memory
-from syslog_tst.syslog         import check_syslog
-from custom_logs.custom_logs   import check_custom_logs
+from error_codes                import *
+from errors                     import error_info, is_error, get_input, print_errors, err_summary
+from helpers                    import geninfo_lookup, update_pkg_manager, check_service_controller
+from check_engine               import Check, run_checks
+from install.install            import check_installation, check_space, check_cert, check_key, DFS_PATH
+from install.check_os           import check_os
+from install.check_oms          import check_oms
+from install.check_files        import check_filesystem
+from install.check_pkgs         import check_packages
+from connect.connect            import check_connection
+from connect.check_endpts       import check_internet_connect, check_agent_service_endpt, \
+                                       check_log_analytics_endpts
+from heartbeat.heartbeat        import check_heartbeat, check_omsagent_running, start_omsagent, \
+                                       OMSADMIN_CONF_PATH
+from heartbeat.check_multihoming import check_multihoming
+from heartbeat.check_logs       import check_log_heartbeat
+from high_cpu_mem.high_cpu_mem  import check_high_cpu_memory
+from high_cpu_mem.check_logrot  import check_log_rotation
+from high_cpu_mem.check_cpu     import check_omi_cpu
+from high_cpu_mem.check_slabmem import check_slab_memory
+from syslog_tst.syslog          import check_syslog
+from syslog_tst.check_rsysng    import check_services
+from syslog_tst.check_conf      import check_conf_files
+from custom_logs.custom_logs    import check_custom_logs
+from custom_logs.check_clconf   import check_customlog_conf
 
 LOGCOLLECT_PATH = "/opt/microsoft/omsagent/tst/modules/log_collector/"
 
@@ -51,8 +68,92 @@ def check_sudo():
 
 
 
+# checks run by silent mode's check_all() which need a bit more than calling the check
+def check_filesystem_copied():
+    if (not os.path.isdir(DFS_PATH)):
+        print("WARNING (INTERNAL): Datafiles have not been successfully copied over.")
+        print("Skipping all files installed correctly check...")
+        return NO_ERROR
+    return check_filesystem(DFS_PATH)
+
+def check_workspace_id():
+    if (geninfo_lookup('WORKSPACE_ID') == None):
+        error_info.append(('Workspace ID', OMSADMIN_CONF_PATH))
+        return ERR_INFO_MISSING
+    return NO_ERROR
+
+def check_omsagent_started():
+    workspace_id = geninfo_lookup('WORKSPACE_ID')
+    checked_omsagent_running = check_omsagent_running(workspace_id)
+    if (checked_omsagent_running == ERR_OMS_WONT_RUN):
+        checked_omsagent_running = start_omsagent(workspace_id)
+    return checked_omsagent_running
+
+
+
+# all checks of the troubleshooter, each after the checks it requires
+def get_all_checks():
+    install = "CHECKING INSTALLATION..."
+    connection = "CHECKING CONNECTION..."
+    heartbeat = "CHECKING HEARTBEAT / HEALTH..."
+    highcpumem = "CHECKING FOR HIGH CPU / MEMORY USAGE..."
+    syslog = "CHECKING FOR SYSLOG ISSUES..."
+    custom_logs = "CHECKING FOR CUSTOM LOG ISSUES..."
+    return [
+        Check('os', install, "Checking if running a supported OS version...", check_os),
+        Check('space', install, "Checking if enough disk space is available...", check_space),
+        Check('pkg_manager', install, "Checking if machine has a supported package manager...",
+              update_pkg_manager),
+        Check('packages', install, "Checking if packages installed correctly...", check_packages,
+              ['os', 'space', 'pkg_manager']),
+        Check('oms', install, "Checking if running a supported version of OMS...",
+              lambda: check_oms(False), ['packages']),
+        Check('files', install, "Checking if all files installed correctly...", check_filesystem_copied,
+              ['packages']),
+        Check('cert', install, "Checking certificate is correct...", check_cert, ['packages']),
+        Check('key', install, "Checking RSA key is correct...", check_key, ['packages']),
+        Check('internet', connection, "Checking if machine is connected to the internet...",
+              check_internet_connect, ['packages']),
+        Check('agent_service_endpt', connection, "Checking if agent service endpoint is connected...",
+              check_agent_service_endpt, ['internet']),
+        Check('log_analytics_endpts', connection, "Checking if log analytics endpoints are connected...",
+              check_log_analytics_endpts, ['internet']),
+        Check('workspace', heartbeat, "Checking if the agent is onboarded to a workspace...",
+              check_workspace_id, ['packages']),
+        Check('multihoming', heartbeat, "Checking if omsagent is trying to run multihoming...",
+              lambda: check_multihoming(geninfo_lookup('WORKSPACE_ID')), ['workspace']),
+        Check('omsagent_running', heartbeat, "Checking if omsagent is running...", check_omsagent_started,
+              ['multihoming', 'log_analytics_endpts']),
+        Check('log_heartbeat', heartbeat, "Checking for errors in omsagent.log...",
+              lambda: check_log_heartbeat(geninfo_lookup('WORKSPACE_ID')), ['omsagent_running']),
+        Check('log_rotation', highcpumem, "Checking if log rotation is working correctly...",
+              check_log_rotation, ['omsagent_running']),
+        Check('omi_cpu', highcpumem, "Checking if OMI is at 100% CPU...", check_omi_cpu,
+              ['omsagent_running']),
+        Check('slab_memory', highcpumem, "Checking slab memory / dentry cache usage...", check_slab_memory,
+              ['omsagent_running']),
+        Check('service_controller', syslog, "Checking if machine has a valid service controller...",
+              check_service_controller, ['omsagent_running']),
+        Check('services', syslog, "Checking if machine has rsyslog or syslog-ng running...",
+              check_services, ['service_controller']),
+        Check('syslog_conf', syslog, "Checking for syslog configuration files...", check_conf_files,
+              ['services']),
+        Check('customlog_conf', custom_logs, "Checking for custom log configuration files...",
+              lambda: check_customlog_conf(False), ['omsagent_running'])
+    ]
+
+
+
 # run through all troubleshooting scenarios
 def check_all(interactive):
+    """Interactive mode runs the sections in order and stops at the first section which finds
+    an error. Silent mode runs the checks of get_all_checks() concurrently, each once the checks
+    it requires passed: a failed check only skips the checks which require it, and every check
+    independent of it still runs and is reported (so a failed install check no longer hides
+    e.g. the connection checks)."""
+    if (not interactive):
+        return run_checks(get_all_checks())
+
     all_success = NO_ERROR
     # 1: Install
     checked_install = check_installation(interactive)
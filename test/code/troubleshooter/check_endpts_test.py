@@ -0,0 +1,159 @@
+# Tests the native TLS probe of connect/check_endpts.py against a local TLS stand-in server
+# using a self-signed certificate for localhost (needs the openssl command to create it).
+#
+#   python -m unittest discover -s test/code/troubleshooter -p '*_test.py'
+
+import os
+import shutil
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..',
+                                'source', 'code', 'troubleshooter', 'modules'))
+
+from connect.check_endpts import probe_endpts
+
+# accepts connections on 127.0.0.1, and does the TLS handshake unless it is told to stall
+class TLSStandin(threading.Thread):
+    def __init__(self, certfile, keyfile, handshake=True):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.handshake = handshake
+        self.context = ssl.SSLContext(getattr(ssl, 'PROTOCOL_TLS_SERVER', ssl.PROTOCOL_SSLv23))
+        self.context.load_cert_chain(certfile, keyfile)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(16)
+        self.port = self.sock.getsockname()[1]
+        # stalled connections, closed on stop
+        self.conns = []
+
+    def run(self):
+        while True:
+            try:
+                (conn, addr) = self.sock.accept()
+            except (socket.error, OSError):
+                return
+            if (not self.handshake):
+                self.conns.append(conn)
+                continue
+            try:
+                ssl_conn = self.context.wrap_socket(conn, server_side=True)
+                ssl_conn.close()
+            except (ssl.SSLError, socket.error, OSError):
+                conn.close()
+
+    def stop(self):
+        # shutdown wakes up the blocked accept(), close alone doesn't on Linux
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except (socket.error, OSError):
+            pass
+        self.sock.close()
+        for conn in self.conns:
+            conn.close()
+        self.join(5)
+
+def free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+
+class ProbeEndptsTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.mkdtemp()
+        cls.certfile = os.path.join(cls.tmp_dir, 'localhost.crt')
+        cls.keyfile = os.path.join(cls.tmp_dir, 'localhost.key')
+        devnull = open(os.devnull, 'w')
+        try:
+            subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+                                   '-subj', '/CN=localhost', '-addext', 'subjectAltName=DNS:localhost',
+                                   '-keyout', cls.keyfile, '-out', cls.certfile],
+                                  stdout=devnull, stderr=subprocess.STDOUT)
+        except (OSError, subprocess.CalledProcessError):
+            shutil.rmtree(cls.tmp_dir)
+            raise unittest.SkipTest("openssl can't create a self-signed certificate")
+        finally:
+            devnull.close()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp_dir)
+
+    def start_standin(self, handshake=True):
+        standin = TLSStandin(self.certfile, self.keyfile, handshake)
+        standin.start()
+        self.addCleanup(standin.stop)
+        return standin
+
+    def test_connected_and_verified(self):
+        standin = self.start_standin()
+        start = time.time()
+        results = probe_endpts(['localhost'] * 3, standin.port, timeout=5, cafile=self.certfile)
+        elapsed = time.time() - start
+        self.assertEqual(len(results), 3)
+        for result in results:
+            self.assertEqual(result['endpoint'], 'localhost')
+            self.assertTrue(result['connected'])
+            self.assertTrue(result['verified'])
+            self.assertEqual(result['error'], None)
+            for step in ['dns', 'connect', 'handshake']:
+                self.assertTrue(0 <= result[step] <= elapsed, step)
+        # the same host name is only resolved once
+        self.assertTrue(min(result['dns'] for result in results) < 0.01)
+
+    def test_certificate_not_trusted(self):
+        standin = self.start_standin()
+        # the system CAs don't include the self-signed certificate
+        result = probe_endpts(['localhost'], standin.port, timeout=5)[0]
+        self.assertTrue(result['connected'])
+        self.assertFalse(result['verified'])
+        self.assertTrue(result['error'].startswith("certificate verification failed"))
+        self.assertTrue(result['connect'] >= 0 and result['handshake'] >= 0)
+
+    def test_host_name_mismatch(self):
+        standin = self.start_standin()
+        # the certificate is for localhost, not for the address
+        result = probe_endpts(['127.0.0.1'], standin.port, timeout=5, cafile=self.certfile)[0]
+        self.assertTrue(result['connected'])
+        self.assertFalse(result['verified'])
+        self.assertTrue(result['error'].startswith("certificate verification failed"))
+
+    def test_connection_refused(self):
+        result = probe_endpts(['localhost'], free_port(), timeout=5, cafile=self.certfile)[0]
+        self.assertFalse(result['connected'])
+        self.assertFalse(result['verified'])
+        self.assertTrue(result['error'].startswith("couldn't connect"))
+        self.assertTrue('dns' in result)
+        self.assertFalse('connect' in result)
+
+    def test_timeout_budget_shared(self):
+        standin = self.start_standin(handshake=False)
+        start = time.time()
+        results = probe_endpts(['localhost'] * 4, standin.port, timeout=0.5, cafile=self.certfile)
+        elapsed = time.time() - start
+        # all endpoints share one budget, rather than taking 0.5s each
+        self.assertTrue(elapsed < 1.5, elapsed)
+        for result in results:
+            self.assertFalse(result['connected'])
+            self.assertFalse(result['verified'])
+            self.assertTrue(result['error'].startswith("timed out"), result['error'])
+            self.assertTrue('connect' in result)
+            self.assertFalse('handshake' in result)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
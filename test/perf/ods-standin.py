@@ -0,0 +1,274 @@
+#! /usr/bin/env python3
+"""Local stand-in for the ODS PostJsonDataItems endpoint, used to measure end-to-end latency.
+
+omsagent-loadtest.py embeds 'idx=<sequence> ts=<send time> <plugin>' in every event. This server
+accepts the requests built by OMS::Common.create_ods_request (optionally deflate compressed),
+finds those stamps in the posted DataItems and records the send -> delivery latency per plugin.
+
+To point out_oms at it:
+  - generate a certificate for the host name used in OMS_ENDPOINT and make it trusted by the agent
+    (system CA store, or SSL_CERT_FILE in the omsagent environment), out_oms verifies the peer
+  - set OMS_ENDPOINT=https://<host>:<port>/OperationInsights.svc/PostJsonDataItems in omsadmin.conf
+  - restart omsagent
+
+The sequence numbers are reconciled in a bitmap per plugin to count lost, duplicated (e.g. re-sent
+after a RetryRequestException) and reordered events.
+
+The statistics are printed on exit and served as JSON on GET /stats, which is what
+omsagent-loadtest.py --ods-standin-url reads at the end of a run. GET /stats?reset=1 clears them and
+GET /stats?sent=syslog:1000,file:1000 computes the lost events against the number of events sent
+instead of the highest sequence number received. Writers sharing a plugin (load test workers or
+hosts) interleave their sequence numbers: each of them is listed as <plugin>:<count>@<first>/<step>,
+for the sequence numbers first, first + step, ... and the lost events add up over them, e.g.
+GET /stats?sent=syslog:500@0/2,syslog:499@1/2.
+"""
+
+import sys
+import re
+import ssl
+import json
+import math
+import time
+import zlib
+import array
+import signal
+import argparse
+import threading
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+ODS_PATH = '/OperationInsights.svc/PostJsonDataItems'
+STAMP_REGEX = re.compile(br'idx=(\d+) ts=(\d+\.\d+) ([\w-]+)')
+
+
+def percentile(values, pct):
+    if len(values) == 0:
+        return 0
+    values = sorted(values)
+    rank = int(math.ceil(pct / 100.0 * len(values))) - 1
+    return values[min(max(rank, 0), len(values) - 1)]
+
+
+class SequenceBitmap:
+    """One bit per sequence number received, grown on demand."""
+    def __init__(self):
+        self.bits = bytearray()
+        self.unique = 0
+        self.duplicates = 0
+        self.reordered = 0
+        self.highest = -1
+
+    def add(self, idx):
+        byte, bit = idx >> 3, 1 << (idx & 7)
+        if byte >= len(self.bits):
+            self.bits.extend(bytearray(max(byte + 1 - len(self.bits), len(self.bits))))
+        if self.bits[byte] & bit:
+            self.duplicates += 1
+            return
+        self.bits[byte] |= bit
+        self.unique += 1
+        if idx < self.highest:
+            self.reordered += 1
+        else:
+            self.highest = idx
+
+    def count_below(self, limit):
+        full_bytes = limit >> 3
+        count = sum(bin(byte).count('1') for byte in self.bits[:full_bytes])
+        for idx in range(full_bytes << 3, min(limit, len(self.bits) << 3)):
+            if self.bits[idx >> 3] & (1 << (idx & 7)):
+                count += 1
+        return count
+
+    def count_sequence(self, first, step, count):
+        """Number of the sequence numbers first, first + step, ... (`count` of them) received."""
+        if step == 1:
+            return self.count_below(first + count) - self.count_below(first)
+        received = 0
+        for idx in range(first, min(first + count * step, len(self.bits) << 3), step):
+            if self.bits[idx >> 3] & (1 << (idx & 7)):
+                received += 1
+        return received
+
+    def lost(self, sequences=None):
+        """Events not received, below the highest sequence number or out of the (first, step, count) sent."""
+        if sequences is None:
+            return self.highest + 1 - self.unique
+        return sum(count - self.count_sequence(first, step, count) for first, step, count in sequences)
+
+
+class LatencyRecorder:
+    """Per-plugin ingest -> delivery latencies, in seconds."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.latencies = {}
+            self.sequences = {}
+            self.nb_requests = 0
+            self.nb_bytes = 0
+            self.first_delivery = None
+            self.last_delivery = None
+
+    def record(self, body, received_time):
+        stamps = STAMP_REGEX.findall(body)
+        with self.lock:
+            self.nb_requests += 1
+            self.nb_bytes += len(body)
+            if self.first_delivery is None:
+                self.first_delivery = received_time
+            self.last_delivery = received_time
+            for idx, ts, plugin in stamps:
+                plugin = plugin.decode('ASCII')
+                if plugin not in self.latencies:
+                    self.latencies[plugin] = array.array('d')
+                    self.sequences[plugin] = SequenceBitmap()
+                self.latencies[plugin].append(received_time - float(ts))
+                self.sequences[plugin].add(int(idx))
+        return len(stamps)
+
+    def stats(self, sent=None):
+        """`sent` maps plugin names to the (first, step, count) sequences the load tester sent."""
+        sent = sent or {}
+        with self.lock:
+            plugins = {}
+            for plugin in set(sent.keys()) - set(self.latencies.keys()):
+                plugins[plugin] = {'nb_events': 0, 'lost': sum(count for _, _, count in sent[plugin]),
+                                   'duplicated': 0, 'reordered': 0}
+            for plugin, latencies in self.latencies.items():
+                sequence = self.sequences[plugin]
+                plugins[plugin] = {
+                    'nb_events': len(latencies),
+                    'lost': sequence.lost(sent.get(plugin)),
+                    'duplicated': sequence.duplicates,
+                    'reordered': sequence.reordered,
+                    'min_latency': round(min(latencies), 6),
+                    'avg_latency': round(sum(latencies) / len(latencies), 6),
+                    'p50_latency': round(percentile(latencies, 50), 6),
+                    'p90_latency': round(percentile(latencies, 90), 6),
+                    'p99_latency': round(percentile(latencies, 99), 6),
+                    'max_latency': round(max(latencies), 6),
+                }
+            return {
+                'nb_requests': self.nb_requests,
+                'nb_bytes': self.nb_bytes,
+                'delivery_time': round((self.last_delivery or 0) - (self.first_delivery or 0), 3),
+                'plugins': plugins,
+            }
+
+
+class ODSRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def send_body(self, code, body, content_type='application/json'):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        received_time = time.time()
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if not self.path.startswith(self.server.ods_path):
+            self.send_body(404, b'')
+            return
+        if self.headers.get('Content-Encoding', '').lower() == 'deflate':
+            try:
+                body = zlib.decompress(body)
+            except zlib.error:
+                self.send_body(400, b'')
+                return
+        self.server.recorder.record(body, received_time)
+        self.send_body(200, b'')
+
+    def do_GET(self):
+        if self.path.startswith('/stats'):
+            sent = {}
+            match = re.search(r'sent=([\w:,@/-]+)', self.path)
+            if match:
+                for item in match.group(1).split(','):
+                    plugin, _, sequence = item.partition(':')
+                    count, _, start = sequence.partition('@')
+                    first, _, step = start.partition('/')
+                    sent.setdefault(plugin, []).append((int(first or 0), int(step or 1), int(count)))
+            stats = self.server.recorder.stats(sent)
+            if 'reset=1' in self.path:
+                self.server.recorder.reset()
+            self.send_body(200, json.dumps(stats, sort_keys=True).encode('utf-8'))
+        else:
+            self.send_body(404, b'')
+
+
+class ODSStandin(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, ods_path=ODS_PATH, cert_path=None, key_path=None, verbose=False):
+        HTTPServer.__init__(self, address, ODSRequestHandler)
+        self.ods_path = ods_path
+        self.verbose = verbose
+        self.recorder = LatencyRecorder()
+        if cert_path is not None:
+            context = ssl.SSLContext(getattr(ssl, 'PROTOCOL_TLS_SERVER', ssl.PROTOCOL_SSLv23))
+            context.load_cert_chain(cert_path, key_path)
+            self.socket = context.wrap_socket(self.socket, server_side=True)
+
+
+def print_stats(stats):
+    print('%d requests, %d bytes in %.1f s' % (stats['nb_requests'], stats['nb_bytes'], stats['delivery_time']))
+    for plugin, plugin_stats in sorted(stats['plugins'].items()):
+        print('  %s: %d events, lost=%d, duplicated=%d, reordered=%d' %
+              (plugin, plugin_stats['nb_events'], plugin_stats['lost'], plugin_stats['duplicated'],
+               plugin_stats['reordered']))
+        if plugin_stats['nb_events'] > 0:
+            print('  %s: latency avg=%.3f s, p50=%.3f s, p90=%.3f s, p99=%.3f s, max=%.3f s' %
+                  (plugin, plugin_stats['avg_latency'], plugin_stats['p50_latency'], plugin_stats['p90_latency'],
+                   plugin_stats['p99_latency'], plugin_stats['max_latency']))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Local ODS stand-in measuring omsagent end-to-end latency')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8443)
+    parser.add_argument('--path', default=ODS_PATH, help='path out_oms posts to')
+    parser.add_argument('--cert', help='server certificate (PEM)')
+    parser.add_argument('--key', help='server private key (PEM)')
+    parser.add_argument('--no-tls', action='store_true', help='serve plain HTTP, for smoke tests only')
+    parser.add_argument('--report', help='write the final statistics as JSON to this file')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    if not args.no_tls and (args.cert is None or args.key is None):
+        parser.error('--cert and --key are required unless --no-tls is set')
+
+    server = ODSStandin((args.host, args.port), args.path, None if args.no_tls else args.cert, args.key,
+                        args.verbose)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print('ODS stand-in listening on %s://%s:%d%s' % ('http' if args.no_tls else 'https', args.host, args.port,
+                                                      args.path))
+    try:
+        server.serve_forever()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        stats = server.recorder.stats()
+        print_stats(stats)
+        if args.report:
+            with open(args.report, 'w') as f:
+                json.dump(stats, f, indent=2, sort_keys=True)
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,15 +1,27 @@
-#! /usr/bin/env python
+#! /usr/bin/env python3
 
 import sys
 import os
 import re
+import glob
+import hmac
+import zlib
 import json
 import time
+import errno
 import socket
+import select
+import signal
 import logging
+import math
+import base64
+import mmap
+import array
+import shutil
 import string
 import random
 import argparse
+import threading
 import datetime
 import subprocess
 import multiprocessing
@@ -17,17 +29,26 @@ import logging.handlers
 from datetime import datetime
 from logging.handlers import SysLogHandler
 
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
 try:
     import psutil
-    import numpy as np
 except:
-    print("[optional] missing python libraries: psutil numpy [You can't use profiling without these packages]")
+    print("[optional] missing python libraries: psutil [You can't use profiling without these packages]")
 PY3 = sys.version_info[0] == 3
+monotonic = getattr(time, 'monotonic', time.time)
 
 
 def average(lst): 
     return sum(lst) / len(lst)
 
+
+
 def gethostname():
     try:
         return socket.gethostname()
@@ -35,8 +56,229 @@ def gethostname():
         return '-'
 
 
-def build_random_msg_string(size):
-    return 'msg_' + ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(size))
+class HdrHistogram:
+    """Log-linear histogram of non-negative integers, accurate to `digits` significant decimal digits.
+
+    Counts are kept in a sparse dict keyed by bucket index, so memory depends on the range of the
+    recorded values and not on their number. Histograms with the same `digits` merge by adding counts,
+    which is how results of several writer processes or hosts are combined.
+    """
+    def __init__(self, digits=3):
+        self.digits = digits
+        self.sub_bucket_bits = int(math.ceil(math.log(2 * 10 ** digits, 2)))
+        self.half_count = 1 << (self.sub_bucket_bits - 1)
+        self.counts = {}
+        self.total = 0
+
+    def index_of(self, value):
+        bucket = max(0, value.bit_length() - self.sub_bucket_bits)
+        return bucket * self.half_count + (value >> bucket)
+
+    def value_at_index(self, index):
+        """Highest value that falls in the bucket at `index`."""
+        bucket = max(0, index // self.half_count - 1)
+        return ((index - bucket * self.half_count) << bucket) + (1 << bucket) - 1
+
+    def record(self, value, count=1):
+        index = self.index_of(max(0, int(value)))
+        self.counts[index] = self.counts.get(index, 0) + count
+        self.total += count
+
+    def merge(self, other):
+        if other.digits != self.digits:
+            raise ValueError('cannot merge histograms of %d and %d significant digits' % (self.digits, other.digits))
+        for index, count in other.counts.items():
+            self.counts[index] = self.counts.get(index, 0) + count
+        self.total += other.total
+        return self
+
+    def value_at_percentile(self, pct):
+        if self.total == 0:
+            return 0
+        rank = max(1, int(math.ceil(pct / 100.0 * self.total)))
+        seen = 0
+        for index in sorted(self.counts.keys()):
+            seen += self.counts[index]
+            if seen >= rank:
+                return self.value_at_index(index)
+        return self.value_at_index(max(self.counts.keys()))
+
+    def to_dict(self):
+        return {'digits': self.digits, 'counts': dict((str(index), count) for index, count in self.counts.items())}
+
+    @classmethod
+    def from_dict(cls, data):
+        histogram = cls(data['digits'])
+        for index, count in data['counts'].items():
+            histogram.counts[int(index)] = count
+            histogram.total += count
+        return histogram
+
+
+class SampleSeries:
+    """Constant-memory replacement of a list of samples.
+
+    Keeps count, sum, min, max, first and last value exactly, and an HdrHistogram of the values multiplied by
+    `scale` (e.g. 100 for CPU percents, 10**6 for seconds measured in microseconds) for percentiles.
+    """
+    def __init__(self, scale=100, digits=3):
+        self.scale = scale
+        self.histogram = HdrHistogram(digits)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+        self.first = None
+        self.last = None
+
+    def __len__(self):
+        return self.count
+
+    def append(self, value):
+        self.histogram.record(value * self.scale)
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        self.first = value if self.first is None else self.first
+        self.last = value
+
+    def avg(self):
+        return self.sum / self.count if self.count > 0 else 0
+
+    def spread(self):
+        return self.max - self.min if self.count > 0 else 0
+
+    def percentile(self, pct):
+        if self.count == 0:
+            return 0
+        # a bucket reports its highest value, keep the result within what was actually recorded
+        return min(max(float(self.histogram.value_at_percentile(pct)) / self.scale, self.min), self.max)
+
+    def merge(self, other):
+        self.histogram.merge(other.histogram)
+        if other.count > 0:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+            self.first = other.first if self.first is None else self.first
+            self.last = other.last
+        self.count += other.count
+        self.sum += other.sum
+        return self
+
+    def to_dict(self):
+        return {'scale': self.scale, 'count': self.count, 'sum': self.sum, 'min': self.min, 'max': self.max,
+                'first': self.first, 'last': self.last, 'histogram': self.histogram.to_dict()}
+
+    @classmethod
+    def from_dict(cls, data):
+        series = cls(data['scale'], data['histogram']['digits'])
+        series.histogram = HdrHistogram.from_dict(data['histogram'])
+        for name in ['count', 'sum', 'min', 'max', 'first', 'last']:
+            setattr(series, name, data.get(name))
+        return series
+
+
+def new_process_sampling():
+    """Samples of one process, as stored by the samplers and profile()."""
+    return {'cpu': new_samples(), 'mem': new_samples(), 'minor_flt': new_samples(), 'major_flt': new_samples(),
+            'threads': {}}
+
+
+def new_samples(scale=100):
+    return SampleSeries(scale)
+
+
+def samples_to_json(obj):
+    if isinstance(obj, SampleSeries):
+        return obj.to_dict()
+    raise TypeError('%r is not JSON serializable' % obj)
+
+
+def lag_stats(lags):
+    return {
+        'avg_lag': round(lags.avg(), 6),
+        'p50_lag': round(lags.percentile(50), 6),
+        'p99_lag': round(lags.percentile(99), 6),
+        'max_lag': round(lags.max or 0, 6),
+    }
+
+
+class ResultStream:
+    """Append results as newline-delimited JSON: one record per sampling interval, one summary per run."""
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.lock = threading.Lock()
+
+    def write(self, record):
+        line = json.dumps(record, ensure_ascii=True, sort_keys=True, default=samples_to_json)
+        with self.lock:
+            if self.file is None:
+                self.file = open(self.path, 'a')
+            self.file.write(line + '\n')
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+def merge_results(paths):
+    """Merge the summary records of several result streams, e.g. from several hosts."""
+    send_lags = SampleSeries(10 ** 6)
+    processes = {}
+    hosts = set()
+    sent = {}
+    send_failed = {}
+    drops = {}
+    nb_runs, nb_events, achieved_eps = 0, 0, 0
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                record = json.loads(line)
+                if record.get('type') != 'summary':
+                    continue
+                nb_runs += 1
+                hosts.add(record['host'])
+                nb_events += record['nb_events']
+                achieved_eps += record['send_stats']['achieved_eps']
+                send_lags.merge(SampleSeries.from_dict(record['send_lags']))
+                for plugin, sequences in get_sent_sequences(record['send_stats']).items():
+                    sent.setdefault(plugin, []).extend(sequences)
+                for plugin, count in get_send_failed(record['send_stats']).items():
+                    send_failed[plugin] = send_failed.get(plugin, 0) + count
+                for drop in record.get('drops', []):
+                    protocol, _, count = drop.rpartition(':')
+                    drops[protocol] = drops.get(protocol, 0) + int(count)
+                for key, sampling in record['profiling'].items():
+                    # the same process has a different pid on every host
+                    name = key.rsplit('-', 1)[0]
+                    if name not in processes:
+                        processes[name] = {'cpu': new_samples(), 'mem': new_samples()}
+                    processes[name]['cpu'].merge(SampleSeries.from_dict(sampling['cpu']))
+                    processes[name]['mem'].merge(SampleSeries.from_dict(sampling['mem']))
+
+    print("%d runs from %d hosts: %d events, achieved=%.1f EPS" % (nb_runs, len(hosts), nb_events, achieved_eps))
+    print("Send lag: avg=%(avg_lag).4f s, p50=%(p50_lag).4f s, p99=%(p99_lag).4f s, max=%(max_lag).4f s" %
+          lag_stats(send_lags))
+    if drops:
+        print("Socket drops: %s" % ', '.join('%s=%d' % item for item in sorted(drops.items())))
+    if any(send_failed.values()):
+        print("Send failures: %s" % ', '.join('%s=%d' % item for item in sorted(send_failed.items())))
+    for name, sampling in sorted(processes.items()):
+        print("  %s: cpu avg=%.2f %%, p50=%.2f %%, p99=%.2f %%, max=%.2f %%, mem avg=%d MB, max=%d MB" %
+              (name, sampling['cpu'].avg(), sampling['cpu'].percentile(50), sampling['cpu'].percentile(99),
+               sampling['cpu'].max or 0, sampling['mem'].avg(), sampling['mem'].max or 0))
+    return {'runs': nb_runs, 'hosts': sorted(hosts), 'nb_events': nb_events, 'achieved_eps': achieved_eps,
+            'sent': sent, 'send_failed': send_failed, 'drops': drops, 'send_lags': lag_stats(send_lags),
+            'processes': processes}
+
+
+def build_random_msg_string(size, rnd=random):
+    return 'msg_' + ''.join(rnd.choice(string.ascii_uppercase + string.digits) for _ in range(size))
 
 
 def get_all_plugins_name():
@@ -47,7 +289,8 @@ def get_ruby_version(path):
     if not os.path.isfile(path):
         return ''
     cmd = '%s --version' % path
-    lines = subprocess.Popen(cmd.split(' '), stdout=subprocess.PIPE, stderr=subprocess.STDOUT).stdout.readlines()
+    lines = subprocess.Popen(cmd.split(' '), stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                             universal_newlines=True).stdout.readlines()
     return lines[0].split(' ')[1]
 
 
@@ -76,13 +319,53 @@ def net_connections(protocol='udp'):
     return results
 
 
+def get_sent_sequences(send_stats):
+    """Map every plugin of `send_stats` to the [first index, step, count] sequences its writers sent."""
+    return dict((plugin, plugin_stats.get('sequences', [[0, 1, plugin_stats['nb_events']]]))
+                for plugin, plugin_stats in send_stats['plugins'].items())
+
+
+def get_send_failed(send_stats):
+    """Map every plugin of `send_stats` to the number of events its writers numbered but failed to send."""
+    return dict((plugin, plugin_stats.get('send_failed', 0))
+                for plugin, plugin_stats in send_stats['plugins'].items())
+
+
+def fetch_standin_stats(url, reset=False, sent=None, send_failed=None):
+    """Read the delivery latency and loss statistics collected by ods-standin.py.
+
+    `sent` maps plugin names to the [first index, step, count] sequences sent (see get_sent_sequences),
+    so events never delivered count as lost. Sequences interleave when workers or hosts share a plugin.
+    The sequences also number the events the writers failed to send: `send_failed` maps plugins to their
+    count (see get_send_failed), reported apart and taken out of the events lost by omsagent.
+    """
+    try:
+        from urllib.request import urlopen
+    except ImportError:
+        from urllib2 import urlopen
+    import ssl
+    context = ssl._create_unverified_context()  # the stand-in uses a self-signed certificate
+    query = 'reset=1' if reset else 'sent=%s' % ','.join('%s:%d@%d/%d' % (plugin, count, first, step)
+                                                         for plugin, sequences in sorted((sent or {}).items())
+                                                         for first, step, count in sequences)
+    response = urlopen('%s/stats?%s' % (url.rstrip('/'), query), context=context, timeout=10)
+    stats = json.loads(response.read().decode('utf-8'))
+    for plugin, count in (send_failed or {}).items():
+        if plugin in stats['plugins']:
+            plugin_stats = stats['plugins'][plugin]
+            plugin_stats['send_failed'] = count
+            plugin_stats['lost'] = max(0, plugin_stats['lost'] - count)
+    return stats
+
+
 def measure_page_faults(pid):
     flts = [0, 0]
     cmd = 'ps -o min_flt=,maj_flt= -p %s' % pid
-    lines = subprocess.Popen(cmd.split(' '), stdout=subprocess.PIPE, stderr=subprocess.STDOUT).stdout.readlines()
+    lines = subprocess.Popen(cmd.split(' '), stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                             universal_newlines=True).stdout.readlines()
     if any(lines):
         output = lines[0].strip('\n').strip().split(' ')
-        flts = map(int, filter(None, output))
+        flts = [int(flt) for flt in output if flt]
     return {'minor_flt': flts[0], 'major_flt': flts[1]}
 
 
@@ -111,7 +394,7 @@ def get_threads_cpu_percent(p, total_percent):
 def measure(process, cpu_interval=0):
     result = dict()
     result['cpu'] = process.cpu_percent(cpu_interval)
-    mem = vars(process.memory_full_info())
+    mem = process.memory_full_info()._asdict()
     result.update(mem)
     # faults = measure_page_faults(process.pid)
     # result.update(faults)
@@ -120,6 +403,22 @@ def measure(process, cpu_interval=0):
     return result
 
 
+def summarize_sampling(sampling):
+    """Summary statistics of one process entry of the profiler."""
+    threads_cpu = [samples.avg() for samples in sampling['threads'].values() if len(samples) > 0]
+    return {
+        'avg_cpu': sampling['cpu'].avg(),
+        'max_cpu': sampling['cpu'].max or 0,
+        'max_thread_cpu': max(threads_cpu) if any(threads_cpu) else 0,
+        'avg_mem': sampling['mem'].avg(),
+        'max_mem': sampling['mem'].max or 0,
+        'last_mem': sampling['mem'].last or 0,
+        'mem_growth': (sampling['mem'].last or 0) - (sampling['mem'].first or 0),
+        'minor_flt': sampling['minor_flt'].spread(),
+        'major_flt': sampling['major_flt'].spread(),
+    }
+
+
 def find_children_processes(processes):
     children = []
     ignore_proc = ['sh', 'sudo']
@@ -144,17 +443,16 @@ def profile(processes, profiler, cpu_interval=0):
 
             key = '%s-%d' % (process.name(), process.pid)
             if key not in profiler:
-                profiler[key] = {'cpu': [], 'mem': [], 'minor_flt': [], 'major_flt': [], 'threads': {}}
+                profiler[key] = new_process_sampling()
             result = measure(process, cpu_interval)
             profiler[key]['cpu'].append(result['cpu'])
             profiler[key]['mem'].append(result['rss'] / 10 ** 6)
-            # profiler[key]['mem'].append(result['pss'] / 10 ** 6)
             # profiler[key]['minor_flt'].append(result['minor_flt'])
             # profiler[key]['major_flt'].append(result['major_flt'])
 
-            for tid, value in get_threads_cpu_percent(process, result['cpu']).iteritems():
+            for tid, value in get_threads_cpu_percent(process, result['cpu']).items():
                 if tid not in profiler[key]['threads']:
-                    profiler[key]['threads'][tid] = []
+                    profiler[key]['threads'][tid] = new_samples()
 
                 profiler[key]['threads'][tid].append(value)
         except psutil.NoSuchProcess:
@@ -165,38 +463,869 @@ def profile(processes, profiler, cpu_interval=0):
     return processes, profiler
 
 
+def pread(fd, size, offset=0):
+    if hasattr(os, 'pread'):
+        return os.pread(fd, size, offset)
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.read(fd, size)
+
+
+def parse_proc_stat(content):
+    """Return (comm, minor faults, major faults, utime+stime ticks) from a /proc/<pid>/stat line."""
+    content = content.decode('ASCII', 'replace')
+    comm = content[content.find('(') + 1:content.rfind(')')]
+    fields = content[content.rfind(')') + 2:].split(' ')
+    # fields[0] is the 3rd field of proc(5): state
+    return comm, int(fields[7]), int(fields[9]), int(fields[11]) + int(fields[12])
+
+
+class ProcStatFiles:
+    """Open /proc/<pid>/stat, statm and task/*/stat once and re-read them with pread."""
+    def __init__(self, pid):
+        self.pid = pid
+        self.stat_fd = os.open('/proc/%d/stat' % pid, os.O_RDONLY)
+        self.statm_fd = os.open('/proc/%d/statm' % pid, os.O_RDONLY)
+        self.name = parse_proc_stat(pread(self.stat_fd, 4096))[0]
+        self.key = '%s-%d' % (self.name, pid)
+        self.threads = {}
+        self.last_ticks = None
+        self.last_time = None
+
+    def refresh_threads(self):
+        try:
+            tids = set(int(tid) for tid in os.listdir('/proc/%d/task' % self.pid))
+        except OSError:
+            return
+        for tid in list(self.threads.keys()):
+            if tid not in tids:
+                os.close(self.threads.pop(tid)[0])
+        for tid in tids:
+            if tid not in self.threads:
+                try:
+                    fd = os.open('/proc/%d/task/%d/stat' % (self.pid, tid), os.O_RDONLY)
+                except OSError:
+                    continue
+                self.threads[tid] = [fd, None]
+
+    def children(self):
+        children = set()
+        for tid in self.threads:
+            try:
+                with open('/proc/%d/task/%d/children' % (self.pid, tid)) as f:
+                    children.update(int(pid) for pid in f.read().split())
+            except (IOError, OSError):
+                pass
+        return children
+
+    def sample(self, now, clk_tck, page_size):
+        """Raise OSError when the process is gone."""
+        comm, minor_flt, major_flt, ticks = parse_proc_stat(pread(self.stat_fd, 4096))
+        rss = int(pread(self.statm_fd, 256).split()[1]) * page_size
+        wall = (now - self.last_time) * clk_tck if self.last_time is not None else 0
+        cpu = 100.0 * (ticks - self.last_ticks) / wall if wall > 0 else 0.0
+        self.last_ticks, self.last_time = ticks, now
+
+        threads = {}
+        if len(self.threads) > 1:
+            for tid, thread in list(self.threads.items()):
+                try:
+                    thread_comm, _, _, thread_ticks = parse_proc_stat(pread(thread[0], 4096))
+                except OSError:
+                    os.close(self.threads.pop(tid)[0])
+                    continue
+                thread_cpu = 100.0 * (thread_ticks - thread[1]) / wall if wall > 0 and thread[1] is not None else 0.0
+                thread[1] = thread_ticks
+                threads['%s-%d' % (thread_comm, tid)] = round(thread_cpu, 2)
+        return {'cpu': round(cpu, 2), 'rss': rss, 'minor_flt': minor_flt, 'major_flt': major_flt, 'threads': threads}
+
+    def close(self):
+        for fd in [self.stat_fd, self.statm_fd] + [thread[0] for thread in self.threads.values()]:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+        self.threads = {}
+
+
+class ProcSampler(threading.Thread):
+    """Sample CPU, RSS, page faults and per-thread CPU of processes from /proc at a fixed cadence.
+
+    Unlike profile(), no psutil.Process is created per sample and smaps is never read, so the
+    monitored agent can be sampled at 10-100 Hz without being perturbed. Children of the monitored
+    processes are discovered every `discover_interval` seconds from /proc/<pid>/task/<tid>/children.
+    Samples are stored in the same layout as profile().
+    """
+    CLK_TCK = os.sysconf('SC_CLK_TCK')
+    PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+    IGNORED_CHILDREN = ['sh', 'sudo']
+
+    def __init__(self, pids, interval, discover_interval=1.0, stop_event=None):
+        threading.Thread.__init__(self, name='proc-sampler')
+        self.daemon = True
+        self.interval = interval
+        self.discover_interval = discover_interval
+        self.profiler = {}
+        self.nb_samples = 0
+        self.files = {}
+        self.stop_event = stop_event or threading.Event()
+        for pid in pids:
+            self.watch(pid, ignore_names=[])
+
+    def watch(self, pid, ignore_names=None):
+        if pid in self.files:
+            return
+        try:
+            files = ProcStatFiles(pid)
+        except OSError:
+            return
+        if files.name in (self.IGNORED_CHILDREN if ignore_names is None else ignore_names):
+            files.close()
+            return
+        files.refresh_threads()
+        self.files[pid] = files
+
+    def discover(self):
+        for files in list(self.files.values()):
+            files.refresh_threads()
+            for child in files.children():
+                self.watch(child)
+
+    def sample(self):
+        now = monotonic()
+        for pid, files in list(self.files.items()):
+            try:
+                result = files.sample(now, self.CLK_TCK, self.PAGE_SIZE)
+            except (OSError, ValueError, IndexError):
+                files.close()
+                del self.files[pid]
+                continue
+            self.emit(files.key, result)
+        self.nb_samples += 1
+
+    def emit(self, key, result):
+        if key not in self.profiler:
+            self.profiler[key] = new_process_sampling()
+        sampling = self.profiler[key]
+        sampling['cpu'].append(result['cpu'])
+        sampling['mem'].append(result['rss'] / 10 ** 6)
+        sampling['minor_flt'].append(result['minor_flt'])
+        sampling['major_flt'].append(result['major_flt'])
+        for tid, value in result['threads'].items():
+            if tid not in sampling['threads']:
+                sampling['threads'][tid] = new_samples()
+            sampling['threads'][tid].append(value)
+
+    def run(self):
+        start_time = monotonic()
+        last_discover_time = start_time
+        while not self.stop_event.is_set():
+            self.sample()
+            now = monotonic()
+            if now - last_discover_time >= self.discover_interval:
+                self.discover()
+                last_discover_time = now
+            # fixed cadence: wake up on the next multiple of the interval, skipping missed ones
+            elapsed = monotonic() - start_time
+            next_time = (math.floor(elapsed / self.interval) + 1) * self.interval
+            self.stop_event.wait(next_time - elapsed)
+
+    def poll(self):
+        return self.profiler
+
+    def stop(self):
+        self.stop_event.set()
+        if self.is_alive():
+            self.join()
+        for files in self.files.values():
+            files.close()
+        return self.profiler
+
+
+class PsutilSampler(threading.Thread):
+    """Run profile() and find_children_processes() at a fixed cadence in a background thread."""
+    def __init__(self, processes, interval):
+        threading.Thread.__init__(self, name='psutil-sampler')
+        self.daemon = True
+        self.processes = list(processes)
+        self.interval = interval
+        self.profiler = {}
+        self.stop_event = threading.Event()
+
+    def run(self):
+        start_time = monotonic()
+        while not self.stop_event.is_set():
+            self.processes = find_children_processes([p for p in self.processes if p.is_running()])
+            self.processes, self.profiler = profile(self.processes, self.profiler)
+            elapsed = monotonic() - start_time
+            self.stop_event.wait((math.floor(elapsed / self.interval) + 1) * self.interval - elapsed)
+
+    def poll(self):
+        return self.profiler
+
+    def stop(self):
+        self.stop_event.set()
+        if self.is_alive():
+            self.join()
+        return self.profiler
+
+
+class SampleRing:
+    """Single-producer single-consumer ring of fixed-size float records in shared memory.
+
+    The producer writes a record, then publishes it by advancing `head`; the consumer reads the
+    records up to `head`, then releases them by advancing `tail`. Each index has a single writer, so
+    neither side takes a lock. When the consumer falls behind, new records are dropped and counted.
+    """
+    RECORD_SIZE = 5
+    HEAD, TAIL, DROPPED = range(3)
+
+    def __init__(self, capacity=65536):
+        self.capacity = capacity
+        self.records = multiprocessing.RawArray('d', capacity * self.RECORD_SIZE)
+        self.indexes = multiprocessing.RawArray('L', 3)
+
+    def push(self, record):
+        head = self.indexes[self.HEAD]
+        if head - self.indexes[self.TAIL] >= self.capacity:
+            self.indexes[self.DROPPED] += 1
+            return False
+        offset = (head % self.capacity) * self.RECORD_SIZE
+        self.records[offset:offset + self.RECORD_SIZE] = record
+        self.indexes[self.HEAD] = head + 1
+        return True
+
+    def pop_all(self):
+        head, tail = self.indexes[self.HEAD], self.indexes[self.TAIL]
+        records = []
+        for position in range(tail, head):
+            offset = (position % self.capacity) * self.RECORD_SIZE
+            records.append(self.records[offset:offset + self.RECORD_SIZE])
+        self.indexes[self.TAIL] = head
+        return records
+
+    def dropped(self):
+        return self.indexes[self.DROPPED]
+
+
+class RingProcSampler(ProcSampler):
+    """ProcSampler of a sampler process: samples go to a SampleRing instead of the profiler.
+
+    A record is (key id, cpu, mem, minor faults, major faults); thread records only carry the cpu.
+    Key ids are sent once through `keys_queue`, before the first record using them.
+    """
+    def __init__(self, pids, interval, discover_interval, ring, keys_queue, stop_event):
+        ProcSampler.__init__(self, pids, interval, discover_interval, stop_event=stop_event)
+        self.ring = ring
+        self.keys_queue = keys_queue
+        self.key_ids = {}
+
+    def get_key_id(self, key, tid=None):
+        key_id = self.key_ids.get((key, tid))
+        if key_id is None:
+            key_id = len(self.key_ids)
+            self.key_ids[(key, tid)] = key_id
+            self.keys_queue.put((key_id, key, tid))
+        return key_id
+
+    def emit(self, key, result):
+        self.ring.push((self.get_key_id(key), result['cpu'], result['rss'] / 10 ** 6, result['minor_flt'],
+                        result['major_flt']))
+        for tid, value in result['threads'].items():
+            self.ring.push((self.get_key_id(key, tid), value, 0, 0, 0))
+
+
+def run_ring_sampler(pids, interval, discover_interval, ring, keys_queue, stop_event):
+    """Entry point of the sampler process."""
+    RingProcSampler(pids, interval, discover_interval, ring, keys_queue, stop_event).run()
+
+
+def new_simple_queue():
+    if hasattr(multiprocessing, 'SimpleQueue'):
+        return multiprocessing.SimpleQueue()
+    from multiprocessing.queues import SimpleQueue
+    return SimpleQueue()
+
+
+class SamplerProcess:
+    """Run a ProcSampler in a child process with its own clock, for --sampler process.
+
+    The sampler no longer competes with the send loop for the GIL. Its samples come back through a
+    SampleRing that poll() drains, from the send loop, once per sampling interval.
+    """
+    def __init__(self, pids, interval, discover_interval=1.0, capacity=65536):
+        self.ring = SampleRing(capacity)
+        self.keys_queue = new_simple_queue()
+        self.stop_event = multiprocessing.Event()
+        self.process = multiprocessing.Process(target=run_ring_sampler, name='proc-sampler',
+                                               args=(pids, interval, discover_interval, self.ring,
+                                                     self.keys_queue, self.stop_event))
+        self.process.daemon = True
+        self.keys = {}
+        self.profiler = {}
+
+    def start(self):
+        self.process.start()
+
+    def poll(self):
+        # a key id is queued before the records using it are published, so the keys drained after
+        # taking the records cover all of them, even those queued in between
+        records = self.ring.pop_all()
+        while not self.keys_queue.empty():
+            key_id, key, tid = self.keys_queue.get()
+            self.keys[key_id] = (key, tid)
+        for key_id, cpu, mem, minor_flt, major_flt in records:
+            key, tid = self.keys[int(key_id)]
+            if key not in self.profiler:
+                self.profiler[key] = new_process_sampling()
+            sampling = self.profiler[key]
+            if tid is not None:
+                if tid not in sampling['threads']:
+                    sampling['threads'][tid] = new_samples()
+                sampling['threads'][tid].append(cpu)
+                continue
+            sampling['cpu'].append(cpu)
+            sampling['mem'].append(mem)
+            sampling['minor_flt'].append(int(minor_flt))
+            sampling['major_flt'].append(int(major_flt))
+        return self.profiler
+
+    def stop(self):
+        self.stop_event.set()
+        self.process.join()
+        self.poll()
+        if self.ring.dropped() > 0:
+            print("Warning: %d samples dropped, the sample ring was full" % self.ring.dropped())
+        return self.profiler
+
+
+class SlopeFit:
+    """Online least-squares fit of y = a + b * x, with the standard error of the slope.
+
+    Only the sums are kept, so a fit over a soak run of several hours uses constant memory. The sums
+    of the products of consecutive samples give the lag-1 autocorrelation of the residuals, which
+    widens the standard error: samples a few seconds apart are far from independent.
+    """
+    def __init__(self):
+        self.n = 0
+        self.sum_x = self.sum_y = self.sum_xx = self.sum_xy = self.sum_yy = 0.0
+        # sums over consecutive samples (x0, y0), (x1, y1): x0 * x1, x0 * y1 + y0 * x1, y0 * y1
+        self.sum_lag_xx = self.sum_lag_xy = self.sum_lag_yy = 0.0
+        self.first = None
+        self.last = None
+        self.first_x = None
+        self.last_x = None
+
+    def add(self, x, y):
+        self.n += 1
+        self.sum_x += x
+        self.sum_y += y
+        self.sum_xx += x * x
+        self.sum_xy += x * y
+        self.sum_yy += y * y
+        if self.first is None:
+            self.first, self.first_x = y, x
+        else:
+            self.sum_lag_xx += self.last_x * x
+            self.sum_lag_xy += self.last_x * y + self.last * x
+            self.sum_lag_yy += self.last * y
+        self.last, self.last_x = y, x
+
+    def mean(self):
+        return self.sum_y / self.n if self.n > 0 else 0
+
+    def fit(self):
+        """Return (intercept, slope, sum of the squared residuals, standard error of the slope)."""
+        if self.n < 3:
+            return self.mean(), 0.0, 0.0, float('inf')
+        sxx = self.sum_xx - self.sum_x * self.sum_x / self.n
+        sxy = self.sum_xy - self.sum_x * self.sum_y / self.n
+        syy = self.sum_yy - self.sum_y * self.sum_y / self.n
+        if sxx <= 0:
+            return self.mean(), 0.0, 0.0, float('inf')
+        slope = sxy / sxx
+        intercept = (self.sum_y - slope * self.sum_x) / self.n
+        sse = max(syy - slope * sxy, 0.0)
+        return intercept, slope, sse, math.sqrt(sse / (self.n - 2) / sxx)
+
+    def autocorrelation(self):
+        """Lag-1 autocorrelation of the residuals of the fit."""
+        a, b, sse, _ = self.fit()
+        if self.n < 3 or sse <= 0:
+            return 0.0
+        # sum over consecutive residuals of (y0 - a - b * x0) * (y1 - a - b * x1)
+        lag_y = 2 * self.sum_y - self.first - self.last
+        lag_x = 2 * self.sum_x - self.first_x - self.last_x
+        lag_sum = (self.sum_lag_yy - a * lag_y - b * self.sum_lag_xy + a * a * (self.n - 1) + a * b * lag_x +
+                   b * b * self.sum_lag_xx)
+        return max(-1.0, min(1.0, lag_sum / sse))
+
+    def slope(self):
+        """Return (slope, standard error of the slope corrected for the autocorrelation of the residuals)."""
+        _, slope, _, stderr = self.fit()
+        if self.n < 3:
+            return slope, stderr
+        # effective number of independent samples of an AR(1) series, n (1 - r) / (1 + r)
+        r = max(self.autocorrelation(), 0.0)
+        n_eff = self.n * (1 - r) / (1 + r)
+        if n_eff <= 2:
+            return slope, float('inf')
+        return slope, stderr * math.sqrt((self.n - 2) / (n_eff - 2))
+
+    def span(self):
+        return self.last_x - self.first_x if self.n > 0 else 0.0
+
+
+def read_ruby_heap_slots(pid, sigdump_dir='/tmp', timeout=5.0):
+    """Live ruby heap slots of a fluentd process, from the GC stats of its sigdump (SIGCONT) dump."""
+    path = os.path.join(sigdump_dir, 'sigdump-%d.log' % pid)
+    previous_mtime = os.path.getmtime(path) if os.path.exists(path) else 0
+    os.kill(pid, signal.SIGCONT)
+    deadline = monotonic() + timeout
+    while monotonic() < deadline:
+        if os.path.exists(path) and os.path.getmtime(path) != previous_mtime:
+            break
+        time.sleep(0.1)
+    else:
+        return None
+    time.sleep(0.1)  # let sigdump finish writing
+    with open(path) as f:
+        match = re.search(r'heap_live_(?:slots|slot|num):\s*(\d+)', f.read())
+    return int(match.group(1)) if match else None
+
+
+def read_pss(pid):
+    """PSS of a process in MB from /proc/<pid>/smaps_rollup (Linux 4.14+), None where there is none."""
+    try:
+        with open('/proc/%d/smaps_rollup' % pid) as f:
+            for line in f:
+                if line.startswith('Pss:'):
+                    return int(line.split()[1]) * 1024 / 10.0 ** 6
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+
+class LeakDetector(threading.Thread):
+    """Tell memory leaks from steady-state buffering during long soak runs, for --soak.
+
+    Every `interval` seconds the processes and their children (find_children_processes, so omiagent
+    and npmd are covered) are sampled: RSS (memory_info), open file descriptors and, with `ruby_heap`,
+    the live ruby heap slots of the fluentd processes. PSS, which the kernel sums over every mapping,
+    is only read every `pss_every` samples and only from smaps_rollup, never from the full smaps
+    (it is not sampled on kernels older than 4.14). After `warmup` seconds a slope
+    is fitted per process: the sum over processes of the same name would jump as children come and go.
+    A metric leaks when the slope is `min_t` standard errors above 0, the error being corrected for
+    the autocorrelation of the samples, and the fitted growth over the window exceeds `min_growth` of
+    its mean.
+    """
+    METRICS = ['rss', 'pss', 'fds', 'ruby_heap_slots']
+
+    def __init__(self, processes, interval=10.0, warmup=600.0, min_growth=0.05, min_t=3.0, ruby_heap=False,
+                 pss_every=6):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.processes = list(processes)
+        self.interval = interval
+        self.warmup = warmup
+        self.min_growth = min_growth
+        self.min_t = min_t
+        self.ruby_heap = ruby_heap
+        self.pss_every = pss_every
+        self.nb_samples = 0
+        self.fits = {}
+        self.stop_event = threading.Event()
+        self.start_time = None
+
+    def is_ruby(self, process):
+        return process.name() in ['omsagent', 'ruby'] or 'ruby' in ' '.join(process.cmdline()[:1])
+
+    def sample_process(self, process, with_pss=False):
+        sample = {'rss': process.memory_info().rss / 10.0 ** 6, 'fds': process.num_fds()}
+        if with_pss:
+            pss = read_pss(process.pid)
+            if pss is not None:
+                sample['pss'] = pss
+        if self.ruby_heap and self.is_ruby(process):
+            slots = read_ruby_heap_slots(process.pid)
+            if slots is not None:
+                sample['ruby_heap_slots'] = slots
+        return sample
+
+    def add(self, key, metric, hours, value):
+        fits = self.fits.setdefault(key, {})
+        if metric not in fits:
+            fits[metric] = SlopeFit()
+        fits[metric].add(hours, value)
+
+    def sample(self):
+        now = monotonic()
+        if now - self.start_time < self.warmup:
+            return
+        hours = (now - self.start_time - self.warmup) / 3600.0
+        with_pss = self.nb_samples % self.pss_every == 0
+        self.nb_samples += 1
+        self.processes = [p for p in find_children_processes(self.processes) if p.is_running()]
+        for process in self.processes:
+            try:
+                name = process.name()
+                sample = self.sample_process(process, with_pss)
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                continue
+            for metric, value in sample.items():
+                self.add('%s-%d' % (name, process.pid), metric, hours, value)
+
+    def run(self):
+        self.start_time = monotonic()
+        while not self.stop_event.is_set():
+            self.sample()
+            self.stop_event.wait(self.interval)
+
+    def stop(self):
+        self.stop_event.set()
+        if self.is_alive():
+            self.join()
+        return self.analyze()
+
+    def analyze(self):
+        """Return {key: {metric: fit summary}}; 'leak' is set on the significant growths."""
+        report = {}
+        for key, fits in sorted(self.fits.items()):
+            for metric, fit in sorted(fits.items()):
+                slope, stderr = fit.slope()
+                mean = fit.mean()
+                growth = slope * fit.span() / mean if mean > 0 else 0
+                t = slope / stderr if stderr > 0 else (float('inf') if slope > 0 else 0)
+                report.setdefault(key, {})[metric] = {
+                    'samples': fit.n, 'first': round(fit.first, 3), 'last': round(fit.last, 3),
+                    'slope_per_hour': round(slope, 6), 't': round(min(t, 10 ** 6), 2),
+                    'autocorrelation': round(fit.autocorrelation(), 3),
+                    'growth': round(growth, 4), 'leak': fit.n >= 3 and t >= self.min_t and growth >= self.min_growth,
+                }
+        return report
+
+
+def print_leak_report(report):
+    units = {'rss': 'MB', 'pss': 'MB', 'fds': 'fds', 'ruby_heap_slots': 'slots'}
+    for key, metrics in sorted(report.items()):
+        for metric, fit in sorted(metrics.items()):
+            print("%s %s: %s -> %s, slope=%.3f %s/h (t=%.1f), growth=%.1f %%%s" %
+                  (key, metric, fit['first'], fit['last'], fit['slope_per_hour'], units.get(metric, ''), fit['t'],
+                   fit['growth'] * 100, ' LEAK' if fit['leak'] else ''))
+
+
+CORPUS_KINDS = ['syslog', 'cef', 'file']
+
+
+def escape_corpus_body(body):
+    return body.replace('\\', '\\\\').replace('\n', '\\n').replace('\t', '\\t')
+
+
+def unescape_corpus_body(body):
+    if b'\\' not in body:
+        return body
+    return re.sub(br'\\(.)', lambda match: {b'n': b'\n', b't': b'\t'}.get(match.group(1), match.group(1)), body)
+
+
+class WorkloadCorpus:
+    """Replay a workload corpus from a memory-mapped file.
+
+    A corpus is a text file with one event per line:
+        <kind>\\t<facility>\\t<severity>\\t<app name>\\t<body>
+    where kind is one of CORPUS_KINDS and backslash, tab and newline are escaped in the body, so that
+    multi-line events (stack traces for in_tail) fit on one line. CEF bodies omit the 'CEF:' prefix
+    (see CEFWriter.CEF_SAMPLE). Only line offsets are kept in memory, one array per kind. Event `idx`
+    of a writer always replays record `idx` modulo the number of records of its kind, so a replay is
+    deterministic whatever the EPS or the number of writer processes.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.size = os.fstat(self.file.fileno()).st_size
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if self.size > 0 else b''
+        self.offsets = dict((kind, array.array('L')) for kind in CORPUS_KINDS)
+        self.index()
+
+    def index(self):
+        start = 0
+        line_number = 0
+        malformed = []
+        while start < self.size:
+            end = self.mm.find(b'\n', start)
+            if end < 0:
+                end = self.size
+            line_number += 1
+            kind_end = self.mm.find(b'\t', start, end)
+            if kind_end < 0 or self.mm[kind_end:end].count(b'\t') < 4:
+                # not <kind>\t<facility>\t<severity>\t<app name>\t<body>
+                if end > start:
+                    malformed.append(line_number)
+                start = end + 1
+                continue
+            kind = self.mm[start:kind_end].decode('ASCII', 'replace')
+            if kind in self.offsets:
+                self.offsets[kind].append(start)
+            start = end + 1
+        if malformed:
+            print("Warning: %d malformed lines skipped in corpus %s (expected 5 tab separated fields), first: line %d" %
+                  (len(malformed), self.path, malformed[0]))
+
+    def count(self, kind):
+        return len(self.offsets.get(kind, ()))
+
+    def record(self, kind, position):
+        """Return (facility, severity, app name, body) of the `position`-th record of `kind`."""
+        offsets = self.offsets[kind]
+        start = offsets[position % len(offsets)]
+        end = self.mm.find(b'\n', start)
+        _, facility, severity, app_name, body = self.mm[start:end if end >= 0 else self.size].split(b'\t', 4)
+        return int(facility), int(severity), app_name.decode('ASCII', 'replace'), unescape_corpus_body(body)
+
+    def records(self, kind, first_index, index_step, count):
+        return [self.record(kind, first_index + i * index_step) for i in range(count)]
+
+    def stats(self):
+        """Size and shape statistics of the corpus, computed in one pass."""
+        stats = {'path': self.path, 'bytes': self.size, 'kinds': {}}
+        for kind in CORPUS_KINDS:
+            sizes = new_samples(1)
+            facilities, severities, app_names = {}, {}, {}
+            multi_line = 0
+            for position in range(self.count(kind)):
+                facility, severity, app_name, body = self.record(kind, position)
+                sizes.append(len(body))
+                facilities[facility] = facilities.get(facility, 0) + 1
+                severities[severity] = severities.get(severity, 0) + 1
+                app_names[app_name] = app_names.get(app_name, 0) + 1
+                multi_line += 1 if b'\n' in body else 0
+            if len(sizes) == 0:
+                continue
+            stats['kinds'][kind] = {
+                'records': len(sizes), 'multi_line': multi_line, 'min_size': sizes.min, 'avg_size': round(sizes.avg(), 1),
+                'p50_size': sizes.percentile(50), 'p99_size': sizes.percentile(99), 'max_size': sizes.max,
+                'facilities': facilities, 'severities': severities, 'apps': len(app_names),
+            }
+        return stats
+
+    def close(self):
+        if self.size > 0:
+            self.mm.close()
+        self.file.close()
+
+
+def print_corpus_stats(stats):
+    print("Corpus %s: %d bytes" % (stats['path'], stats['bytes']))
+    for kind, kind_stats in sorted(stats['kinds'].items()):
+        print("  %s: %d records (%d multi-line), size min=%d avg=%.1f p50=%d p99=%d max=%d, %d apps" %
+              (kind, kind_stats['records'], kind_stats['multi_line'], kind_stats['min_size'], kind_stats['avg_size'],
+               kind_stats['p50_size'], kind_stats['p99_size'], kind_stats['max_size'], kind_stats['apps']))
+        print("    facilities: %s" % ', '.join('%s=%d' % item for item in sorted(kind_stats['facilities'].items())))
+        print("    severities: %s" % ', '.join('%s=%d' % item for item in sorted(kind_stats['severities'].items())))
+
+
+class CorpusSynthesizer:
+    """Generate a deterministic mixed workload corpus (same seed, same corpus)."""
+    USERS = ['root', 'admin', 'azureuser', 'omsagent', 'nagios', 'postgres', 'www-data']
+    COMMANDS = ['ls', 'systemctl', 'apt-get', 'yum', 'cat', 'tail', 'python3', 'docker']
+    SYSLOG_TEMPLATES = [
+        (SysLogHandler.LOG_AUTH, 'sshd', 'Failed password for {user} from {ip} port {port} ssh2'),
+        (SysLogHandler.LOG_AUTH, 'sshd', 'Accepted publickey for {user} from {ip} port {port} ssh2: RSA SHA256:{hex}'),
+        (SysLogHandler.LOG_AUTHPRIV, 'sudo', '{user} : TTY=pts/{n} ; PWD=/home/{user} ; USER=root ; COMMAND=/usr/bin/{cmd}'),
+        (SysLogHandler.LOG_CRON, 'CRON', '({user}) CMD ({cmd} > /dev/null 2>&1)'),
+        (SysLogHandler.LOG_KERN, 'kernel', '[{uptime}] IPv4: martian source {ip} from {ip}, on dev eth0'),
+        (SysLogHandler.LOG_DAEMON, 'systemd', 'Started Session {n} of user {user}.'),
+        (SysLogHandler.LOG_LOCAL0, 'nginx', '{ip} - - "GET /api/v1/items/{n} HTTP/1.1" {status} {port} "-" "curl/7.58.0"'),
+        (SysLogHandler.LOG_USER, 'app', 'level=info msg="request processed" duration={n}ms request_id={hex}'),
+    ]
+    # rough production mix: mostly info/notice, a tail of warnings and errors
+    SEVERITIES = [SysLogHandler.LOG_INFO] * 12 + [SysLogHandler.LOG_NOTICE] * 3 + [SysLogHandler.LOG_WARNING] * 2 + \
+        [SysLogHandler.LOG_ERR, SysLogHandler.LOG_DEBUG, SysLogHandler.LOG_CRIT]
+    CEF_VENDORS = [
+        ('Palo Alto Networks', 'PAN-OS', '8.0.0'),
+        ('Fortinet', 'Fortigate', 'v6.0.3'),
+        ('Check Point', 'VPN-1 & FireWall-1', 'R80'),
+        ('Cisco', 'ASA', '9.8'),
+        ('Trend Micro', 'Deep Security Agent', '10.0'),
+    ]
+    CEF_ACTIONS = ['allow', 'deny', 'drop', 'reset-both', 'alert']
+
+    def __init__(self, seed=0, median_size=150, multi_line_ratio=0.3):
+        self.random = random.Random(seed)
+        self.median_size = median_size
+        self.multi_line_ratio = multi_line_ratio
+
+    def fields(self):
+        rnd = self.random
+        return {
+            'user': rnd.choice(self.USERS), 'cmd': rnd.choice(self.COMMANDS), 'n': rnd.randint(1, 99999),
+            'ip': '%d.%d.%d.%d' % (rnd.randint(1, 223), rnd.randint(0, 255), rnd.randint(0, 255), rnd.randint(1, 254)),
+            'port': rnd.randint(1024, 65535), 'hex': '%032x' % rnd.getrandbits(128),
+            'uptime': '%.6f' % rnd.uniform(0, 10 ** 6), 'status': rnd.choice([200, 200, 200, 301, 404, 500]),
+        }
+
+    def target_size(self):
+        # log-normal sizes: most events are short, a few are several KB
+        return min(16384, int(self.random.lognormvariate(math.log(self.median_size), 0.8)))
+
+    def pad(self, body):
+        size = self.target_size()
+        fields = []
+        while len(body) + sum(len(field) + 1 for field in fields) < size:
+            fields.append('k%d=%s' % (len(fields), build_random_msg_string(self.random.randint(4, 24), self.random)))
+        return ' '.join([body] + fields)
+
+    def syslog_record(self):
+        facility, app_name, template = self.random.choice(self.SYSLOG_TEMPLATES)
+        return 'syslog', facility, self.random.choice(self.SEVERITIES), app_name, \
+            self.pad(template.format(**self.fields()))
+
+    def cef_record(self):
+        vendor, product, version = self.random.choice(self.CEF_VENDORS)
+        fields = self.fields()
+        severity = self.random.randint(1, 10)
+        body = '0|%s|%s|%s|%d|%s|%d|src=%s dst=%s spt=%d dpt=%d proto=TCP act=%s msg=%s' % (
+            vendor, product, version, self.random.randint(100, 999), 'traffic', severity, fields['ip'],
+            '10.0.%d.%d' % (self.random.randint(0, 255), self.random.randint(1, 254)), fields['port'],
+            self.random.choice([22, 80, 443, 3389]), self.random.choice(self.CEF_ACTIONS),
+            'session %s' % fields['hex'])
+        return 'cef', SysLogHandler.LOG_LOCAL4, SysLogHandler.LOG_WARNING, product, self.pad(body)
+
+    def file_record(self):
+        fields = self.fields()
+        if self.random.random() < self.multi_line_ratio:
+            lines = ['ERROR [main] com.contoso.orders.OrderService - request %s failed' % fields['hex'],
+                     'java.lang.IllegalStateException: order %d is locked' % fields['n']]
+            for depth in range(self.random.randint(3, 15)):
+                lines.append('\tat com.contoso.orders.Layer%d.handle(Layer%d.java:%d)' %
+                             (depth, depth, self.random.randint(10, 900)))
+            return 'file', SysLogHandler.LOG_USER, SysLogHandler.LOG_ERR, 'java', '\n'.join(lines)
+        return 'file', SysLogHandler.LOG_USER, SysLogHandler.LOG_INFO, 'app', \
+            self.pad('INFO [worker-%d] request %s served in %d ms' % (fields['n'] % 16, fields['hex'], fields['n'] % 900))
+
+    def write(self, path, nb_records, mix=(0.6, 0.2, 0.2)):
+        with open(path, 'w') as f:
+            for _ in range(nb_records):
+                draw = self.random.random()
+                if draw < mix[0]:
+                    record = self.syslog_record()
+                elif draw < mix[0] + mix[1]:
+                    record = self.cef_record()
+                else:
+                    record = self.file_record()
+                kind, facility, severity, app_name, body = record
+                f.write('%s\t%d\t%d\t%s\t%s\n' % (kind, facility, severity, app_name, escape_corpus_body(body)))
+
+
+def import_corpus(source_path, corpus_path, kind='syslog'):
+    """Convert a captured log (one event per line) into corpus records of `kind`."""
+    with open(source_path) as source, open(corpus_path, 'a') as corpus:
+        for line in source:
+            line = line.rstrip('\n')
+            if line:
+                corpus.write('%s\t%d\t%d\t%s\t%s\n' % (kind, SysLogHandler.LOG_USER, SysLogHandler.LOG_INFO,
+                                                       'captured', escape_corpus_body(line)))
+
+
 class OutputWriter:
     def __init__(self, name, tag, path, msg_size):
+        self.first_index = 0
         self.index = 0
+        # writer processes sharing a plugin interleave their sequence numbers: shard k sends k, k+N, k+2N...
+        self.index_step = 1
         self.tag = tag
         self.path = path
         self.msg_size = msg_size
         self.name = name
         self.msg = build_random_msg_string(self.msg_size)
+        # events are replayed from a WorkloadCorpus when one is set, see set_corpus
+        self.corpus = None
+        self.corpus_kind = 'syslog'
 
     def __str__(self):
-        self.name()
+        return self.name
+
+    def set_corpus(self, corpus):
+        if corpus.count(self.corpus_kind) == 0:
+            print("Warning: no '%s' record in corpus %s, %s keeps sending its fixed message" %
+                  (self.corpus_kind, corpus.path, self.get_name()))
+            return
+        self.corpus = corpus
+
+    def corpus_records(self, count):
+        return self.corpus.records(self.corpus_kind, self.index, self.index_step, count)
 
     def get_name(self):
         return self.name
 
+    def set_sequence(self, first_index, index_step):
+        """Number the next events first_index, first_index + index_step, first_index + 2 * index_step..."""
+        self.first_index = first_index
+        self.index = first_index
+        self.index_step = index_step
+
+    def get_sequence(self):
+        """Return [first index, step, count] of the sequence numbers given out since set_sequence."""
+        return [self.first_index, self.index_step, (self.index - self.first_index) // self.index_step]
+
     def get_protocol(self):
         return ''
 
+    def stamp(self, index, now):
+        # sequence number and send time of the event, parsed back by ods-standin.py for end-to-end latency
+        return 'idx=%d ts=%.6f %s' % (index, now, self.get_name())
+
     def write(self, eps):
+        """Send `eps` events, return the number of events actually sent."""
         print("Not Implemented")
+        return 0
+
+    def flush(self):
+        """Send the buffered events, return the number of them that could not be sent."""
+        return 0
+
+    def get_stats(self):
+        return {}
 
     def get_number_dropped_event(self):
         return 0
 
 
 class MsgPackWriter(OutputWriter):
-    def __init__(self, tag, path, msg_size):
+    """Send events to in_forward with the fluentd forward protocol over one reused connection.
+
+    'message' sends one [tag, time, record] frame per event. 'packed' (PackedForward) and 'compressed'
+    (CompressedPackedForward, gzip) buffer the [time, record] entries and send one [tag, entries, option]
+    frame per `chunk_size` events, or when the oldest buffered event is `flush_interval` seconds old.
+    With `ack`, every frame carries a chunk id and the writer waits for the {'ack': <chunk id>} response
+    of in_forward before sending the next one, as out_forward does with require_ack_response.
+
+    CompressedPackedForward came with fluentd v0.14: the in_forward of the fluentd 0.12 bundled with
+    omsagent does not decompress the entries, so 'compressed' only benchmarks newer receivers.
+    """
+    MODES = ['message', 'packed', 'compressed']
+
+    def __init__(self, tag, path, msg_size, mode='message', chunk_size=1000, flush_interval=1.0, ack=False,
+                 ack_timeout=30.0):
         OutputWriter.__init__(self, 'msgpack', tag, path, msg_size)
+        if mode not in self.MODES:
+            raise ValueError("Unknown forward mode '%s', available modes: %s" % (mode, ', '.join(self.MODES)))
         self.protocol = 'tcp'
         self.host, port = self.path.split(':')
         self.port = int(port)
-        self.fluent_sender = None
+        self.mode = mode
+        self.chunk_size = max(1, chunk_size)
+        self.flush_interval = flush_interval
+        self.ack = ack
+        self.ack_timeout = ack_timeout
+        self.socket = None
+        self.entries = []
+        self.first_entry_time = None
+        self.nb_frames = 0
+        self.nb_bytes = 0
+        self.nb_connections = 0
+        self.nb_send_errors = 0
+        self.nb_ack_timeouts = 0
+        self.ack_wait = 0.0
+        self.max_ack_wait = 0.0
 
     def get_protocol(self):
         return self.protocol
@@ -211,67 +1340,304 @@ class MsgPackWriter(OutputWriter):
                 break
         return dropped_events
 
-    def write(self, eps, override_buffer=None):
+    def connect(self):
+        if self.socket is None:
+            self.socket = socket.create_connection((self.host, self.port))
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.nb_connections += 1
+        return self.socket
+
+    def close(self):
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+
+    def wait_ack(self, chunk_id):
         import msgpack
-        from fluent import sender
-        if self.fluent_sender is None:
-            self.fluent_sender = sender.FluentSender(self.tag, host=self.host, port=self.port)
-        self.msgpack_msg = msgpack.packb((self.tag, int(time.time()), self.msg), **{})
+        unpacker = msgpack.Unpacker(raw=False)
+        start = monotonic()
+        self.socket.settimeout(self.ack_timeout)
+        try:
+            while True:
+                data = self.socket.recv(4096)
+                if not data:
+                    raise socket.error('connection closed by in_forward')
+                unpacker.feed(data)
+                for response in unpacker:
+                    if isinstance(response, dict) and response.get('ack') == chunk_id:
+                        return
+        finally:
+            wait = monotonic() - start
+            self.ack_wait += wait
+            self.max_ack_wait = max(self.max_ack_wait, wait)
+            if self.socket is not None:
+                self.socket.settimeout(None)
+
+    def send_frame(self, frame, chunk_id):
+        """Return whether the frame was sent (and acknowledged with `ack`)."""
+        try:
+            self.connect().sendall(frame)
+            self.nb_frames += 1
+            self.nb_bytes += len(frame)
+            if chunk_id is not None:
+                self.wait_ack(chunk_id)
+            return True
+        except socket.timeout:
+            # out_forward drops the connection when no ack comes back, the chunk would be retried
+            self.nb_ack_timeouts += 1
+            self.close()
+        except socket.error:
+            self.nb_send_errors += 1
+            self.close()
+        return False
+
+    def new_chunk_option(self, size):
+        option = {'size': size}
+        if self.ack:
+            option['chunk'] = base64.b64encode(os.urandom(16)).decode('ASCII')
+        return option
+
+    def send_entries(self):
+        """Send the buffered entries as one frame, return the number of entries lost if it failed."""
+        import msgpack
+        if len(self.entries) == 0:
+            return 0
+        entries = b''.join(self.entries)
+        option = self.new_chunk_option(len(self.entries))
+        if self.mode == 'compressed':
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # gzip
+            entries = compressor.compress(entries) + compressor.flush()
+            option['compressed'] = 'gzip'
+        frame = msgpack.packb([self.tag, entries, option], use_bin_type=True)
+        nb_entries = len(self.entries)
+        self.entries = []
+        self.first_entry_time = None
+        return 0 if self.send_frame(frame, option.get('chunk')) else nb_entries
 
+    def write(self, eps, override_buffer=None):
+        import msgpack
         if override_buffer is not None:
             self.msg = override_buffer
-            self.msgpack_msg = msgpack.packb((self.tag, int(time.time()), self.msg), **{})
 
-        for i in range(eps):
-            self.fluent_sender._send_internal(self.msgpack_msg)
+        now = time.time()
+        bodies = [body.decode('utf-8', 'replace') for _, _, _, body in self.corpus_records(eps)] \
+            if self.corpus is not None else [self.msg] * eps
+        # buffered entries are credited when written, and taken back when their chunk fails
+        sent = len(bodies)
+        for body in bodies:
+            record = {'message': '%s %s' % (self.stamp(self.index, now), body)}
+            self.index += self.index_step
+            if self.mode == 'message':
+                frame = [self.tag, int(now), record]
+                chunk_id = None
+                if self.ack:
+                    chunk_id = self.new_chunk_option(1)['chunk']
+                    frame.append({'chunk': chunk_id})
+                if not self.send_frame(msgpack.packb(frame, use_bin_type=True), chunk_id):
+                    sent -= 1
+                continue
+            self.entries.append(msgpack.packb([int(now), record], use_bin_type=True))
+            if self.first_entry_time is None:
+                self.first_entry_time = now
+            if len(self.entries) >= self.chunk_size:
+                sent -= self.send_entries()
+        if self.first_entry_time is not None and now - self.first_entry_time >= self.flush_interval:
+            sent -= self.send_entries()
+        return sent
+
+    def flush(self):
+        lost = self.send_entries()
+        self.close()
+        return lost
+
+    def get_stats(self):
+        return {'frames': self.nb_frames, 'bytes': self.nb_bytes, 'connections': self.nb_connections,
+                'send_errors': self.nb_send_errors, 'ack_timeouts': self.nb_ack_timeouts,
+                'ack_wait': round(self.ack_wait, 6), 'max_ack_wait': round(self.max_ack_wait, 6)}
 
 
 class TailFileWriter(OutputWriter):
-    def __init__(self, tag, path, msg_size):
+    """Append events to the files followed by in_tail.
+
+    Events are spread round robin across `nb_files` files, <name>.<n><ext> when there is more than one
+    (see get_glob for the in_tail path). Every `rotate_every` seconds each file is rotated to <path>.1,
+    either by 'rename' (a new file is created by the next write) or by 'copytruncate' (copied, then
+    truncated in place). Rotations of the files are staggered over the period. With `partial_lines`,
+    the second half of the last line of every flush is held back until the next flush of that file,
+    so in_tail reads lines split across reads.
+    """
+    ROTATIONS = ['none', 'rename', 'copytruncate']
+
+    def __init__(self, tag, path, msg_size, rotation='none', rotate_every=60, nb_files=1, partial_lines=False):
         OutputWriter.__init__(self, 'file', tag, path, msg_size)
+        if rotation not in self.ROTATIONS:
+            raise ValueError("Unknown tail rotation '%s', available rotations: %s" %
+                             (rotation, ', '.join(self.ROTATIONS)))
+        self.corpus_kind = 'file'
         self.max_file_size = 10 * 1024 * 1024 * 1024  # 10 GB
+        self.rotation = rotation
+        self.rotate_every = rotate_every
+        self.nb_files = max(1, nb_files)
+        self.partial_lines = partial_lines
+        self.paths = None
+        self.files = {}
+        self.file_sizes = {}
+        self.pending = {}
+        self.next_rotations = None
+        self.nb_rotations = 0
+        self.nb_partial_writes = 0
+        self.nb_bytes = 0
 
     def get_protocol(self):
         return 'file'
 
+    def is_single_file(self, index_step):
+        # shards of --workers write to their own files when they would interleave partial lines
+        return self.nb_files == 1 and (index_step == 1 or not self.partial_lines)
+
+    def get_paths(self):
+        if self.paths is None:
+            if self.is_single_file(self.index_step):
+                self.paths = [self.path]
+            else:
+                stem, ext = os.path.splitext(self.path)
+                shard = self.index % self.index_step
+                self.paths = ['%s.%d%s' % (stem, shard * self.nb_files + n, ext) for n in range(self.nb_files)]
+        return self.paths
+
+    def get_glob(self, nb_workers=0):
+        """Return the in_tail path matching the files written by this writer, or by its `nb_workers` shards."""
+        if self.is_single_file(self.index_step * max(1, nb_workers)):
+            return self.path
+        stem, ext = os.path.splitext(self.path)
+        return '%s.*%s' % (stem, ext)
+
+    def get_file(self, path):
+        f = self.files.get(path)
+        if f is None:
+            f = open(path, 'ab', 0)
+            self.files[path] = f
+            self.file_sizes[path] = os.fstat(f.fileno()).st_size
+        return f
+
+    def write_file(self, path, data):
+        f = self.get_file(path)
+        if self.file_sizes[path] + len(data) > self.max_file_size:
+            os.ftruncate(f.fileno(), 0)
+            self.file_sizes[path] = 0
+        f.write(data)
+        self.file_sizes[path] += len(data)
+        self.nb_bytes += len(data)
+
+    def rotate(self, path):
+        # complete the held back line first, as a logger does before rotating
+        self.write_file(path, self.pending.pop(path, b''))
+        if self.rotation == 'rename':
+            self.files.pop(path).close()
+            os.rename(path, path + '.1')
+        else:
+            shutil.copyfile(path, path + '.1')
+            os.ftruncate(self.files[path].fileno(), 0)
+            self.file_sizes[path] = 0
+        self.nb_rotations += 1
+
+    def rotate_due_files(self):
+        now = monotonic()
+        paths = self.get_paths()
+        if self.next_rotations is None:
+            self.next_rotations = [now + self.rotate_every * (1 + float(n) / len(paths)) for n in range(len(paths))]
+        for n, path in enumerate(paths):
+            if now >= self.next_rotations[n]:
+                self.rotate(path)
+                self.next_rotations[n] += self.rotate_every
+
     def write(self, eps, override_buffer=None):
         if override_buffer is not None:
             self.msg = override_buffer
 
-        if os.path.exists(self.path):
-            if os.stat(self.path).st_size > self.max_file_size:
-                with open(self.path, "w"):
-                    pass
-        self.write_in_tail(self.msg, self.path, eps)
+        if self.rotation != 'none':
+            self.rotate_due_files()
+        self.write_in_tail(self.msg, eps)
+        return eps
+
+    def write_in_tail(self, line, num_lines=1):
+        paths = self.get_paths()
+        lines = dict((path, []) for path in paths)
+        now = time.time()
+        bodies = [body.decode('utf-8', 'replace') for _, _, _, body in self.corpus_records(num_lines)] \
+            if self.corpus is not None else [line] * num_lines
+        for body in bodies:
+            # multi-line corpus records (stack traces) are written as is, for in_tail multiline parsers
+            path = paths[(self.index // self.index_step) % len(paths)]
+            lines[path].append(('%s %s\n' % (self.stamp(self.index, now), body)).encode('utf-8'))
+            self.index += self.index_step
+        for path, path_lines in lines.items():
+            if len(path_lines) == 0:
+                continue
+            data = self.pending.pop(path, b'') + b''.join(path_lines)
+            if self.partial_lines:
+                held_back = len(path_lines[-1]) // 2
+                self.pending[path] = data[len(data) - held_back:]
+                data = data[:len(data) - held_back]
+                self.nb_partial_writes += 1
+            self.write_file(path, data)
+
+    def flush(self):
+        for path, data in list(self.pending.items()):
+            self.write_file(path, data)
+        self.pending = {}
+        for f in self.files.values():
+            f.close()
+        self.files = {}
+        return 0
 
-    def write_in_tail(self, line, path, num_lines=1):
-        lines = []
-        for i in range(num_lines):
-            lines.append('%d-%s-%s\n' % (self.index, self.get_name(), line))
-            self.index += 1
-        with open(path, "a") as myfile:
-            myfile.writelines(lines)
+    def get_stats(self):
+        return {'files': len(self.get_paths()), 'rotations': self.nb_rotations, 'bytes': self.nb_bytes,
+                'partial_writes': self.nb_partial_writes}
+
+
+def read_pos_file(path):
+    """Entries of an in_tail position file: '<path>\\t<position>\\t<inode>', in hexadecimal.
+
+    Entries of files no longer followed keep the UNWATCHED_POSITION until PositionFile.compact
+    removes them, so their number shows the position file churn caused by rotations.
+    """
+    stats = {'entries': 0, 'unwatched': 0, 'bytes': 0}
+    if not os.path.exists(path):
+        return stats
+    with open(path) as f:
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) != 3:
+                continue
+            stats['entries'] += 1
+            if fields[1] == 'ffffffffffffffff':
+                stats['unwatched'] += 1
+    stats['bytes'] = os.path.getsize(path)
+    return stats
+
+
+def rfc5424_isotime(created):
+    isotime = datetime.fromtimestamp(created).isoformat()
+    tz = re.match(r'([+-]\d{2})(\d{2})$', time.strftime('%z'))
+    if time.timezone and tz:
+        (offset_hrs, offset_min) = tz.groups()
+        if int(offset_hrs) == 0 and int(offset_min) == 0:
+            isotime = isotime + 'Z'
+        else:
+            isotime = '{0}{1}:{2}'.format(isotime, offset_hrs, offset_min)
+    else:
+        isotime = isotime + 'Z'
+    return isotime
 
 
 class RFC5424Formatter(logging.Formatter, object):
     def __init__(self, *args, **kwargs):
-        self._tz_fix = re.compile(r'([+-]\d{2})(\d{2})$')
         super(RFC5424Formatter, self).__init__(*args, **kwargs)
 
     def format(self, record):
         record.__dict__['hostname'] = gethostname()
-        isotime = datetime.fromtimestamp(record.created).isoformat()
-        tz = self._tz_fix.match(time.strftime('%z'))
-        if time.timezone and tz:
-            (offset_hrs, offset_min) = tz.groups()
-            if int(offset_hrs) == 0 and int(offset_min) == 0:
-                isotime = isotime + 'Z'
-            else:
-                isotime = '{0}{1}:{2}'.format(isotime, offset_hrs, offset_min)
-        else:
-            isotime = isotime + 'Z'
-
-        record.__dict__['isotime'] = isotime
+        record.__dict__['isotime'] = rfc5424_isotime(record.created)
         header = '1 {isotime} {hostname} {module} {process} - - '.format(**record.__dict__)
         body = super(RFC5424Formatter, self).format(record)
         return (header + body).encode('utf-8')
@@ -311,7 +1677,8 @@ class MySysLogHandler(SysLogHandler):
             msg = self.format(record)
 
             if self.include_priority:
-                msg = '<%d>%s' % (self.encodePriority(self.facility, self.mapPriority(record.levelname)), msg)
+                priority = '<%d>' % self.encodePriority(self.facility, self.mapPriority(record.levelname))
+                msg = priority.encode('ASCII') + msg
 
             if self.unixsocket:
                 try:
@@ -330,8 +1697,209 @@ class MySysLogHandler(SysLogHandler):
             self.handleError(record)
 
 
+class SyslogFrameRenderer:
+    """Render syslog frames without going through logging.Logger.
+
+    The hostname is resolved once and the priority/timestamp/hostname header is rebuilt only when
+    the second changes, so the per-event cost is a single bytes concatenation of the sequence number.
+    Corpus records carry their own priority and app name: their headers are cached per
+    (priority, app name) for the current second.
+    """
+    FORMATS = ['rfc3164', 'rfc5424', 'cef']
+
+    def __init__(self, syslog_format, app_name, body, facility=SysLogHandler.LOG_USER,
+                 severity=SysLogHandler.LOG_INFO):
+        if syslog_format not in self.FORMATS:
+            raise ValueError("Unknown syslog format '%s', available formats: %s" %
+                             (syslog_format, ', '.join(self.FORMATS)))
+        self.syslog_format = syslog_format
+        self.app_name = app_name
+        self.hostname = gethostname()
+        self.pid = os.getpid()
+        self.priority = (facility << 3) | severity
+        self.body = (' %s\n' % body).encode('ASCII', 'ignore')
+        self.header_second = None
+        self.headers = {}
+
+    def get_header(self, now, priority=None, app_name=None):
+        second = int(now)
+        if second != self.header_second:
+            self.headers = {}
+            self.header_second = second
+        priority = self.priority if priority is None else priority
+        app_name = app_name or self.app_name
+        header = self.headers.get((priority, app_name))
+        if header is None:
+            if self.syslog_format == 'rfc5424':
+                header = '<%d>1 %s %s %s %d - - ' % (priority, rfc5424_isotime(second), self.hostname,
+                                                     app_name, self.pid)
+            elif self.syslog_format == 'cef':
+                header = '<%d>%s %s CEF: ' % (priority, datetime.fromtimestamp(second).strftime("%b %d %H:%M:%S"),
+                                              self.hostname)
+            else:
+                header = '<%d>%s %s %s[%d]: ' % (priority, datetime.fromtimestamp(second).strftime("%b %d %H:%M:%S"),
+                                                 self.hostname, app_name, self.pid)
+            header = header.encode('ASCII', 'ignore')
+            self.headers[(priority, app_name)] = header
+        return header
+
+    def render(self, first_index, index_step, count, now=None):
+        now = time.time() if now is None else now
+        header = self.get_header(now)
+        # the whole batch shares one send timestamp, see OutputWriter.stamp
+        body = (' ts=%.6f' % now).encode('ASCII') + self.body
+        return [b''.join((header, b'idx=', str(first_index + i * index_step).encode('ASCII'), body))
+                for i in range(count)]
+
+    def render_records(self, first_index, index_step, records, name, now=None):
+        """Render one frame per (facility, severity, app name, body) corpus record."""
+        now = time.time() if now is None else now
+        stamp = (' ts=%.6f %s ' % (now, name)).encode('ASCII')
+        frames = []
+        for i, (facility, severity, app_name, body) in enumerate(records):
+            frames.append(b''.join((self.get_header(now, (facility << 3) | severity, app_name), b'idx=',
+                                    str(first_index + i * index_step).encode('ASCII'), stamp, body, b'\n')))
+        return frames
+
+
+class SyslogSender:
+    """Send pre-rendered syslog frames over a pool of persistent connections.
+
+    Datagram sockets are connected once so each frame is a plain send(). Each batch is split across
+    the `pool_size` connections of stream sockets (TCP, or unix sockets not accepting datagrams),
+    which are written without blocking: short writes count as partial writes, and EAGAIN as a
+    backpressure stall that waits for the socket to be writable again. With 'octet' framing, stream
+    frames are sent as '<length> <message>' (RFC 6587 octet counting) instead of newline terminated.
+    A connection that fails is closed and re-opened on its next batch.
+
+    The in_syslog of the fluentd 0.12 bundled with omsagent only splits TCP input on newlines: 'octet'
+    framing is for receivers supporting octet counting (rsyslog imtcp, fluentd 1.x frame_type
+    octet_count), not for the agent's own syslog port.
+    """
+    FRAMINGS = ['lf', 'octet']
+
+    def __init__(self, address, protocol, pool_size=1, framing='lf', stall_timeout=30.0):
+        if framing not in self.FRAMINGS:
+            raise ValueError("Unknown syslog framing '%s', available framings: %s" %
+                             (framing, ', '.join(self.FRAMINGS)))
+        self.address = address
+        self.protocol = protocol.lower()
+        self.pool_size = max(1, pool_size)
+        self.framing = framing
+        self.stall_timeout = stall_timeout
+        self.sockets = [None] * self.pool_size
+        self.is_stream = False
+        self.send_errors = 0
+        self.reconnects = 0
+        self.partial_writes = 0
+        self.stalls = 0
+        self.stall_time = 0.0
+        self.max_stall = 0.0
+
+    def connect(self, slot=0):
+        if self.protocol == 'unix':
+            try:
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+                sock.connect(self.address)
+            except socket.error:
+                sock.close()
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.connect(self.address)
+        elif self.protocol == 'tcp':
+            sock = socket.create_connection(self.address)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        else:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.connect(self.address)
+        self.is_stream = sock.type == socket.SOCK_STREAM
+        if self.is_stream:
+            sock.setblocking(False)
+        if self.sockets[slot] is False:
+            self.reconnects += 1
+        self.sockets[slot] = sock
+        return sock
+
+    def close(self, slot=None):
+        for n in range(self.pool_size) if slot is None else [slot]:
+            if self.sockets[n]:
+                self.sockets[n].close()
+                # False marks a slot whose next connection is a reconnect
+                self.sockets[n] = False
+
+    def frame(self, frames):
+        if self.framing == 'octet':
+            # the frames are rendered newline terminated, the length prefix replaces the trailer
+            return b''.join(('%d ' % (len(frame) - 1)).encode('ascii') + frame[:-1] for frame in frames)
+        return b''.join(frames)
+
+    def wait_writable(self, sock):
+        start = monotonic()
+        _, writable, _ = select.select([], [sock], [], self.stall_timeout)
+        stall = monotonic() - start
+        self.stalls += 1
+        self.stall_time += stall
+        self.max_stall = max(self.max_stall, stall)
+        if not writable:
+            raise socket.error(errno.ETIMEDOUT, 'in_syslog did not read for %.0f s' % self.stall_timeout)
+
+    def send_stream(self, sock, data):
+        view = memoryview(data)
+        while len(view) > 0:
+            try:
+                sent = sock.send(view)
+            except socket.error as e:
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+                self.wait_writable(sock)
+                continue
+            if sent < len(view):
+                self.partial_writes += 1
+            view = view[sent:]
+
+    def send_frames(self, frames):
+        """Send `frames`, return the number of frames sent: a slice is dropped from its first failed send."""
+        if not self.sockets[0]:
+            # the first connection tells whether the pool is made of stream sockets, the others are
+            # opened on their first slice below
+            try:
+                self.connect(0)
+            except socket.error:
+                self.send_errors += 1
+                self.sockets[0] = False
+                return 0
+        slices = [frames]
+        if self.is_stream and self.pool_size > 1:
+            size = int(math.ceil(len(frames) / float(self.pool_size)))
+            slices = [frames[n * size:(n + 1) * size] for n in range(self.pool_size)]
+        nb_sent = 0
+        for slot, slot_frames in enumerate(slices):
+            if len(slot_frames) == 0:
+                continue
+            try:
+                sock = self.sockets[slot] or self.connect(slot)
+                if self.is_stream:
+                    self.send_stream(sock, self.frame(slot_frames))
+                    nb_sent += len(slot_frames)
+                else:
+                    send = sock.send
+                    for frame in slot_frames:
+                        send(frame)
+                        nb_sent += 1
+            except socket.error:
+                # the receiver went away (agent restart, socket re-created): count it and reconnect on the next batch
+                self.send_errors += 1
+                self.close(slot)
+        return nb_sent
+
+    def get_stats(self):
+        return {'connections': self.pool_size if self.is_stream else 1, 'reconnects': self.reconnects,
+                'send_errors': self.send_errors, 'partial_writes': self.partial_writes, 'stalls': self.stalls,
+                'stall_time': round(self.stall_time, 6), 'max_stall': round(self.max_stall, 6)}
+
+
 class SyslogWriter(OutputWriter):
-    def __init__(self, tag, path, msg_size, protocol="udp"):
+    def __init__(self, tag, path, msg_size, protocol="udp", syslog_format='rfc3164', send_path='fast',
+                 connections=1, framing='lf'):
         OutputWriter.__init__(self, 'syslog', tag, path, msg_size)
         self.host = None
         self.port = None
@@ -342,6 +1910,12 @@ class SyslogWriter(OutputWriter):
         self.protocol = protocol
         self.logger = None
         self.include_counter = True
+        self.syslog_format = syslog_format
+        self.fast_path = (send_path == 'fast')
+        self.renderer = None
+        self.sender = None
+        self.connections = connections
+        self.framing = framing
 
     def get_address(self):
         return self.path if self.is_unix_socket else (self.host, self.port)
@@ -352,7 +1926,10 @@ class SyslogWriter(OutputWriter):
     def get_syslog_handler(self, address, socktype):
         syslog_handler = MySysLogHandler(address=address, socktype=socktype)
         syslog_handler.include_priority = True
-        syslog_handler.setFormatter(RFC3164Formatter())  # fluentd uses rfc3164 by default
+        if self.syslog_format == 'rfc5424':
+            syslog_handler.setFormatter(RFC5424Formatter())
+        else:
+            syslog_handler.setFormatter(RFC3164Formatter())  # fluentd uses rfc3164 by default
         return syslog_handler
 
     def get_logger(self):
@@ -383,26 +1960,54 @@ class SyslogWriter(OutputWriter):
                 break
         return dropped_events
 
+    def get_renderer(self):
+        if self.renderer is None:
+            self.renderer = SyslogFrameRenderer(self.syslog_format, 'omstest', '%s %s' % (self.get_name(), self.msg))
+        return self.renderer
+
+    def get_sender(self):
+        if self.sender is None:
+            self.sender = SyslogSender(self.get_address(), self.protocol, self.connections, self.framing)
+        return self.sender
+
+    def get_stats(self):
+        return self.sender.get_stats() if self.sender is not None else {}
+
     def write(self, eps, override_buffer=None):
         if override_buffer is not None:
             self.msg = override_buffer
+            self.renderer = None
+
+        if self.fast_path and self.include_counter:
+            if self.corpus is not None:
+                frames = self.get_renderer().render_records(self.index, self.index_step, self.corpus_records(eps),
+                                                            self.get_name())
+            else:
+                frames = self.get_renderer().render(self.index, self.index_step, eps)
+            self.index += eps * self.index_step
+            return self.get_sender().send_frames(frames)
 
         logger = self.get_logger()
-        for i in range(eps):
-            message = 'idx=%d %s %s' % (self.index, self.get_name(), self.msg) if self.include_counter else self.msg
+        bodies = [body.decode('utf-8', 'replace') for _, _, _, body in self.corpus_records(eps)] \
+            if self.corpus is not None else [self.msg] * eps
+        for msg in bodies:
+            message = '%s %s' % (self.stamp(self.index, time.time()), msg) if self.include_counter else msg
             message += '\n'
             # print(message)
             logger.log(logging.INFO, message)
-            self.index += 1
+            self.index += self.index_step
+        # SysLogHandler reports its send errors through handleError, not to the caller
+        return len(bodies)
 
 
 class CEFWriter(SyslogWriter):
     CEF_SAMPLE = '0|omsagent-loadtest|PAN-OS|8.0.0|general|SYSTEM|3|rt=Nov 04 2018 07:15:46 GMT deviceExternalId=unknown cs3Label=Virtual System cs3= fname= flexString2Label=Module flexString2=general msg= Failed password for root from 116.31.116.38 port 63605 ssh2 externalId=5705651 cat=general PanOSDGl1=0 PanOSDGl2=0 PanOSDGl3=0 PanOSDGl4=0 PanOSVsysName= dvchost=palovmfw PanOSActionFlags=0x0'
 
-    def __init__(self, tag, path, msg_size, protocol):
-        SyslogWriter.__init__(self, tag, path, msg_size, protocol)
+    def __init__(self, tag, path, msg_size, protocol, send_path='fast', connections=1, framing='lf'):
+        SyslogWriter.__init__(self, tag, path, msg_size, protocol, 'cef', send_path, connections, framing)
         self.include_counter = True
         self.name = 'syslog_cef'
+        self.corpus_kind = 'cef'
         self.msg = self.CEF_SAMPLE
 
     def get_syslog_handler(self, address, socktype):
@@ -415,6 +2020,140 @@ class TcpWriter(SyslogWriter):
         SyslogWriter.__init__(self, tag, path, msg_size, 'tcp')
         self.name = 'tcp'
 
+class OpenLoopScheduler:
+    """Spread `eps` events evenly over each second using fixed monotonic-clock deadlines.
+
+    The deadline of every batch is computed from the start of the run and never from the end of the
+    previous send, so a slow writer or profiler shows up as send lag and backlog instead of silently
+    lowering the rate (coordinated omission).
+    """
+    def __init__(self, eps, run_time, tick=0.001):
+        self.eps = eps
+        self.total_events = eps * run_time
+        # smallest number of events per batch so that batches are not scheduled more often than `tick`
+        self.batch_size = max(1, int(math.ceil(eps * tick)))
+        self.start_time = None
+        self.end_time = None
+        # events scheduled so far (the deadlines follow them) and events the writers actually sent
+        self.nb_events = 0
+        self.nb_sent = 0
+        self.lags = new_samples(10 ** 6)
+        self.interval_max_lag = 0
+        self.max_backlog = 0
+
+    def start(self):
+        self.start_time = monotonic()
+        self.nb_events = 0
+        self.nb_sent = 0
+        return self.start_time
+
+    def done(self):
+        return self.nb_events >= self.total_events
+
+    def next_deadline(self):
+        return self.start_time + self.nb_events / float(self.eps)
+
+    def wait_next_batch(self):
+        """Sleep until the deadline of the next batch, return (batch size, lag in seconds)."""
+        deadline = self.next_deadline()
+        now = monotonic()
+        if now < deadline:
+            time.sleep(deadline - now)
+            now = monotonic()
+        lag = now - deadline
+        backlog = int((now - self.start_time) * self.eps) - self.nb_events
+        self.max_backlog = max(self.max_backlog, backlog)
+        return min(self.batch_size, self.total_events - self.nb_events), lag
+
+    def record(self, count, lag, sent=None):
+        """Account a batch of `count` scheduled events, `sent` of them (default: all) actually sent."""
+        self.nb_events += count
+        self.nb_sent += count if sent is None else sent
+        self.lags.append(lag)
+        self.interval_max_lag = max(self.interval_max_lag, lag)
+        self.end_time = monotonic()
+
+    def pop_interval_max_lag(self):
+        lag, self.interval_max_lag = self.interval_max_lag, 0
+        return lag
+
+    def elapsed(self):
+        return (self.end_time or monotonic()) - self.start_time
+
+    def achieved_eps(self):
+        elapsed = self.elapsed()
+        return self.nb_sent / elapsed if elapsed > 0 else 0
+
+    def stats(self):
+        stats = {
+            'target_eps': self.eps,
+            'achieved_eps': round(self.achieved_eps(), 2),
+            'elapsed_time': round(self.elapsed(), 3),
+            'batch_size': self.batch_size,
+            'max_backlog': self.max_backlog,
+        }
+        stats.update(lag_stats(self.lags))
+        return stats
+
+
+def merge_send_stats(stats_list, lags=None):
+    """Merge the send statistics of concurrent writer processes.
+
+    Rates, events and backlogs add up. Lags are computed from the merged lag samples when given,
+    otherwise they keep the worst value of any shard.
+    """
+    merged = {'target_eps': 0, 'achieved_eps': 0, 'elapsed_time': 0, 'nb_events': 0, 'send_failed': 0,
+              'avg_lag': 0, 'p50_lag': 0, 'p99_lag': 0, 'max_lag': 0, 'max_backlog': 0}
+    for stats in stats_list:
+        for name in ['target_eps', 'achieved_eps', 'nb_events', 'send_failed', 'max_backlog']:
+            merged[name] += stats.get(name, 0)
+        for name in ['elapsed_time', 'avg_lag', 'p50_lag', 'p99_lag', 'max_lag']:
+            merged[name] = max(merged[name], stats.get(name, 0))
+    merged['achieved_eps'] = round(merged['achieved_eps'], 2)
+    if lags is not None:
+        merged.update(lag_stats(lags))
+    return merged
+
+
+def merge_writer_stats(stats_list):
+    merged = {}
+    for stats in stats_list:
+        for name, value in stats.items():
+            merged[name] = max(merged.get(name, 0), value) if name.startswith('max_') else merged.get(name, 0) + value
+    return merged
+
+
+def shard_eps(eps, nb_shards):
+    shares = [eps // nb_shards] * nb_shards
+    for i in range(eps % nb_shards):
+        shares[i] += 1
+    return shares
+
+
+def run_writer_shard(shard):
+    """Entry point of a writer process: drive one plugin at its share of the EPS."""
+    config_mgr = ConfigManager(shard['constants'])
+    writer = config_mgr.get_writers_by_name([shard['plugin']])[0]
+    host_index, nb_hosts = parse_host_shard(shard['constants'])
+    writer.set_sequence(host_index * shard['nb_shards'] + shard['shard'], nb_hosts * shard['nb_shards'])
+    scheduler = OpenLoopScheduler(shard['eps'], shard['run_time'], shard['tick'])
+    scheduler.start()
+    while not scheduler.done():
+        count, lag = scheduler.wait_next_batch()
+        scheduler.record(count, lag, writer.write(eps=count))
+    scheduler.nb_sent -= writer.flush()
+    stats = scheduler.stats()
+    stats['nb_events'] = scheduler.nb_sent
+    stats['sequences'] = [writer.get_sequence()]
+    # numbered events the writer failed to send, which the stand-in would otherwise count as lost
+    stats['send_failed'] = writer.get_sequence()[2] - scheduler.nb_sent
+    stats['writer'] = writer.get_stats()
+    stats['plugin'] = shard['plugin']
+    stats['shard'] = shard['shard']
+    stats['lags'] = scheduler.lags.to_dict()
+    return stats
+
+
 class ProcessWrapper:
     def __init__(self, cmd_fmt, cmd_args):
         self.cmd_fmt = cmd_fmt
@@ -425,7 +2164,7 @@ class ProcessWrapper:
 
     def start_process(self, envs=None, wait_for_steady_stat=1):
         envs_str = {}
-        for name, val in envs.iteritems():
+        for name, val in envs.items():
             envs_str[name] = str(val)
         popen = subprocess.Popen(self.get_cmd().split(' '), close_fds=True, env=envs_str)
         time.sleep(wait_for_steady_stat)
@@ -450,13 +2189,31 @@ class ConfigManager:
         self.constants['dummy_event'] = build_random_msg_string(self.event_size)
 
         self.available_writers = [
-            SyslogWriter(self.tag, self.SYSLOG_PATH, self.event_size, constants['syslog_protocol']),
-            CEFWriter(self.tag, self.SYSLOG_PATH, self.event_size, constants['syslog_protocol']),
-            TailFileWriter(self.tag, self.TAIL_PATH, self.event_size),
-            MsgPackWriter(self.tag, self.FLUENT_PATH, self.event_size),
+            SyslogWriter(self.tag, self.SYSLOG_PATH, self.event_size, constants['syslog_protocol'],
+                         constants['syslog_format'], constants['syslog_send_path'],
+                         int(constants['syslog_connections']), constants['syslog_framing']),
+            CEFWriter(self.tag, self.SYSLOG_PATH, self.event_size, constants['syslog_protocol'],
+                      constants['syslog_send_path'], int(constants['syslog_connections']),
+                      constants['syslog_framing']),
+            TailFileWriter(self.tag, self.TAIL_PATH, self.event_size, constants['tail_rotation'],
+                           float(constants['tail_rotate_every']), int(constants['tail_files']),
+                           constants['tail_partial_lines'] == 'yes'),
+            MsgPackWriter(self.tag, self.FLUENT_PATH, self.event_size, constants['forward_mode'],
+                          int(constants['forward_chunk_size']), float(constants['forward_flush_interval']),
+                          constants['forward_ack'] == 'yes'),
             # TcpWriter(self.tag, self.SYSLOG_PATH, self.event_size)
         ]
 
+        host_index, nb_hosts = parse_host_shard(constants)
+        for writer in self.available_writers:
+            writer.set_sequence(host_index, nb_hosts)
+
+        self.corpus = None
+        if constants.get('corpus_path'):
+            self.corpus = WorkloadCorpus(constants['corpus_path'])
+            for writer in self.available_writers:
+                writer.set_corpus(self.corpus)
+
     def get_writers_by_name(self, names):
         writers = []
 
@@ -476,13 +2233,20 @@ class LoadBench:
         self.sampling_rate = sampling_rate
         self.config_mgr = config_mgr
         self.do_profiling = True
+        self.send_tick = 0.001
+        self.sampler = 'process'
+        self.workers = 0
+        self.send_stats = {}
         self.test_status_path = os.path.join(os.path.dirname(self.config_mgr.constants['result_path']), 'status.txt')
+        self.stream = ResultStream(os.path.splitext(self.config_mgr.constants['result_path'])[0] + '.ndjson')
+        self.run_context = {}
+        self.agent_version = get_agent_version()
 
         self.reset_workspace()
 
     @staticmethod
     def get_pids(name):
-        return map(int, subprocess.check_output(["pidof", name]).split())
+        return [int(pid) for pid in subprocess.check_output(["pidof", name]).split()]
 
     def save_test_status(self, context, elapsed_seconds, sampling):
         lines = []
@@ -491,24 +2255,40 @@ class LoadBench:
             lines.append('status_time   : %s\n' % datetime.now().time())
             lines.append('elapsed_time  : %d seconds\n' % elapsed_seconds)
             lines.append('--------------- Configuration ----------------\n')
-            for name, value in self.config_mgr.constants.iteritems():
+            for name, value in self.config_mgr.constants.items():
                 lines.append("%s\t\t\t: %s\n" % (name, value))
             lines.append('--------------- Test dir ----------------\n')
             listing_files = 'ls -la %s' % self.config_mgr.TESTING_FOLDER_PATH
             content = subprocess.Popen(listing_files.split(' '), stdout=subprocess.PIPE,
-                                       stderr=subprocess.STDOUT).stdout.readlines()
+                                       stderr=subprocess.STDOUT, universal_newlines=True).stdout.readlines()
             lines += content
             lines.append('--------------- Sampling ------------------\n')
-            lines.append('sampling\t: %s\n' % json.dumps(sampling, ensure_ascii=True))
+            lines.append('sampling\t: %s\n' % json.dumps(sampling, ensure_ascii=True, default=samples_to_json))
             f.writelines(lines)
 
     def reset_workspace(self):
-        os.system("mkdir -p %s" % self.config_mgr.TESTING_FOLDER_PATH)
-        os.system("sudo chmod 777 -R  %s" % self.config_mgr.TESTING_FOLDER_PATH)
-        os.system("sudo rm -rf %s/* " % self.config_mgr.TESTING_FOLDER_PATH)
+        test_dir = self.config_mgr.TESTING_FOLDER_PATH
+        make_dirs(test_dir)
+        subprocess.call(['sudo', 'chmod', '777', '-R', test_dir])
+        entries = glob.glob(os.path.join(test_dir, '*'))
+        if entries:
+            subprocess.call(['sudo', 'rm', '-rf', '--'] + entries)
 
     def run_load(self, eps, processes, writers):
-                return self.run_load_for_duration(eps, processes, writers, self.run_time, self.sampling_rate)
+        return self.run_load_for_duration(eps, processes, writers, self.run_time, self.sampling_rate)
+
+    def run_plugins(self, eps, processes, plugins, writers=None):
+        """Run the load for `plugins`, from this process or sharded across `self.workers` processes."""
+        if self.workers > 0:
+            result = self.run_load_with_workers(eps, processes, plugins, self.workers)
+        else:
+            if writers is None:
+                writers = self.config_mgr.get_writers_by_name(plugins)
+            result = self.run_load(eps, processes, writers)
+        pos_file = self.config_mgr.constants['tail_pos_file']
+        if pos_file and 'file' in plugins:
+            self.send_stats['tail_pos_file'] = read_pos_file(pos_file)
+        return result
 
     def clear_dead_process(self, processes):
         terminated_processes = []
@@ -520,51 +2300,177 @@ class LoadBench:
             processes.remove(p)
         return processes
 
+    def begin_run(self, eps, plugins):
+        start_time = time.time()
+        self.run_context = {'run': '%s-%d' % (gethostname(), int(start_time * 1000)), 'host': gethostname(),
+                            'plugins': '|'.join(plugins), 'eps': eps, 'start_time': round(start_time, 3),
+                            'agent_version': self.agent_version,
+                            'event_size': int(self.config_mgr.constants['event_size'])}
+        if self.config_mgr.corpus is not None:
+            self.run_context['corpus'] = self.config_mgr.corpus.path
+
+    def stream_interval(self, profiler, scheduler=None, sent=None, writers=()):
+        """Stream the latest sample of every process, and the send progress, as one NDJSON record.
+
+        `sent` maps plugins to the events sent so far; the socket drops of `writers` are read with them.
+        """
+        record = dict(self.run_context)
+        record['type'] = 'interval'
+        record['time'] = round(time.time(), 3)
+        if scheduler is not None:
+            record['nb_events'] = scheduler.nb_sent
+            record['max_lag'] = round(scheduler.pop_interval_max_lag(), 6)
+        if sent is not None:
+            record['sent'] = dict(sent)
+        if writers:
+            record['drops'] = dict((writer.get_name(), writer.get_number_dropped_event()) for writer in writers)
+        record['processes'] = {}
+        for key, sampling in list(profiler.items()):
+            record['processes'][key] = {
+                'cpu': sampling['cpu'].last, 'mem': sampling['mem'].last,
+                'minor_flt': sampling['minor_flt'].last, 'major_flt': sampling['major_flt'].last,
+                'threads': dict((tid, samples.last) for tid, samples in list(sampling['threads'].items())),
+            }
+        self.stream.write(record)
+
     def run_load_for_duration(self, eps, processes, writers, run_time, sampling_rate):
-        total_events = run_time * eps
-        response_times = [0]
-        nb_events = 0
-        profile_diff_time = 0
         profiler = {}
-
-        if self.do_profiling:
-            processes, profiler = profile(processes, profiler)
-
-        elapsed_time = 0.0
-        last_profile_time = 0.0
-        while nb_events < total_events:
-            previous_elapsed_time = elapsed_time
-            begin_time = time.time()
+        # writers are reused from one run to the next (--find-max-eps steps): every run numbers its events
+        # from the start of the sequence, as the stand-in counts them once reset
+        for writer in writers:
+            writer.set_sequence(writer.first_index, writer.index_step)
+        scheduler = OpenLoopScheduler(eps, run_time, self.send_tick)
+        self.begin_run(eps, [writer.get_name() for writer in writers])
+        sampler = self.start_sampler(processes, sampling_rate)
+
+        # the scheduler paces every writer at `eps` and credits the events sent by all of them
+        sent = dict((writer.get_name(), 0) for writer in writers)
+        last_profile_time = scheduler.start()
+        last_warning_time = last_profile_time
+        # the first record is the baseline of the send counters and socket drops of the run
+        self.stream_interval(profiler, scheduler, sent, writers)
+        while not scheduler.done():
+            count, lag = scheduler.wait_next_batch()
+            batch_sent = 0
             for writer in writers:
-                writer.write(eps=eps)
-            nb_events += eps
-            diff_time = round(time.time() - begin_time, 1)
-            response_times.append(diff_time)
-
-            elapsed_time += (time.time() - begin_time)
-            if self.do_profiling:
-                begin_time = time.time()
-                if (elapsed_time - last_profile_time) >= sampling_rate:
-                    processes = self.clear_dead_process(processes)
-                    processes = find_children_processes(processes)
-                    processes, profiler = profile(processes, profiler)
-                    last_profile_time = elapsed_time
-                profile_diff_time = time.time() - begin_time
-                elapsed_time += profile_diff_time
-
-            # sleep the rest of the time to complete 1 second
-            sleep_time = 1 - diff_time - profile_diff_time - 0.05
-            if sleep_time > 0.05:
-                begin_time = time.time()
-                time.sleep(sleep_time)
-                elapsed_time += (time.time() - begin_time)
-
-            if round(elapsed_time - previous_elapsed_time, 2) > 1:
-                print('%s: Took more than 1s for %d EPS: total_time=%.3f s, resp_time=%.2f s, profile_time=%.2f s, '
-                      'sleep_time=%.2f s' % (datetime.now().time(), eps, elapsed_time - previous_elapsed_time,
-                                             diff_time, profile_diff_time, sleep_time))
-
-        self.save_test_status('done', elapsed_time, profiler)
+                writer_sent = writer.write(eps=count)
+                sent[writer.get_name()] += writer_sent
+                batch_sent += writer_sent
+            scheduler.record(count, lag, batch_sent)
+
+            now = monotonic()
+            if (now - last_profile_time) >= sampling_rate:
+                # samples are taken off the send loop, which only collects them and streams one record
+                # per interval, so the interval lag is read on the thread that records it
+                if sampler is not None:
+                    profiler = sampler.poll()
+                self.stream_interval(profiler, scheduler, sent, writers)
+                last_profile_time = now
+
+            if lag > 1 and (now - last_warning_time) >= 1:
+                total_eps = eps * len(writers)
+                print('%s: Sending is %.3f s behind schedule for %d EPS: backlog=%d events, achieved=%.1f EPS' %
+                      (datetime.now().time(), lag, total_eps, int(lag * total_eps), scheduler.achieved_eps()))
+                last_warning_time = now
+
+        for writer in writers:
+            lost = writer.flush()
+            sent[writer.get_name()] -= lost
+            scheduler.nb_sent -= lost
+        if sampler is not None:
+            profiler = sampler.stop()
+        schedule_stats = scheduler.stats()
+        elapsed = scheduler.elapsed()
+        plugins_stats = {}
+        for name, nb_sent in sent.items():
+            plugins_stats[name] = dict(schedule_stats, nb_events=nb_sent,
+                                       achieved_eps=round(nb_sent / elapsed if elapsed > 0 else 0, 2))
+        for writer in writers:
+            plugins_stats[writer.get_name()]['sequences'] = [writer.get_sequence()]
+            # numbered events the writer failed to send, which the stand-in would otherwise count as lost
+            plugins_stats[writer.get_name()]['send_failed'] = writer.get_sequence()[2] - sent[writer.get_name()]
+        self.send_stats = merge_send_stats(list(plugins_stats.values()))
+        self.send_stats['plugins'] = plugins_stats
+        self.send_stats['writers'] = dict((writer.get_name(), writer.get_stats()) for writer in writers
+                                          if writer.get_stats())
+        self.save_test_status('done', scheduler.elapsed(), profiler)
+        self.flush_processes(processes)
+
+        return profiler, scheduler.lags, self.send_stats['nb_events']
+
+    def run_load_with_workers(self, eps, processes, plugins, nb_workers):
+        """Shard `eps` of every plugin across `nb_workers` writer processes and merge their counters.
+
+        The parent process only profiles while the writers run, so the generator is no longer bound
+        to a single core.
+        """
+        profiler = {}
+        shards = []
+        for plugin in plugins:
+            for shard, shard_eps_value in enumerate(shard_eps(eps, nb_workers)):
+                if shard_eps_value > 0:
+                    shards.append({'constants': self.config_mgr.constants, 'plugin': plugin, 'eps': shard_eps_value,
+                                   'run_time': self.run_time, 'tick': self.send_tick, 'shard': shard,
+                                   'nb_shards': nb_workers})
+
+        self.begin_run(eps, plugins)
+        sampler = self.start_sampler(processes, self.sampling_rate)
+
+        start_time = monotonic()
+        pool = multiprocessing.Pool(len(shards))
+        try:
+            async_result = pool.map_async(run_writer_shard, shards)
+            while not async_result.ready():
+                async_result.wait(self.sampling_rate)
+                if sampler is not None:
+                    profiler = sampler.poll()
+                self.stream_interval(profiler)
+            shard_stats = async_result.get()
+        finally:
+            pool.close()
+            pool.join()
+            if sampler is not None:
+                profiler = sampler.stop()
+
+        lags = new_samples(10 ** 6)
+        self.send_stats = {'plugins': {}, 'writers': {}}
+        for plugin in plugins:
+            plugin_shards = [stats for stats in shard_stats if stats['plugin'] == plugin]
+            writer_stats = merge_writer_stats([stats.pop('writer') for stats in plugin_shards])
+            if writer_stats:
+                self.send_stats['writers'][plugin] = writer_stats
+            plugin_lags = new_samples(10 ** 6)
+            for stats in plugin_shards:
+                plugin_lags.merge(SampleSeries.from_dict(stats.pop('lags')))
+            plugin_stats = merge_send_stats(plugin_shards, plugin_lags)
+            plugin_stats['workers'] = nb_workers
+            plugin_stats['sequences'] = [sequence for stats in plugin_shards for sequence in stats.pop('sequences')]
+            self.send_stats['plugins'][plugin] = plugin_stats
+            lags.merge(plugin_lags)
+        self.send_stats.update(merge_send_stats(shard_stats, lags))
+        self.save_test_status('done', monotonic() - start_time, profiler)
+        self.flush_processes(processes)
+
+        return profiler, lags, self.send_stats['nb_events']
+
+    def start_sampler(self, processes, sampling_rate):
+        """Start the sampler of `self.sampler`, or return None without profiling.
+
+        Samplers run on their own clock; the send loop calls poll() once per sampling interval for the
+        samples taken so far, and streams them.
+        """
+        if not self.do_profiling:
+            return None
+        if self.sampler == 'process':
+            sampler = SamplerProcess([p.pid for p in processes], sampling_rate)
+        elif self.sampler == 'psutil':
+            sampler = PsutilSampler(processes, sampling_rate)
+        else:
+            sampler = ProcSampler([p.pid for p in processes], sampling_rate)
+        sampler.start()
+        return sampler
+
+    def flush_processes(self, processes):
         # wait more times for collecting more data
         # force flushing
         processes = self.clear_dead_process(processes)
@@ -572,29 +2478,42 @@ class LoadBench:
             if proc.is_running():
                 proc.send_signal(psutil.signal.SIGUSR1)
 
-        return profiler, response_times, nb_events
+    def make_result(self, eps, plugins, writers, profiling, send_lags, nb_events, delivery_stats=None):
+        return {
+            "eps": eps,
+            "sampling_rate": self.sampling_rate,
+            "run_time": self.run_time,
+            'profiling': profiling,
+            'send_lags': send_lags,
+            'send_stats': self.send_stats,
+            'delivery_stats': delivery_stats or {},
+            'plugins': '|'.join(plugins),
+            'nb_events': nb_events,
+            'drops': ['%s:%d' % (w.get_protocol(), w.get_number_dropped_event()) for w in writers]
+        }
 
     def save_results(self, results, write_header=True):
         path = self.config_mgr.constants['result_path']
         header_list = ['res', 'proc', 'plugins', 'eps', 'run_time', 'avg_cpu', 'max_cpu', 'avg_mem', 'max_mem',
         'last_mem', 'minor_flt', 'major_flt', 'nb_events', 'drops']
 
-        with open(path, "a") as csvfile, open(path + '.json', 'a') as jsonfile:
-            # json
-            jsonfile.write(json.dumps(results, ensure_ascii=True))
+        # ndjson: the summary record closes the interval records streamed during the run
+        record = dict(self.run_context)
+        record.update(results)
+        record['type'] = 'summary'
+        self.stream.write(record)
+
+        with open(path, "a") as csvfile:
             # csv
             lines = []
             stats_header = []
             # compute stats
             stats_entries = []
-            for procname, sampling in results['profiling'].iteritems():
-                max_cpu = max(sampling['cpu']) if any(sampling['cpu']) else 0
-                avg_cpu = np.mean(sampling['cpu']) if any(sampling['mem']) else 0
-                last_mem = sampling['mem'][-1] if any(sampling['mem']) else 0
-                max_mem = max(sampling['mem']) if any(sampling['mem']) else 0
-                avg_mem = np.mean(sampling['mem']) if any(sampling['mem']) else 0
-                minor_flt = max(sampling['minor_flt']) - min(sampling['minor_flt']) if any(sampling['minor_flt']) else 0
-                major_flt = max(sampling['major_flt']) - min(sampling['major_flt']) if any(sampling['major_flt']) else 0
+            for procname, sampling in results['profiling'].items():
+                summary = summarize_sampling(sampling)
+                avg_cpu, max_cpu = summary['avg_cpu'], summary['max_cpu']
+                avg_mem, max_mem, last_mem = summary['avg_mem'], summary['max_mem'], summary['last_mem']
+                minor_flt, major_flt = summary['minor_flt'], summary['major_flt']
                 stats_line = ",".join(map(str, stats_entries))
                 drops = '|'.join(results['drops']) if len(results['drops']) > 0 else 0
                 print("%s cpu=%.2f %%, mem=%d MB" % (procname, avg_cpu, avg_mem))
@@ -604,20 +2523,970 @@ class LoadBench:
                         minor_flt, major_flt, results['nb_events'], drops, stats_line))
                 lines.append(line)
 
-                for tid, thread_sampling in sampling['threads'].iteritems():
-                    lines.append('"%s", %.2f, %.2f\n' % (tid, np.mean(thread_sampling), max(thread_sampling)))
+                for tid, thread_sampling in sampling['threads'].items():
+                    lines.append('"%s", %.2f, %.2f\n' % (tid, thread_sampling.avg(), thread_sampling.max or 0))
 
             if write_header:
                 header = "%s\n" % ','.join(header_list + stats_header)
                 csvfile.write(header)
             csvfile.writelines(lines)
 
+class CapacitySearch:
+    """Find the highest EPS a plugin combination sustains, for --find-max-eps.
+
+    The EPS doubles from `start_eps` until a step fails, then a binary search narrows the range
+    between the last passing and the first failing step down to `precision`. A step fails when the
+    receiving sockets dropped events, the stand-in lost events, a monitored process (or one of its
+    threads) saturated its CPU, or the generator itself could not keep up (achieved rate or send
+    lag). Every step is a point of the capacity curve.
+    """
+    # max_avg_cpu: highest average CPU % of a monitored process over the step
+    CURVE_HEADER = ['res', 'plugins', 'eps', 'achieved_eps', 'p99_lag', 'max_avg_cpu', 'max_thread_cpu', 'max_mem',
+                    'drops', 'lost', 'passed', 'reasons']
+
+    def __init__(self, loadbench, processes, start_eps, max_eps=1000000, precision=0.05, max_cpu=95.0,
+                 max_send_lag=1.0, standin_url=''):
+        self.loadbench = loadbench
+        self.processes = processes
+        self.start_eps = max(1, start_eps)
+        self.max_eps = max_eps
+        self.precision = precision
+        self.max_cpu = max_cpu
+        self.max_send_lag = max_send_lag
+        self.standin_url = standin_url
+        self.curve = []
+
+    def count_drops(self, writers):
+        return sum(writer.get_number_dropped_event() for writer in writers)
+
+    def run_step(self, plugins, eps):
+        writers = self.loadbench.config_mgr.get_writers_by_name(plugins)
+        if self.standin_url:
+            fetch_standin_stats(self.standin_url, reset=True)
+        drops_before = self.count_drops(writers)
+        profiling, _, _ = self.loadbench.run_plugins(eps, self.processes, plugins, writers)
+        wait_time = int(self.loadbench.config_mgr.constants['wait_time_after_completion'])
+        if wait_time > 0:
+            time.sleep(wait_time)
+        send_stats = self.loadbench.send_stats
+
+        summaries = [summarize_sampling(sampling) for sampling in profiling.values()]
+        step = {
+            'res': get_resources(),
+            'plugins': '|'.join(plugins),
+            'eps': eps,
+            'achieved_eps': send_stats['achieved_eps'],
+            'p99_lag': send_stats['p99_lag'],
+            'max_avg_cpu': max([summary['avg_cpu'] for summary in summaries] or [0]),
+            'max_thread_cpu': max([summary['max_thread_cpu'] for summary in summaries] or [0]),
+            'max_mem': max([summary['max_mem'] for summary in summaries] or [0]),
+            'drops': self.count_drops(writers) - drops_before,
+            'lost': 0,
+        }
+        if self.standin_url:
+            delivery_stats = fetch_standin_stats(self.standin_url, sent=get_sent_sequences(send_stats),
+                                                 send_failed=get_send_failed(send_stats))
+            step['lost'] = sum(plugin_stats['lost'] for plugin_stats in delivery_stats['plugins'].values())
+
+        reasons = []
+        if step['drops'] > 0:
+            reasons.append('drops')
+        if step['lost'] > 0:
+            reasons.append('lost')
+        if step['max_avg_cpu'] >= self.max_cpu or step['max_thread_cpu'] >= self.max_cpu:
+            reasons.append('cpu')
+        if send_stats['achieved_eps'] < 0.98 * send_stats['target_eps'] or send_stats['p99_lag'] > self.max_send_lag:
+            reasons.append('send_lag')
+        step['passed'] = len(reasons) == 0
+        step['reasons'] = '|'.join(reasons)
+        self.curve.append(step)
+        print("[find-max-eps] %s: %d EPS -> achieved=%.1f EPS, avg cpu=%.1f %%, thread cpu=%.1f %%, rss=%d MB, "
+              "drops=%d, lost=%d: %s" % (step['plugins'], eps, step['achieved_eps'], step['max_avg_cpu'],
+                                         step['max_thread_cpu'], step['max_mem'], step['drops'], step['lost'],
+                                         'pass' if step['passed'] else 'fail (%s)' % step['reasons']))
+        return step['passed']
+
+    def search(self, plugins):
+        """Return the highest passing EPS for `plugins`, 0 if even `start_eps` fails."""
+        passed, failed = 0, None
+        eps = self.start_eps
+        while failed is None and eps <= self.max_eps:
+            if self.run_step(plugins, eps):
+                passed = eps
+                eps *= 2
+            else:
+                failed = eps
+
+        if failed is None:
+            return passed
+        while failed - passed > max(1, int(passed * self.precision)):
+            eps = (passed + failed) // 2
+            if self.run_step(plugins, eps):
+                passed = eps
+            else:
+                failed = eps
+        return passed
+
+    def save_curve(self, path):
+        write_header = not os.path.exists(path)
+        with open(path, 'a') as csvfile:
+            if write_header:
+                csvfile.write('%s\n' % ','.join(self.CURVE_HEADER))
+            for step in self.curve:
+                csvfile.write('"%s", "%s", %d, %.1f, %.4f, %.2f, %.2f, %d, %d, %d, %s, "%s"\n' %
+                              tuple(step[name] for name in self.CURVE_HEADER))
+
+
+def get_agent_version(path='/etc/opt/microsoft/omsagent/sysconf/installinfo.txt'):
+    # same lookup as OMS::Common.get_agent_version
+    if os.path.isfile(path):
+        with open(path) as f:
+            match = re.search(r'(\d+\.\d+\.\d+-\d+)\s.*\n', f.read())
+            if match:
+                return match.group(1)
+    return '0.0.0-0'
+
+
+def get_host_key():
+    # stable part of get_resources(): available memory changes from one run to the next
+    total_mem = psutil.virtual_memory().total / 10 ** 9.0
+    return '%dCPU-%dG' % (multiprocessing.cpu_count(), int(round(total_mem)))
+
+
+SUITE_SCENARIOS = [
+    {'name': 'syslog-1k-eps-200b', 'plugins': ['syslog'], 'eps': 1000, 'event_size': 200},
+    {'name': 'syslog-10k-eps-200b', 'plugins': ['syslog'], 'eps': 10000, 'event_size': 200},
+    {'name': 'syslog-5k-eps-2kb', 'plugins': ['syslog'], 'eps': 5000, 'event_size': 2000},
+    {'name': 'cef-5k-eps', 'plugins': ['syslog_cef'], 'eps': 5000, 'event_size': 1000},
+    {'name': 'file-5k-eps-1kb', 'plugins': ['file'], 'eps': 5000, 'event_size': 1000},
+    {'name': 'msgpack-5k-eps-1kb', 'plugins': ['msgpack'], 'eps': 5000, 'event_size': 1000},
+    {'name': 'syslog-file-5k-eps-1kb', 'plugins': ['syslog', 'file'], 'eps': 5000, 'event_size': 1000},
+]
+
+
+class BenchmarkSuite:
+    """Run a fixed matrix of scenarios and gate them against stored baselines, for --suite.
+
+    Baselines are stored in a JSON file keyed by '<agent version>|<host key>' then by scenario name.
+    A scenario regresses when a metric is worse than its baseline by more than `threshold` (relative)
+    and by more than the metric's noise floor (absolute).
+    """
+    # metric: (higher is worse, noise floor)
+    GATED_METRICS = {
+        'avg_cpu': (True, 1.0),
+        'max_cpu': (True, 5.0),
+        'mem_growth': (True, 5.0),
+        'drops': (True, 0),
+        'lost': (True, 0),
+        'achieved_eps': (False, 0),
+    }
+
+    def __init__(self, make_loadbench, constants, processes, scenarios, threshold=0.1, standin_url=''):
+        self.make_loadbench = make_loadbench
+        self.constants = constants
+        self.processes = processes
+        self.scenarios = scenarios
+        self.threshold = threshold
+        self.standin_url = standin_url
+
+    @staticmethod
+    def baseline_key(agent_version, host_key):
+        return '%s|%s' % (agent_version, host_key)
+
+    @staticmethod
+    def load_baselines(path):
+        if not os.path.exists(path):
+            return {}
+        with open(path) as f:
+            return json.load(f)
+
+    @staticmethod
+    def save_baselines(path, baselines):
+        with open(path + '.tmp', 'w') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+        os.rename(path + '.tmp', path)
+
+    def run_scenario(self, scenario):
+        constants = dict(self.constants)
+        constants['event_size'] = str(scenario['event_size'])
+        loadbench = self.make_loadbench(constants)
+        writers = loadbench.config_mgr.get_writers_by_name(scenario['plugins'])
+        if self.standin_url:
+            fetch_standin_stats(self.standin_url, reset=True)
+        drops_before = sum(writer.get_number_dropped_event() for writer in writers)
+
+        print("[suite] %s: %s, %d EPS, %d bytes" % (scenario['name'], '|'.join(scenario['plugins']), scenario['eps'],
+                                                    scenario['event_size']))
+        profiling, send_lags, nb_events = loadbench.run_plugins(scenario['eps'], self.processes,
+                                                                scenario['plugins'], writers)
+        wait_time = int(constants['wait_time_after_completion'])
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+        delivery_stats = {}
+        if self.standin_url:
+            delivery_stats = fetch_standin_stats(self.standin_url, sent=get_sent_sequences(loadbench.send_stats),
+                                                 send_failed=get_send_failed(loadbench.send_stats))
+        loadbench.save_results(loadbench.make_result(scenario['eps'], scenario['plugins'], writers, profiling,
+                                                     send_lags, nb_events, delivery_stats))
+
+        summaries = [summarize_sampling(sampling) for sampling in profiling.values()]
+        return {
+            'avg_cpu': round(sum(summary['avg_cpu'] for summary in summaries), 2),
+            'max_cpu': round(max([summary['max_cpu'] for summary in summaries] or [0]), 2),
+            'max_mem': round(sum(summary['max_mem'] for summary in summaries), 2),
+            'mem_growth': round(sum(summary['mem_growth'] for summary in summaries), 2),
+            'drops': sum(writer.get_number_dropped_event() for writer in writers) - drops_before,
+            'lost': sum(stats['lost'] for stats in delivery_stats.get('plugins', {}).values()),
+            'achieved_eps': loadbench.send_stats['achieved_eps'],
+        }
+
+    def compare(self, metrics, baseline):
+        """Return the list of regressions of `metrics` against `baseline`."""
+        regressions = []
+        for name, (higher_is_worse, noise_floor) in sorted(self.GATED_METRICS.items()):
+            if name not in baseline:
+                continue
+            current, reference = metrics[name], baseline[name]
+            if higher_is_worse:
+                regressed = current > reference * (1 + self.threshold) and current - reference > noise_floor
+            else:
+                regressed = current < reference * (1 - self.threshold) and reference - current > noise_floor
+            if regressed:
+                regressions.append('%s: %.2f -> %.2f' % (name, reference, current))
+        return regressions
+
+    def run(self, baselines, baseline_key):
+        """Run all the scenarios, return (metrics per scenario, regressions per scenario)."""
+        results, regressions = {}, {}
+        reference = baselines.get(baseline_key, {})
+        for scenario in self.scenarios:
+            metrics = self.run_scenario(scenario)
+            results[scenario['name']] = metrics
+            if scenario['name'] not in reference:
+                print("[suite] %s: no baseline for %s" % (scenario['name'], baseline_key))
+                continue
+            regressions[scenario['name']] = self.compare(metrics, reference[scenario['name']])
+            print("[suite] %s: %s" % (scenario['name'], ', '.join(regressions[scenario['name']]) or 'ok'))
+        return results, regressions
+
+
+def set_output_buffer(conf, output_type, settings):
+    """Set the buffer/flush `settings` in the <match> sections of omsagent.conf using `output_type`."""
+    def update_section(match):
+        section = match.group(0)
+        if not re.search(r'^[ \t]*type[ \t]+%s[ \t]*$' % re.escape(output_type), section, re.M):
+            return section
+        for name, value in sorted(settings.items()):
+            line = '  %s %s' % (name, value)
+            section, count = re.subn(r'^[ \t]*%s[ \t]+\S+[ \t]*$' % re.escape(name), line, section, flags=re.M)
+            if count == 0:
+                section = section.replace('\n</match>', '\n%s\n</match>' % line)
+        return section
+    return re.sub(r'<match [^>]*>.*?</match>', update_section, conf, flags=re.S)
+
+
+def set_jemalloc(env, enabled):
+    """Enable or disable the LD_PRELOAD of jemalloc in omsagent.env, like disable_jemalloc_if_cylance_exist."""
+    if enabled:
+        return re.sub(r'^#\s*LD_PRELOAD=', 'LD_PRELOAD=', env, flags=re.M)
+    return re.sub(r'^LD_PRELOAD=', '#LD_PRELOAD=', env, flags=re.M)
+
+
+class TuningMatrix:
+    """Run the same load scenario under every combination of tuning settings, for --tuning-matrix.
+
+    The dimensions are the kernel socket receive buffers (net.core.rmem_max/rmem_default, see
+    network_setups_cmds), the buffer/flush settings of an output plugin in omsagent.conf and jemalloc
+    (LD_PRELOAD in omsagent.env). omsagent is restarted after each change and every setting is
+    restored at the end, even when a run fails. Configurations are ranked by EPS per CPU % and by
+    drops.
+    """
+    RMEM_FILES = ['/proc/sys/net/core/rmem_max', '/proc/sys/net/core/rmem_default']
+    BUFFER_SETTINGS = ['buffer_chunk_limit', 'flush_interval', 'buffer_queue_limit']
+
+    def __init__(self, constants, make_suite, scenario, rmem_sizes=None, buffers=None, jemalloc=None,
+                 output_type='out_oms', steady_time=10, pgrep='omsagent'):
+        self.constants = constants
+        self.pgrep = pgrep
+        self.make_suite = make_suite
+        self.scenario = scenario
+        self.output_type = output_type
+        self.steady_time = steady_time
+        self.dimensions = [('rmem', rmem_sizes or [None]), ('buffer', buffers or [None]),
+                           ('jemalloc', jemalloc or [None])]
+        self.saved = None
+
+    @staticmethod
+    def parse_buffer(value):
+        """'<buffer_chunk_limit>:<flush_interval>:<buffer_queue_limit>', empty fields are left as is."""
+        return dict((name, field) for name, field in zip(TuningMatrix.BUFFER_SETTINGS, value.split(':')) if field)
+
+    def combinations(self):
+        combinations = [{}]
+        for name, values in self.dimensions:
+            combinations = [dict(combination, **{name: value}) for combination in combinations for value in values]
+        return combinations
+
+    @staticmethod
+    def label(combination):
+        return ' '.join('%s=%s' % (name, value) for name, value in sorted(combination.items()) if value is not None) \
+            or 'default'
+
+    def save(self):
+        self.saved = {'rmem': []}
+        for path in self.RMEM_FILES:
+            with open(path) as f:
+                self.saved['rmem'].append(f.read().strip())
+        for name in ['omsagent_config_path', 'omsagent_env_path']:
+            with open(self.constants[name]) as f:
+                self.saved[name] = f.read()
+
+    def write(self, name, content):
+        # the agent's settings belong to root/omsagent, written through sudo like the other privileged steps
+        path = self.constants[name]
+        tee = subprocess.Popen(['sudo', 'tee', path], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        tee.communicate(content if isinstance(content, bytes) else content.encode('utf-8'))
+        if tee.returncode != 0:
+            raise IOError("Cannot write %s: 'sudo tee' exited with status %d" % (path, tee.returncode))
+
+    def apply(self, combination):
+        """Apply `combination` and restart omsagent, return False if the kernel settings could not be set."""
+        if combination['rmem'] is not None:
+            if run_cmds(network_setups_cmds, dict(self.constants, network_queue=combination['rmem'])):
+                return False
+        conf = self.saved['omsagent_config_path']
+        if combination['buffer'] is not None:
+            conf = set_output_buffer(conf, self.output_type, self.parse_buffer(combination['buffer']))
+        self.write('omsagent_config_path', conf)
+        env = self.saved['omsagent_env_path']
+        if combination['jemalloc'] is not None:
+            env = set_jemalloc(env, combination['jemalloc'] == 'on')
+        self.write('omsagent_env_path', env)
+        self.restart()
+        return True
+
+    def restore(self):
+        rmem_max, rmem_default = self.saved['rmem']
+        if run_cmds(['sudo sysctl -w net.core.rmem_max=%s' % rmem_max,
+                     'sudo sysctl -w net.core.rmem_default=%s' % rmem_default]):
+            print("[tuning] Warning: could not restore net.core.rmem_max=%s, net.core.rmem_default=%s" %
+                  (rmem_max, rmem_default))
+        self.write('omsagent_config_path', self.saved['omsagent_config_path'])
+        self.write('omsagent_env_path', self.saved['omsagent_env_path'])
+        self.restart()
+
+    def restart(self):
+        run_cmds([self.constants['omsagent_restart_cmd']])
+        time.sleep(self.steady_time)
+
+    def find_processes(self):
+        pids = subprocess.Popen(['pgrep', self.pgrep], stdout=subprocess.PIPE,
+                                universal_newlines=True).stdout.readlines()
+        return [psutil.Process(int(pid)) for pid in pids]
+
+    def run(self):
+        """Return the metrics of every combination, ranked by EPS per CPU %."""
+        results = []
+        self.save()
+        try:
+            for combination in self.combinations():
+                label = self.label(combination)
+                print("[tuning] %s" % label)
+                if not self.apply(combination):
+                    print("[tuning] %s: skipped, the socket receive buffers could not be set" % label)
+                    continue
+                constants = dict(self.constants, perf_tuning=label)
+                suite = self.make_suite(constants, self.find_processes())
+                metrics = suite.run_scenario(dict(self.scenario, name=label))
+                metrics['eps_per_cpu'] = round(metrics['achieved_eps'] / max(metrics['avg_cpu'], 0.01), 2)
+                metrics['configuration'] = label
+                print("[tuning] %s: %.1f EPS, cpu=%.2f %%, %.2f EPS per cpu %%, drops=%d, lost=%d" %
+                      (label, metrics['achieved_eps'], metrics['avg_cpu'], metrics['eps_per_cpu'], metrics['drops'],
+                       metrics['lost']))
+                results.append(metrics)
+        finally:
+            print("[tuning] restoring the initial settings")
+            self.restore()
+        return sorted(results, key=lambda metrics: -metrics['eps_per_cpu'])
+
+    @staticmethod
+    def save_ranking(path, results):
+        columns = ['configuration', 'achieved_eps', 'avg_cpu', 'eps_per_cpu', 'drops', 'lost', 'max_mem',
+                   'mem_growth']
+        with open(path, 'w') as f:
+            f.write(','.join(columns) + '\n')
+            for metrics in results:
+                f.write(','.join('"%s"' % metrics[column] if column == 'configuration' else str(metrics[column])
+                                 for column in columns) + '\n')
+
+
+def get_ruby_path():
+    for path in [RUBY_PATH_OMS, RUBY_PATH_LOCAL, RUBY_PATH_DEFAULT]:
+        if os.path.isfile(path):
+            return path
+    return ''
+
+
+class RubyProfiler:
+    """Profile the ruby code of omsagent during the measured window, for --ruby-profiler.
+
+    rbspy samples running processes ('attach') or an omsagent it starts ('launch') and writes the
+    stacks in the collapsed format read by flamegraph.pl and speedscope. The stacks of all profiled
+    processes are merged into flamegraph.stacks next to results.csv, under a root frame per process.
+    ruby-prof can only launch omsagent; it traces every call instead of sampling and writes a
+    callgrind profile (kcachegrind) at exit.
+    """
+    PROFILERS = ['rbspy', 'ruby-prof']
+
+    def __init__(self, profiler, output_dir, rate=100):
+        if profiler not in self.PROFILERS:
+            raise ValueError("Unknown ruby profiler '%s', available profilers: %s" %
+                             (profiler, ', '.join(self.PROFILERS)))
+        self.profiler = profiler
+        self.output_dir = output_dir
+        self.rate = rate
+        self.recorders = []
+        self.launched_pid = None
+        self.devnull = open(os.devnull, 'w')
+
+    def attach(self, pids):
+        if self.profiler != 'rbspy':
+            raise ValueError('%s cannot attach to a running process, use --ruby-profile-mode launch' % self.profiler)
+        for pid in pids:
+            path = os.path.join(self.output_dir, 'rbspy-%d.stacks' % pid)
+            cmd = [RBSPY_PATH, 'record', '--pid', str(pid), '--rate', str(self.rate), '--format', 'collapsed',
+                   '--file', path, '--nonblocking']
+            self.recorders.append(('omsagent-%d' % pid, path, subprocess.Popen(cmd, stdout=self.devnull,
+                                                                              stderr=self.devnull)))
+
+    def launch(self, omsagent_path, config_path, wait_for_steady_stat=5):
+        """Start omsagent under the profiler and return the pid of its ruby process."""
+        if self.profiler == 'rbspy':
+            path = os.path.join(self.output_dir, 'rbspy-launch.stacks')
+            cmd = [RBSPY_PATH, 'record', '--rate', str(self.rate), '--format', 'collapsed', '--file', path,
+                   '--subprocesses', '--', get_ruby_path(), omsagent_path, '-c', config_path]
+        else:
+            path = os.path.join(self.output_dir, 'ruby-prof.callgrind')
+            cmd = [RUBY_PROF_PATH, '--mode=process', '--printer=call_tree', '--file=%s' % path, omsagent_path,
+                   '--', '-c', config_path]
+        popen = subprocess.Popen(cmd, stdout=self.devnull, stderr=self.devnull)
+        time.sleep(wait_for_steady_stat)
+        if self.profiler == 'rbspy':
+            children = subprocess.Popen(['pgrep', '-P', str(popen.pid)], stdout=subprocess.PIPE,
+                                        universal_newlines=True).stdout.readlines()
+            self.launched_pid = int(children[0]) if children else None
+        else:
+            self.launched_pid = popen.pid
+        self.recorders.append(('omsagent-%s' % self.launched_pid, path, popen))
+        return self.launched_pid
+
+    def stop(self, timeout=60):
+        """Stop profiling and return the path of the profile."""
+        if self.launched_pid is not None:
+            # omsagent exits on SIGTERM, the profiler writes its output when its target is gone
+            try:
+                os.kill(self.launched_pid, signal.SIGTERM)
+            except OSError:
+                pass
+        else:
+            for _, _, popen in self.recorders:
+                popen.send_signal(signal.SIGINT)
+        deadline = monotonic() + timeout
+        for _, _, popen in self.recorders:
+            while popen.poll() is None and monotonic() < deadline:
+                time.sleep(0.1)
+            if popen.poll() is None:
+                popen.kill()
+        self.devnull.close()
+        if self.profiler == 'ruby-prof':
+            return self.recorders[0][1] if self.recorders else ''
+        return self.merge_stacks(os.path.join(self.output_dir, 'flamegraph.stacks'))
+
+    def merge_stacks(self, path):
+        counts = {}
+        for name, stacks_path, _ in self.recorders:
+            if not os.path.exists(stacks_path):
+                print("Warning: no ruby stacks recorded for %s" % name)
+                continue
+            with open(stacks_path) as f:
+                for line in f:
+                    stack, _, count = line.rstrip('\n').rpartition(' ')
+                    if stack and count.isdigit():
+                        stack = '%s;%s' % (name, stack)
+                        counts[stack] = counts.get(stack, 0) + int(count)
+        with open(path, 'w') as f:
+            for stack, count in sorted(counts.items()):
+                f.write('%s %d\n' % (stack, count))
+        return path
+
+
+def parse_host_shard(constants):
+    """Return (k, N) of --host-shard k/N: host k of N interleaves its sequence numbers with the other hosts."""
+    index, _, count = constants.get('host_shard', '0/1').partition('/')
+    return int(index), int(count or 1)
+
+
+def strip_options(argv, names):
+    """Remove the `names` options and their values from a command line."""
+    stripped = []
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg in names:
+            skip = True
+        elif not any(arg.startswith(name + '=') for name in names):
+            stripped.append(arg)
+    return stripped
+
+
+# options of the command line a LoadAgent runs: load settings only, no paths or commands
+AGENT_OPTIONS = set([
+    '--run-time', '--eps', '--sample-rate', '--send-tick', '--workers', '--sampler', '--plugins', '--pids',
+    '--pgrep', '--host-shard', '--tag', '--syslog-port', '--security-events-port', '--syslog-host',
+    '--syslog-protocol', '--syslog-format', '--syslog-send-path', '--syslog-connections', '--syslog-framing',
+    '--fluent-port', '--fluent-host', '--forward-mode', '--forward-chunk-size', '--forward-flush-interval',
+    '--forward-ack', '--tail-rotation', '--tail-rotate-every', '--tail-files', '--tail-partial-lines',
+    '--event-size', '--wait-time-after-completion',
+])
+AGENT_TOKEN_HEADER = 'X-Agent-Token'
+# largest POST body an agent reads, a run request is a few hundred bytes
+MAX_AGENT_REQUEST_SIZE = 64 * 1024
+
+
+def check_agent_argv(argv):
+    """Return why a LoadAgent refuses to run `argv`, or None if it only holds AGENT_OPTIONS and their values."""
+    if not isinstance(argv, list) or not all(isinstance(arg, (str, type(u''))) for arg in argv):
+        return 'argv must be a list of strings'
+    i = 0
+    while i < len(argv):
+        name, sep, value = argv[i].partition('=')
+        if name not in AGENT_OPTIONS:
+            return 'option not allowed: %s' % name
+        if not sep:
+            i += 1
+            if i >= len(argv) or argv[i].startswith('-'):
+                return 'missing value of %s' % name
+        i += 1
+    return None
+
+
+def make_dirs(path):
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+
+class LoadAgentHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def authorized(self):
+        token = self.headers.get(AGENT_TOKEN_HEADER, '')
+        compare = getattr(hmac, 'compare_digest', lambda a, b: a == b)
+        if compare(token.encode('utf-8'), self.server.token.encode('utf-8')):
+            return True
+        # a request body left unread can't be skipped to the next request of the connection
+        self.close_connection = True
+        self.send_body(403, b'')
+        return False
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, code, body, content_type='application/json'):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if self.close_connection:
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, code, obj):
+        self.send_body(code, json.dumps(obj, sort_keys=True).encode('utf-8'))
+
+    def do_GET(self):
+        if not self.authorized():
+            return
+        parts = [part for part in self.path.split('/') if part]
+        if parts == ['time']:
+            self.send_json(200, {'time': time.time()})
+        elif len(parts) >= 2 and parts[0] == 'runs' and parts[1] in self.server.runs:
+            run = self.server.runs[parts[1]]
+            if len(parts) == 2:
+                returncode = run['popen'].poll()
+                self.send_json(200, {'status': 'running' if returncode is None else 'done', 'returncode': returncode})
+            elif parts[2:] == ['results'] and os.path.exists(run['results']):
+                with open(run['results'], 'rb') as f:
+                    self.send_body(200, f.read(), 'application/x-ndjson')
+            else:
+                self.send_body(404, b'')
+        else:
+            self.send_body(404, b'')
+
+    def do_POST(self):
+        # nothing is read from unauthenticated clients, nor more than MAX_AGENT_REQUEST_SIZE from anyone
+        if not self.authorized():
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            length = -1
+        if not 0 <= length <= MAX_AGENT_REQUEST_SIZE:
+            self.close_connection = True
+            self.send_json(413, {'error': 'expected a body of at most %d bytes' % MAX_AGENT_REQUEST_SIZE})
+            return
+        body = self.rfile.read(length)
+        if self.path.rstrip('/') != '/runs':
+            self.send_body(404, b'')
+            return
+        try:
+            request = json.loads(body.decode('utf-8'))
+            argv = request['argv']
+            start_at = float(request['start_at'])
+        except (ValueError, KeyError, TypeError):
+            self.send_json(400, {'error': 'expected {argv, start_at}'})
+            return
+        error = check_agent_argv(argv)
+        if error is not None:
+            self.send_json(400, {'error': error})
+            return
+        self.send_json(200, {'run': self.server.start_run(argv, start_at)})
+
+
+class LoadAgent(ThreadingMixIn, HTTPServer):
+    """Run load generators on behalf of a Coordinator, for --serve-agent.
+
+    POST /runs {argv, start_at} starts this script with `argv` and --start-at, GET /runs/<id> returns
+    its status and GET /runs/<id>/results its result stream. GET /time lets the coordinator measure
+    the clock offset of the host. In CI, one agent per network namespace (ip netns exec) simulates
+    several hosts.
+
+    Every request must carry the shared token in the X-Agent-Token header, and `argv` may only hold
+    the load options of AGENT_OPTIONS: the runs may use sudo, so the caller can't pick paths or commands.
+    """
+    daemon_threads = True
+
+    def __init__(self, address, workspace_dir, token):
+        HTTPServer.__init__(self, address, LoadAgentHandler)
+        self.workspace_dir = workspace_dir
+        self.token = token
+        self.runs = {}
+        self.lock = threading.Lock()
+
+    def start_run(self, argv, start_at):
+        with self.lock:
+            run = '%d-%d' % (int(time.time() * 1000), len(self.runs))
+            result_path = os.path.join(self.workspace_dir, 'agent-%s.csv' % run)
+            cmd = [sys.executable, os.path.abspath(__file__)] + argv + \
+                ['--start-at', repr(start_at), '--result-path', result_path]
+            print("%s: starting run %s: %s" % (datetime.now().time(), run, ' '.join(cmd)))
+            self.runs[run] = {'popen': subprocess.Popen(cmd, close_fds=True),
+                              'results': os.path.splitext(result_path)[0] + '.ndjson'}
+            return run
+
+
+class Coordinator:
+    """Drive LoadAgents on several hosts with a shared start time, for --coordinate.
+
+    Each agent runs the same command line as host k of N (--host-shard), so the sequence numbers of
+    all hosts interleave and ods-standin.py accounts for the losses of the whole tier. The start time
+    of each agent is corrected by its clock offset, measured as in NTP from the midpoint of a request.
+    """
+    def __init__(self, agents, argv, token, start_delay=5.0, standin_url='', poll_interval=1.0):
+        self.agents = agents
+        self.argv = argv
+        self.token = token
+        self.start_delay = start_delay
+        self.standin_url = standin_url
+        self.poll_interval = poll_interval
+        self.runs = {}
+
+    def request(self, agent, path, body=None, timeout=30):
+        try:
+            from urllib.request import urlopen, Request
+        except ImportError:
+            from urllib2 import urlopen, Request
+        data = json.dumps(body).encode('utf-8') if body is not None else None
+        headers = {AGENT_TOKEN_HEADER: self.token}
+        if data is not None:
+            headers['Content-Type'] = 'application/json'
+        response = urlopen(Request('http://%s%s' % (agent, path), data, headers), timeout=timeout)
+        content = response.read()
+        return content if path.endswith('/results') else json.loads(content.decode('utf-8'))
+
+    def clock_offset(self, agent):
+        before = time.time()
+        remote = self.request(agent, '/time')['time']
+        return remote - (before + time.time()) / 2
+
+    def start(self):
+        offsets = dict((agent, self.clock_offset(agent)) for agent in self.agents)
+        start_time = time.time() + self.start_delay
+        for k, agent in enumerate(self.agents):
+            argv = self.argv + ['--host-shard', '%d/%d' % (k, len(self.agents))]
+            self.runs[agent] = self.request(agent, '/runs', {'argv': argv, 'start_at': start_time + offsets[agent]})['run']
+            print("%s: run %s, clock offset %.3f s" % (agent, self.runs[agent], offsets[agent]))
+        return start_time
+
+    def wait(self):
+        pending = set(self.agents)
+        while pending:
+            time.sleep(self.poll_interval)
+            for agent in list(pending):
+                status = self.request(agent, '/runs/%s' % self.runs[agent])
+                if status['status'] == 'done':
+                    if status['returncode'] != 0:
+                        print("Warning: run on %s exited with status %s" % (agent, status['returncode']))
+                    pending.remove(agent)
+
+    def collect(self, output_dir):
+        paths = []
+        for agent in self.agents:
+            path = os.path.join(output_dir, 'coordinated-%s.ndjson' % agent.replace(':', '-'))
+            with open(path, 'wb') as f:
+                f.write(self.request(agent, '/runs/%s/results' % self.runs[agent]))
+            paths.append(path)
+        return paths
+
+    def run(self, output_dir):
+        if self.standin_url:
+            fetch_standin_stats(self.standin_url, reset=True)
+        self.start()
+        self.wait()
+        merged = merge_results(self.collect(output_dir))
+        if self.standin_url:
+            delivery_stats = fetch_standin_stats(self.standin_url, sent=merged['sent'],
+                                                 send_failed=merged['send_failed'])
+            for plugin, plugin_stats in sorted(delivery_stats['plugins'].items()):
+                print("  %s: delivered=%d events, lost=%d, duplicated=%d, reordered=%d" %
+                      (plugin, plugin_stats['nb_events'], plugin_stats['lost'], plugin_stats['duplicated'],
+                       plugin_stats['reordered']))
+                if plugin_stats['nb_events'] > 0:
+                    print("  %s: latency p50=%.3f s, p99=%.3f s, max=%.3f s" %
+                          (plugin, plugin_stats['p50_latency'], plugin_stats['p99_latency'],
+                           plugin_stats['max_latency']))
+        return merged
+
+
+def sampling_from_dict(sampling):
+    """Rebuild a profiler entry (see new_process_sampling) from its JSON form."""
+    result = dict((name, SampleSeries.from_dict(value)) for name, value in sampling.items() if name != 'threads')
+    result['threads'] = dict((tid, SampleSeries.from_dict(value)) for tid, value in sampling.get('threads', {}).items())
+    return result
+
+
+def html_escape(text):
+    return str(text).replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').replace('"', '&quot;')
+
+
+class HtmlReport:
+    """Build one self-contained HTML page from the NDJSON result streams of many runs, for --html-report.
+
+    Every run gets time series of the CPU and RSS of each process, of the busiest threads, and of the
+    send rate and socket drops of each plugin, from its interval records, drawn as inline SVG. The
+    events the stand-in found lost are only known at the end of a run, and drawn as a point there.
+    The summary records give a table of
+    all runs and, when two agent versions are compared, a side-by-side diff of the latest run of each
+    scenario (plugins, EPS, event size) that both versions ran.
+    """
+    COLORS = ['#1f77b4', '#ff7f0e', '#2ca02c', '#d62728', '#9467bd', '#8c564b', '#e377c2', '#7f7f7f', '#bcbd22',
+              '#17becf']
+    # metric: (label, higher is worse)
+    METRICS = [
+        ('achieved_eps', 'achieved EPS', False),
+        ('avg_cpu', 'avg CPU %', True),
+        ('max_cpu', 'max CPU %', True),
+        ('max_mem', 'max RSS MB', True),
+        ('mem_growth', 'RSS growth MB', True),
+        ('drops', 'socket drops', True),
+        ('lost', 'lost events', True),
+        ('p99_lag', 'p99 send lag s', True),
+        ('p99_latency', 'p99 delivery latency s', True),
+    ]
+    MAX_THREADS = 8
+
+    def __init__(self, paths):
+        self.runs = {}
+        for path in paths:
+            with open(path) as f:
+                for line in f:
+                    record = json.loads(line)
+                    if 'run' not in record:
+                        continue
+                    run = self.runs.setdefault(record['run'], {'intervals': [], 'summary': None, 'source': path})
+                    if record.get('type') == 'interval':
+                        run['intervals'].append(record)
+                    elif record.get('type') == 'summary':
+                        run['summary'] = record
+
+    @staticmethod
+    def run_metrics(summary):
+        summaries = [summarize_sampling(sampling_from_dict(sampling))
+                     for sampling in summary.get('profiling', {}).values()]
+        delivery = summary.get('delivery_stats', {}).get('plugins', {})
+        return {
+            'agent_version': summary.get('agent_version', '-'),
+            'scenario': '%s %d EPS %s B' % (summary.get('plugins', ''), summary.get('eps', 0),
+                                           summary.get('event_size', '-')),
+            'start_time': summary.get('start_time', 0),
+            'achieved_eps': summary.get('send_stats', {}).get('achieved_eps', 0),
+            'avg_cpu': round(sum(s['avg_cpu'] for s in summaries), 2),
+            'max_cpu': round(max([s['max_cpu'] for s in summaries] or [0]), 2),
+            'max_mem': round(sum(s['max_mem'] for s in summaries), 2),
+            'mem_growth': round(sum(s['mem_growth'] for s in summaries), 2),
+            'drops': sum(int(drop.rpartition(':')[2]) for drop in summary.get('drops', [])),
+            'lost': sum(stats.get('lost', 0) for stats in delivery.values()),
+            'p99_lag': summary.get('send_stats', {}).get('p99_lag', 0),
+            'p99_latency': max([stats.get('p99_latency', 0) for stats in delivery.values()] or [0]),
+        }
+
+    def summaries(self):
+        runs = [(run_id, run) for run_id, run in self.runs.items() if run['summary'] is not None]
+        return sorted(((run_id, self.run_metrics(run['summary'])) for run_id, run in runs),
+                      key=lambda item: item[1]['start_time'])
+
+    def versions(self):
+        versions = []
+        for _, metrics in self.summaries():
+            if metrics['agent_version'] not in versions:
+                versions.append(metrics['agent_version'])
+        return versions
+
+    def compare(self, base_version, new_version):
+        """Return [(scenario, base metrics, new metrics)] of the scenarios run by both versions."""
+        latest = {}
+        for _, metrics in self.summaries():
+            latest[(metrics['agent_version'], metrics['scenario'])] = metrics
+        scenarios = sorted(set(scenario for version, scenario in latest if version == base_version) &
+                           set(scenario for version, scenario in latest if version == new_version))
+        return [(scenario, latest[(base_version, scenario)], latest[(new_version, scenario)])
+                for scenario in scenarios]
+
+    @staticmethod
+    def time_series(run):
+        """Return {chart: {series: [(seconds, value)]}} from the interval records of a run."""
+        charts = {'CPU %': {}, 'RSS MB': {}, 'thread CPU %': {}, 'EPS': {}, 'drops': {}}
+        if not run['intervals']:
+            return charts
+        start = run['intervals'][0]['time']
+        thread_series = {}
+        previous = None
+        first_drops = {}
+        for record in run['intervals']:
+            t = record['time'] - start
+            for key, sample in record.get('processes', {}).items():
+                charts['CPU %'].setdefault(key, []).append((t, sample['cpu'] or 0))
+                charts['RSS MB'].setdefault(key, []).append((t, sample['mem'] or 0))
+                for tid, value in sample.get('threads', {}).items():
+                    thread_series.setdefault('%s %s' % (key.rsplit('-', 1)[0], tid), []).append((t, value or 0))
+            if 'sent' in record:
+                if previous is not None and record['time'] > previous['time']:
+                    for plugin, nb_sent in record['sent'].items():
+                        eps = (nb_sent - previous['sent'].get(plugin, 0)) / (record['time'] - previous['time'])
+                        charts['EPS'].setdefault(plugin, []).append((t, eps))
+                previous = record
+            # the socket counters count the drops since the socket was opened, chart those of the run
+            for plugin, drops in record.get('drops', {}).items():
+                first_drops.setdefault(plugin, drops)
+                charts['drops'].setdefault('%s socket' % plugin, []).append((t, drops - first_drops[plugin]))
+        summary = run['summary'] or {}
+        for plugin, stats in summary.get('delivery_stats', {}).get('plugins', {}).items():
+            charts['drops']['%s lost (stand-in)' % plugin] = [(run['intervals'][-1]['time'] - start,
+                                                               stats.get('lost', 0))]
+        busiest = sorted(thread_series.items(), key=lambda item: -sum(value for _, value in item[1]))
+        charts['thread CPU %'] = dict(busiest[:HtmlReport.MAX_THREADS])
+        return charts
+
+    def svg_chart(self, title, series, width=640, height=200):
+        points = [point for values in series.values() for point in values]
+        if not points:
+            return ''
+        left, right, top, bottom = 50, 10, 20, 25
+        max_x = max(x for x, _ in points) or 1
+        max_y = (max(y for _, y in points) or 1) * 1.1
+        scale = lambda x, y: (left + x * (width - left - right) / max_x,
+                              height - bottom - y * (height - top - bottom) / max_y)
+        parts = ['<svg xmlns="http://www.w3.org/2000/svg" width="%d" height="%d">' % (width, height),
+                 '<text x="%d" y="14" class="title">%s</text>' % (left, html_escape(title)),
+                 '<line x1="%d" y1="%d" x2="%d" y2="%d" class="axis"/>' % (left, height - bottom, width - right,
+                                                                           height - bottom),
+                 '<line x1="%d" y1="%d" x2="%d" y2="%d" class="axis"/>' % (left, top, left, height - bottom),
+                 '<text x="%d" y="%d" class="tick" text-anchor="end">%.4g</text>' % (left - 4, top + 4, max_y),
+                 '<text x="%d" y="%d" class="tick" text-anchor="end">0</text>' % (left - 4, height - bottom),
+                 '<text x="%d" y="%d" class="tick" text-anchor="end">%.0f s</text>' % (width - right, height - 8,
+                                                                                       max_x)]
+        for n, (name, values) in enumerate(sorted(series.items())):
+            color = self.COLORS[n % len(self.COLORS)]
+            if len(values) == 1:
+                parts.append('<circle cx="%.1f" cy="%.1f" r="3" fill="%s"><title>%s</title></circle>' %
+                             (scale(*values[0]) + (color, html_escape(name))))
+                continue
+            path = ' '.join('%.1f,%.1f' % scale(x, y) for x, y in values)
+            parts.append('<polyline points="%s" stroke="%s"><title>%s</title></polyline>' %
+                         (path, color, html_escape(name)))
+        parts.append('</svg>')
+        legend = ''.join('<span style="color:%s">&#9632; %s</span> ' % (self.COLORS[n % len(self.COLORS)],
+                                                                         html_escape(name))
+                         for n, name in enumerate(sorted(series.keys())))
+        return '<div class="chart">%s<div class="legend">%s</div></div>' % (''.join(parts), legend)
+
+    def comparison_table(self, base_version, new_version):
+        rows = []
+        for scenario, base, new in self.compare(base_version, new_version):
+            for name, label, higher_is_worse in self.METRICS:
+                delta = (new[name] - base[name]) / float(base[name]) if base[name] else 0
+                worse = (delta > 0) == higher_is_worse and abs(delta) > 0.05
+                better = (delta < 0) == higher_is_worse and abs(delta) > 0.05
+                rows.append('<tr><td>%s</td><td>%s</td><td>%s</td><td>%s</td><td class="%s">%+.1f %%</td></tr>' %
+                            (html_escape(scenario), label, base[name], new[name],
+                             'worse' if worse else ('better' if better else ''), delta * 100))
+        if not rows:
+            return '<p>No scenario was run by both %s and %s.</p>' % (html_escape(base_version),
+                                                                     html_escape(new_version))
+        return ('<table><tr><th>scenario</th><th>metric</th><th>%s</th><th>%s</th><th>change</th></tr>%s</table>' %
+                (html_escape(base_version), html_escape(new_version), ''.join(rows)))
+
+    def render(self, base_version=None, new_version=None):
+        versions = self.versions()
+        if base_version is None and len(versions) >= 2:
+            base_version, new_version = versions[-2], versions[-1]
+        body = ['<h1>omsagent load test report</h1>',
+                '<p>%d runs, agent versions: %s</p>' % (len(self.runs), html_escape(', '.join(versions) or '-'))]
+        if base_version and new_version:
+            body.append('<h2>%s vs %s</h2>' % (html_escape(base_version), html_escape(new_version)))
+            body.append(self.comparison_table(base_version, new_version))
+        body.append('<h2>Runs</h2><table><tr><th>run</th><th>version</th><th>scenario</th>%s</tr>' %
+                    ''.join('<th>%s</th>' % label for _, label, _ in self.METRICS))
+        for run_id, metrics in self.summaries():
+            body.append('<tr><td><a href="#%s">%s</a></td><td>%s</td><td>%s</td>%s</tr>' %
+                        (html_escape(run_id), html_escape(run_id), html_escape(metrics['agent_version']),
+                         html_escape(metrics['scenario']),
+                         ''.join('<td>%s</td>' % metrics[name] for name, _, _ in self.METRICS)))
+        body.append('</table>')
+        for run_id, run in sorted(self.runs.items(), key=lambda item: item[0]):
+            summary = run['summary'] or (run['intervals'][0] if run['intervals'] else {})
+            body.append('<h2 id="%s">%s</h2><p>%s, plugins %s, %s EPS</p>' %
+                        (html_escape(run_id), html_escape(run_id), html_escape(summary.get('agent_version', '-')),
+                         html_escape(summary.get('plugins', '')), summary.get('eps', '-')))
+            for title, series in sorted(self.time_series(run).items()):
+                body.append(self.svg_chart(title, series))
+        style = ('body{font-family:sans-serif;margin:2em}table{border-collapse:collapse;margin-bottom:1em}'
+                 'td,th{border:1px solid #ccc;padding:2px 6px;font-size:12px}.worse{background:#f8d0d0}'
+                 '.better{background:#d0f0d0}.chart{display:inline-block;margin:4px}'
+                 'polyline{fill:none;stroke-width:1.5}.axis{stroke:#888}.title{font-size:12px;font-weight:bold}'
+                 '.tick{font-size:10px}.legend{font-size:10px;max-width:640px}')
+        return ('<!DOCTYPE html><html><head><meta charset="utf-8"><title>omsagent load test report</title>'
+                '<style>%s</style></head><body>%s</body></html>\n' % (style, '\n'.join(body)))
+
+
 WORKSPACE_DIR = './workspace'
 TEST_DIR = os.path.join(WORKSPACE_DIR, 'test_dir')
 RUBY_PATH_OMS = "/opt/microsoft/omsagent/ruby/bin/ruby"
 RUBY_PATH_DEFAULT = "/usr/bin/ruby"
 RUBY_PATH_LOCAL = "/usr/local/bin/ruby"
 RUBY_PROF_PATH = "/usr/local/bin/ruby-prof"
+RBSPY_PATH = "/usr/local/bin/rbspy"
 DEFAULT_VARS = {
     'tag': 'oms.tag.perf',
     'syslog_port': '25224',
@@ -625,22 +3494,46 @@ DEFAULT_VARS = {
     'syslog_path': '%s/in_syslog.socket' % TEST_DIR,
     'syslog_host': '0.0.0.0',
     'syslog_protocol': 'udp',
+    'syslog_format': 'rfc3164',
+    'syslog_send_path': 'fast',
+    'syslog_connections': '1',
+    'syslog_framing': 'lf',
     'fluent_port': '24224',
     'fluent_host': '0.0.0.0',
+    'forward_mode': 'message',
+    'forward_chunk_size': '1000',
+    'forward_flush_interval': '1',
+    'forward_ack': 'no',
     'tail_path': '%s/in_tail.log' % TEST_DIR,
+    'tail_rotation': 'none',
+    'tail_rotate_every': '60',
+    'tail_files': '1',
+    'tail_partial_lines': 'no',
+    'tail_pos_file': '',
     'test_dir': TEST_DIR,
     'omsadmin_conf_path': '/etc/opt/microsoft/omsagent/conf/omsadmin.conf',
     'cert_path': '/etc/opt/microsoft/omsagent/certs/oms.crt',
     'key_path': '/etc/opt/microsoft/omsagent/certs/oms.key',
     'omsagent_config_path': '/etc/opt/microsoft/omsagent/conf/omsagent.conf',
     'omsagent_path': '/opt/microsoft/omsagent/bin/omsagent',
+    'omsagent_env_path': '/etc/opt/microsoft/omsagent/omsagent.env',
+    'omsagent_restart_cmd': 'sudo /opt/microsoft/omsagent/bin/service_control restart',
     'result_path': '%s/results.csv' % WORKSPACE_DIR,
     'wait_time_after_completion': '0',
     'perf_tuning': 'none',
     'event_size': '1000',
+    'corpus_path': '',
+    'host_shard': '0/1',
     'network_queue': '21299',
 }
 
+DEFAULT_VARS_HELP = {
+    'syslog_framing': "syslog framing of stream sockets: lf, or octet (RFC 6587 octet counting), which the "
+                      "fluentd 0.12 in_syslog bundled with omsagent does not support",
+    'forward_mode': "forward protocol mode of msgpack: message, packed, or compressed (gzip, fluentd v0.14+), "
+                    "which the fluentd 0.12 in_forward bundled with omsagent does not support",
+}
+
 disable_oms_dsc_cmds = [
     'sudo /opt/microsoft/omsagent/bin/service_control stop',
     'sudo /opt/microsoft/omsagent/bin/service_control disable',
@@ -649,36 +3542,191 @@ disable_oms_dsc_cmds = [
     'sudo rm /etc/opt/omi/conf/omsconfig/configuration/Pending.mof*',
 ]
 network_setups_cmds = [
-    'sysctl -w net.core.rmem_max=%(network_queue)s',
-    'sysctl -w net.core.rmem_default=%(network_queue)s',
+    'sudo sysctl -w net.core.rmem_max=%(network_queue)s',
+    'sudo sysctl -w net.core.rmem_default=%(network_queue)s',
 ]
 
-def run_cmds(cmds):
+def run_cmds(cmds, variables=None):
+    """Run `cmds`, report the ones exiting with an error and return them."""
+    failed = []
     for cmd in cmds:
-        cmd = cmd % DEFAULT_VARS
-        out = subprocess.Popen(cmd.split(' '), stdout=subprocess.PIPE,
-                         stderr=subprocess.STDOUT).stdout.readlines()
+        cmd = cmd % (variables or DEFAULT_VARS)
+        popen = subprocess.Popen(cmd.split(' '), stdout=subprocess.PIPE,
+                                 stderr=subprocess.STDOUT, universal_newlines=True)
+        out = popen.communicate()[0]
+        if popen.returncode != 0:
+            print("Warning: '%s' exited with status %d: %s" % (cmd, popen.returncode, out.strip()))
+            failed.append(cmd)
+    return failed
 
 def main(argv):
     parser = argparse.ArgumentParser()
     parser.add_argument("--list-default-val", required=False, action='count', default=0, help="list default values")
-    for name, value in DEFAULT_VARS.iteritems():
-        parser.add_argument("--%s" % name.replace('_', '-'), required=False, help="%s" % name.replace('_', ' '),
-                            default=value)
+    parser.add_argument("--merge-results", required=False, default='',
+                        help="comma separated .ndjson result files (e.g. from several hosts) to merge and report")
+    parser.add_argument("--html-report", required=False, default='',
+                        help="write a self-contained HTML report of the --report-inputs result streams to this path")
+    parser.add_argument("--report-inputs", required=False, default='',
+                        help="comma separated .ndjson result files of --html-report")
+    parser.add_argument("--compare-versions", required=False, default='',
+                        help="<base>,<new> agent versions diffed by --html-report (default: the last two)")
+    parser.add_argument("--synthesize-corpus", required=False, default='',
+                        help="write a synthetic mixed workload corpus (syslog, CEF, multi-line tail) to this path")
+    parser.add_argument("--corpus-records", required=False, type=int, default=100000,
+                        help="number of records of --synthesize-corpus")
+    parser.add_argument("--corpus-seed", required=False, type=int, default=0,
+                        help="random seed of --synthesize-corpus, the same seed gives the same corpus")
+    parser.add_argument("--import-corpus", required=False, default='',
+                        help="append the lines of a captured log to --corpus-path")
+    parser.add_argument("--import-corpus-kind", required=False, choices=CORPUS_KINDS, default='syslog',
+                        help="writer replaying the records of --import-corpus")
+    parser.add_argument("--corpus-stats", required=False, action='store_true',
+                        help="print the size and shape statistics of --corpus-path")
+    for name, value in DEFAULT_VARS.items():
+        parser.add_argument("--%s" % name.replace('_', '-'), required=False,
+                            help=DEFAULT_VARS_HELP.get(name, name.replace('_', ' ')), default=value)
+
+    parser.add_argument("--serve-agent", required=False, type=int, default=0,
+                        help="run as a load agent of --coordinate listening on this port")
+    parser.add_argument("--agent-host", required=False, default='127.0.0.1', help="address --serve-agent listens on")
+    parser.add_argument("--agent-token", required=False, default=os.environ.get('LOADTEST_AGENT_TOKEN', ''),
+                        help="shared secret of --serve-agent and --coordinate (default: $LOADTEST_AGENT_TOKEN, "
+                             "which keeps it out of the process list)")
+    parser.add_argument("--coordinate", required=False, default='',
+                        help="comma separated host:port of load agents to run the rest of the command line on, "
+                             "with a shared start time, then merge their results")
+    parser.add_argument("--start-delay", required=False, type=float, default=5.0,
+                        help="seconds between the start request of --coordinate and the shared start time")
 
     args, unknown = parser.parse_known_args()
     args = vars(args)
     if args['list_default_val'] > 0:
         print("\t Available plugins: %s" % (', '.join(get_all_plugins_name())))
-        for name, value in DEFAULT_VARS.iteritems():
+        for name, value in DEFAULT_VARS.items():
             print("\t %s='%s'" % (name, value))
         return
+    if args['merge_results']:
+        merge_results([path for path in args['merge_results'].split(',') if path])
+        return
+    if args['html_report']:
+        report = HtmlReport([path for path in args['report_inputs'].split(',') if path])
+        versions = [version for version in args['compare_versions'].split(',') if version]
+        with open(args['html_report'], 'w') as f:
+            f.write(report.render(*versions[:2]) if len(versions) >= 2 else report.render())
+        print("Report of %d runs saved in %s" % (len(report.runs), args['html_report']))
+        return
+    if (args['serve_agent'] or args['coordinate']) and not args['agent_token']:
+        parser.error('--serve-agent and --coordinate require --agent-token or LOADTEST_AGENT_TOKEN')
+    if args['serve_agent']:
+        make_dirs(WORKSPACE_DIR)
+        agent = LoadAgent((args['agent_host'], args['serve_agent']), os.path.abspath(WORKSPACE_DIR),
+                          args['agent_token'])
+        print("Load agent listening on %s:%d" % (args['agent_host'], args['serve_agent']))
+        try:
+            agent.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        return
+    if args['coordinate']:
+        make_dirs(WORKSPACE_DIR)
+        forwarded = strip_options(argv, ['--coordinate', '--start-delay', '--ods-standin-url', '--agent-token'])
+        error = check_agent_argv(forwarded)
+        if error is not None:
+            parser.error('the load agents would refuse the command line: %s' % error)
+        standin_parser = argparse.ArgumentParser(add_help=False)
+        standin_parser.add_argument("--ods-standin-url", default='')
+        standin_url = standin_parser.parse_known_args(argv)[0].ods_standin_url
+        coordinator = Coordinator([agent for agent in args['coordinate'].split(',') if agent], forwarded,
+                                  args['agent_token'], args['start_delay'], standin_url)
+        coordinator.run(WORKSPACE_DIR)
+        return
+    if args['synthesize_corpus']:
+        CorpusSynthesizer(args['corpus_seed']).write(args['synthesize_corpus'], args['corpus_records'])
+        print_corpus_stats(WorkloadCorpus(args['synthesize_corpus']).stats())
+        return
+    if args['import_corpus']:
+        if not args['corpus_path']:
+            parser.error('--import-corpus requires --corpus-path')
+        import_corpus(args['import_corpus'], args['corpus_path'], args['import_corpus_kind'])
+        print_corpus_stats(WorkloadCorpus(args['corpus_path']).stats())
+        return
+    if args['corpus_stats']:
+        print_corpus_stats(WorkloadCorpus(args['corpus_path']).stats())
+        return
 
     parser.add_argument("--run-time", required=True, type=int, help="duration of the load in seconds")
     parser.add_argument("--eps", required=False, type=int, help="EPS in seconds", default=1)
     parser.add_argument("--sample-rate", required=False, type=float, help="sampling rate in seconds", default=0.5)
     parser.add_argument("--pids", required=False, help="pids of processes to collect metrics", default='')
     parser.add_argument("--pgrep", required=False, help="process name to collect metrics", default='omsagent')
+    parser.add_argument("--start-at", required=False, type=float, default=0,
+                        help="epoch time at which the load starts (set by --coordinate)")
+    parser.add_argument("--send-tick", required=False, type=float, default=0.001,
+                        help="smallest interval in seconds between two scheduled batches of events")
+    parser.add_argument("--workers", required=False, type=int, default=0,
+                        help="number of writer processes per plugin sharing the EPS (0: write from this process)")
+    parser.add_argument("--sampler", required=False, choices=['process', 'proc', 'psutil'], default='process',
+                        help="process: /proc sampler process returning samples through a shared ring buffer, "
+                             "proc: /proc sampler thread, psutil: profile() in a sampler thread")
+    parser.add_argument("--ods-standin-url", required=False, default='',
+                        help="base url of ods-standin.py (e.g. https://127.0.0.1:8443) to report end-to-end latency")
+    parser.add_argument("--find-max-eps", required=False, action='store_true',
+                        help="search the highest sustainable EPS of each plugin (and of all of them together), "
+                             "starting at --eps, each step lasting --run-time seconds")
+    parser.add_argument("--max-eps", required=False, type=int, default=1000000, help="upper bound of --find-max-eps")
+    parser.add_argument("--eps-precision", required=False, type=float, default=0.05,
+                        help="relative precision at which --find-max-eps stops")
+    parser.add_argument("--max-cpu", required=False, type=float, default=95.0,
+                        help="CPU %% of a monitored process or thread above which a --find-max-eps step fails")
+    parser.add_argument("--max-send-lag", required=False, type=float, default=1.0,
+                        help="p99 send lag in seconds above which a --find-max-eps step fails")
+    parser.add_argument("--tuning-matrix", required=False, action='store_true',
+                        help="run the load under every combination of the --tune-* settings and rank them "
+                             "(restarts omsagent, restores the settings at the end)")
+    parser.add_argument("--tune-rmem", required=False, default='',
+                        help="comma separated net.core.rmem_max/rmem_default sizes in bytes")
+    parser.add_argument("--tune-buffer", required=False, default='',
+                        help="comma separated <buffer_chunk_limit>:<flush_interval>:<buffer_queue_limit> of the "
+                             "--tune-output-type sections of omsagent.conf, e.g. 15m:20s:10,1m:5s:50")
+    parser.add_argument("--tune-output-type", required=False, default='out_oms',
+                        help="output plugin whose buffer settings --tune-buffer changes")
+    parser.add_argument("--tune-jemalloc", required=False, default='',
+                        help="comma separated on/off: LD_PRELOAD of jemalloc in omsagent.env")
+    parser.add_argument("--tune-steady-time", required=False, type=float, default=10,
+                        help="seconds to wait after restarting omsagent")
+    parser.add_argument("--suite", required=False, action='store_true',
+                        help="run the benchmark scenario matrix and compare it against the stored baseline")
+    parser.add_argument("--suite-file", required=False, default='',
+                        help="JSON list of scenarios ({name, plugins, eps, event_size}) replacing the default matrix")
+    parser.add_argument("--baseline-path", required=False, default=os.path.join(WORKSPACE_DIR, 'baselines.json'),
+                        help="JSON file storing the baselines")
+    parser.add_argument("--baseline-version", required=False, default='',
+                        help="agent version of the baseline to compare against (default: installed version)")
+    parser.add_argument("--agent-version", required=False, default='',
+                        help="agent version the results are stored under (default: read from installinfo.txt)")
+    parser.add_argument("--save-baseline", required=False, action='store_true',
+                        help="store the suite results as the baseline of this agent version and host")
+    parser.add_argument("--regression-threshold", required=False, type=float, default=0.1,
+                        help="relative degradation over the baseline that fails the suite")
+    parser.add_argument("--ruby-profiler", required=False, choices=['none'] + RubyProfiler.PROFILERS, default='none',
+                        help="profile the ruby code of omsagent during the run, the profile is saved next to results.csv")
+    parser.add_argument("--ruby-profile-mode", required=False, choices=['attach', 'launch'], default='attach',
+                        help="attach: profile the processes of --pids/--pgrep, launch: start omsagent under the "
+                             "profiler with --omsagent-config-path (stop the omsagent service first)")
+    parser.add_argument("--ruby-profile-rate", required=False, type=int, default=100,
+                        help="rbspy samples per second")
+    parser.add_argument("--soak", required=False, action='store_true',
+                        help="detect memory and fd leaks of the monitored processes during a long run (--run-time)")
+    parser.add_argument("--soak-interval", required=False, type=float, default=10.0,
+                        help="seconds between two --soak samples")
+    parser.add_argument("--soak-warmup", required=False, type=float, default=600.0,
+                        help="seconds of steady-state buffering ignored at the start of --soak")
+    parser.add_argument("--soak-ruby-heap", required=False, action='store_true',
+                        help="also sample the live ruby heap slots with sigdump (SIGCONT) dumps of the agent")
+    parser.add_argument("--soak-pss-every", required=False, type=int, default=6,
+                        help="read the PSS (smaps_rollup) of the --soak processes every this many samples")
+    parser.add_argument("--leak-min-growth", required=False, type=float, default=0.05,
+                        help="relative growth over the --soak window below which a significant slope is not a leak")
     parser.add_argument("--do-profiling", required=False, help="", action='store_true')
     parser.add_argument("--plugins", required=False,
                         help="choose which plugins to enable, available plugins: %s" % ','.join(get_all_plugins_name()),
@@ -688,6 +3736,8 @@ def main(argv):
     if len(unknown) > 0:
         print("unknown args:", unknown)
     args = vars(args)
+    if args['ruby_profiler'] == 'ruby-prof' and args['ruby_profile_mode'] == 'attach':
+        parser.error('ruby-prof cannot attach to a running process, use --ruby-profile-mode launch')
 
     do_profiling = args['do_profiling']
     for name in DEFAULT_VARS.keys():
@@ -696,48 +3746,188 @@ def main(argv):
 
     eps = args['eps']
     run_time = args['run_time']
-    plugins = filter(None, args['plugins'].split(','))
+    plugins = [plugin for plugin in args['plugins'].split(',') if plugin]
     rate = args['sample_rate']
-    pids = map(int, filter(None, args['pids'].split(',')))
+    pids = [int(pid) for pid in args['pids'].split(',') if pid]
 
-    if do_profiling and args['pgrep'] is not '':
+    if (do_profiling or args['ruby_profiler'] != 'none') and args['pgrep'] != '':
         list_pids = subprocess.Popen(('pgrep %s' % args['pgrep']).split(' '), stdout=subprocess.PIPE,
-                                     stderr=subprocess.STDOUT).stdout.readlines()
+                                     stderr=subprocess.STDOUT, universal_newlines=True).stdout.readlines()
         pids += [int(p.strip('\n')) for p in list_pids]
 
+    if DEFAULT_VARS['syslog_framing'] == 'octet':
+        print("Warning: octet framing needs a receiver supporting octet counting, the fluentd 0.12 in_syslog "
+              "bundled with omsagent reads the frames as one line")
+    if DEFAULT_VARS['forward_mode'] == 'compressed':
+        print("Warning: compressed forward mode needs fluentd v0.14+, the fluentd 0.12 in_forward bundled with "
+              "omsagent can't read the gzip entries")
     config_mgr = ConfigManager(DEFAULT_VARS)
+    if config_mgr.corpus is not None:
+        print_corpus_stats(config_mgr.corpus.stats())
     loadbench = LoadBench(run_time, rate, config_mgr)
     loadbench.do_profiling = do_profiling
+    loadbench.send_tick = args['send_tick']
+    loadbench.sampler = args['sampler']
+    loadbench.workers = args['workers']
+    if args['agent_version']:
+        loadbench.agent_version = args['agent_version']
 
     plugin_names = '|'.join(plugins)
     processes = []
-    writers = config_mgr.get_writers_by_name(plugins)
 
-    print("Run load, plugins '%s', %d EPS" % (plugin_names, eps))
+    standin_url = args['ods_standin_url']
+    if standin_url:
+        fetch_standin_stats(standin_url, reset=True)
+
     if do_profiling:
-        processes = map(psutil.Process, pids)
+        processes = [psutil.Process(pid) for pid in pids]
         print("Monitoring process : %s" % ', '.join(['%s-%d' % (p.name(), p.pid) for p in processes]))
 
-    profiling, response_times, nb_events = loadbench.run_load(eps, processes, writers)
+    def make_loadbench(constants):
+        suite_loadbench = LoadBench(run_time, rate, ConfigManager(constants))
+        suite_loadbench.do_profiling = do_profiling
+        suite_loadbench.send_tick = loadbench.send_tick
+        suite_loadbench.sampler = loadbench.sampler
+        suite_loadbench.workers = loadbench.workers
+        suite_loadbench.agent_version = loadbench.agent_version
+        return suite_loadbench
+
+    if args['tuning_matrix']:
+        if not do_profiling:
+            parser.error('--tuning-matrix needs --do-profiling to rank the configurations by CPU')
+        split = lambda value: [item for item in value.split(',') if item]
+        matrix = TuningMatrix(DEFAULT_VARS,
+                              lambda constants, processes: BenchmarkSuite(make_loadbench, constants, processes, [],
+                                                                          standin_url=standin_url),
+                              {'plugins': plugins, 'eps': eps, 'event_size': int(DEFAULT_VARS['event_size'])},
+                              split(args['tune_rmem']), split(args['tune_buffer']), split(args['tune_jemalloc']),
+                              args['tune_output_type'], args['tune_steady_time'], args['pgrep'])
+        results = matrix.run()
+        ranking_path = os.path.join(os.path.dirname(config_mgr.constants['result_path']), 'tuning.csv')
+        TuningMatrix.save_ranking(ranking_path, results)
+        print("Configurations by EPS per CPU %%, ranking saved in %s" % ranking_path)
+        for rank, metrics in enumerate(results, 1):
+            print("  %d. %s: %.2f EPS per cpu %%" % (rank, metrics['configuration'], metrics['eps_per_cpu']))
+        print("Configurations by drops:")
+        for rank, metrics in enumerate(sorted(results, key=lambda metrics: (metrics['drops'] + metrics['lost'],
+                                                                            -metrics['eps_per_cpu'])), 1):
+            print("  %d. %s: drops=%d, lost=%d" % (rank, metrics['configuration'], metrics['drops'], metrics['lost']))
+        return
+
+    if args['suite']:
+        scenarios = SUITE_SCENARIOS
+        if args['suite_file']:
+            with open(args['suite_file']) as f:
+                scenarios = json.load(f)
+        agent_version = args['agent_version'] or get_agent_version()
+        host_key = get_host_key()
+        baselines = BenchmarkSuite.load_baselines(args['baseline_path'])
+        baseline_key = BenchmarkSuite.baseline_key(args['baseline_version'] or agent_version, host_key)
+        suite = BenchmarkSuite(make_loadbench, DEFAULT_VARS, processes, scenarios, args['regression_threshold'],
+                               standin_url)
+        results, regressions = suite.run(baselines, baseline_key)
+        if args['save_baseline']:
+            baselines[BenchmarkSuite.baseline_key(agent_version, host_key)] = results
+            BenchmarkSuite.save_baselines(args['baseline_path'], baselines)
+            print("Baseline of %s on %s saved in %s" % (agent_version, host_key, args['baseline_path']))
+        failed = [name for name, scenario_regressions in regressions.items() if scenario_regressions]
+        if failed:
+            print("Regressions against %s in: %s" % (baseline_key, ', '.join(sorted(failed))))
+            sys.exit(1)
+        return
+
+    if args['find_max_eps']:
+        search = CapacitySearch(loadbench, processes, eps, args['max_eps'], args['eps_precision'], args['max_cpu'],
+                                args['max_send_lag'], standin_url)
+        combinations = [[plugin] for plugin in plugins] + ([plugins] if len(plugins) > 1 else [])
+        max_eps = [('|'.join(combination), search.search(combination)) for combination in combinations]
+        curve_path = os.path.join(os.path.dirname(config_mgr.constants['result_path']), 'capacity.csv')
+        search.save_curve(curve_path)
+        print("Max sustainable EPS (%s), capacity curve saved in %s" % (get_resources(), curve_path))
+        for name, value in max_eps:
+            print("  %s: %d EPS" % (name, value))
+        return
+
+    ruby_profiler = None
+    if args['ruby_profiler'] != 'none':
+        ruby_profiler = RubyProfiler(args['ruby_profiler'], os.path.dirname(config_mgr.constants['result_path']),
+                                     args['ruby_profile_rate'])
+        print("Profiling ruby %s with %s" % (get_ruby_version(get_ruby_path()), args['ruby_profiler']))
+        if args['ruby_profile_mode'] == 'launch':
+            pid = ruby_profiler.launch(config_mgr.constants['omsagent_path'],
+                                       config_mgr.constants['omsagent_config_path'])
+            if do_profiling and pid is not None:
+                processes.append(psutil.Process(pid))
+        else:
+            ruby_profiler.attach(pids)
+
+    writers = config_mgr.get_writers_by_name(plugins)
+    print("Run load, plugins '%s', %d EPS" % (plugin_names, eps))
+    for writer in writers:
+        if isinstance(writer, TailFileWriter):
+            print("in_tail path: %s" % writer.get_glob(loadbench.workers))
+    if args['start_at'] > 0:
+        delay = args['start_at'] - time.time()
+        print("Starting at %s (in %.3f s)" % (datetime.fromtimestamp(args['start_at']).time(), delay))
+        if delay > 0:
+            time.sleep(delay)
+    leak_detector = None
+    if args['soak']:
+        if not processes:
+            parser.error('--soak needs --do-profiling and the processes to watch (--pids or --pgrep)')
+        if args['soak_pss_every'] < 1:
+            parser.error('--soak-pss-every must be at least 1')
+        leak_detector = LeakDetector(processes, args['soak_interval'], args['soak_warmup'], args['leak_min_growth'],
+                                     ruby_heap=args['soak_ruby_heap'], pss_every=args['soak_pss_every'])
+        leak_detector.start()
+    profiling, send_lags, nb_events = loadbench.run_plugins(eps, processes, plugins, writers)
+    if ruby_profiler is not None:
+        print("Ruby profile saved in %s" % ruby_profiler.stop())
+    leaks = []
+    if leak_detector is not None:
+        leak_report = leak_detector.stop()
+        print_leak_report(leak_report)
+        loadbench.stream.write(dict(loadbench.run_context, type='leaks', leaks=leak_report))
+        leaks = sorted('%s %s' % (key, metric) for key, metrics in leak_report.items()
+                       for metric, fit in metrics.items() if fit['leak'])
+    send_stats = loadbench.send_stats
     wait_time_after_completion = int(config_mgr.constants['wait_time_after_completion'])
     if wait_time_after_completion > 0:
         print("Waiting %d seconds after completion" % wait_time_after_completion)
         time.sleep(wait_time_after_completion)
 
-    print("Response times: avg=%.2f s, max=%.2fs" % (average(response_times), max(response_times)))
-    if do_profiling:
-        dropped_events = ['%s:%d' % (w.get_protocol(), w.get_number_dropped_event()) for w in writers]
-        result = {
-            "eps": eps,
-            "sampling_rate": rate,
-            "run_time": run_time,
-            'profiling': profiling,
-            'response_times': response_times,
-            'plugins': plugin_names,
-            'nb_events': nb_events,
-            'drops': dropped_events
-        }
+    # the totals add up all the plugins, each sending --eps
+    print("Send rate: target=%d EPS, achieved=%.1f EPS, max backlog=%d events" %
+          (send_stats['target_eps'], send_stats['achieved_eps'], send_stats['max_backlog']))
+    print("Send lag: avg=%.4f s, p50=%.4f s, p99=%.4f s, max=%.4f s" %
+          (send_stats['avg_lag'], send_stats['p50_lag'], send_stats['p99_lag'], send_stats['max_lag']))
+    for plugin, plugin_stats in sorted(send_stats['plugins'].items()):
+        print("  %s: target=%d EPS, achieved=%.1f EPS, p99 lag=%.4f s, max backlog=%d events, send failed=%d" %
+              (plugin, plugin_stats['target_eps'], plugin_stats['achieved_eps'], plugin_stats['p99_lag'],
+               plugin_stats['max_backlog'], plugin_stats.get('send_failed', 0)))
+    for plugin, writer_stats in sorted(send_stats['writers'].items()):
+        print("  %s: %s" % (plugin, ', '.join('%s=%s' % item for item in sorted(writer_stats.items()))))
+    if 'tail_pos_file' in send_stats:
+        print("  position file: %(entries)d entries, %(unwatched)d unwatched, %(bytes)d bytes" %
+              send_stats['tail_pos_file'])
+    delivery_stats = {}
+    if standin_url:
+        delivery_stats = fetch_standin_stats(standin_url, sent=get_sent_sequences(send_stats),
+                                             send_failed=get_send_failed(send_stats))
+        for plugin, plugin_stats in sorted(delivery_stats['plugins'].items()):
+            print("  %s: delivered=%d events, lost=%d, duplicated=%d, reordered=%d" %
+                  (plugin, plugin_stats['nb_events'], plugin_stats['lost'], plugin_stats['duplicated'],
+                   plugin_stats['reordered']))
+            if plugin_stats['nb_events'] > 0:
+                print("  %s: latency p50=%.3f s, p99=%.3f s, max=%.3f s" %
+                      (plugin, plugin_stats['p50_latency'], plugin_stats['p99_latency'], plugin_stats['max_latency']))
+    if do_profiling or args['start_at'] > 0:
+        # the summary record is what a coordinator merges
+        result = loadbench.make_result(eps, plugins, writers, profiling, send_lags, nb_events, delivery_stats)
         loadbench.save_results(result)
+    if leaks:
+        print("Leaks in: %s" % ', '.join(leaks))
+        sys.exit(1)
 
 
 if __name__ == "__main__":